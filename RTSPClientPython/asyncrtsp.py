@@ -0,0 +1,248 @@
+import asyncio
+import time
+
+from rtsp import Connection, ResponseParser, ControlLatency, RTSPException
+from rtsp import set_receive_buffer, receive_buffer_size
+from rtp import RtpPacket
+from playout import JitterBuffer
+from depacketizer import JpegDepacketizer
+from stats import StreamStatistics
+
+class RtpProtocol(asyncio.DatagramProtocol):
+    '''Datagram endpoint feeding received RTP packets to an AsyncConnection.'''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def datagram_received(self, data, addr):
+        self.connection.packet_received(data)
+
+    def error_received(self, exc):
+        pass
+
+class AsyncConnection:
+    '''asyncio version of rtsp.Connection. The RTSP control channel is an
+    asyncio stream and RTP packets are received by a datagram protocol, so
+    any number of connections can be driven from a single event loop
+    thread. Frames are released by event loop timers at their playout
+    time and passed to session.process_frame, like Connection does.
+
+    Requests are coroutines; a non-200 response raises RTSPException.
+    Responses are matched to requests by CSeq, so requests may be
+    pipelined.
+    '''
+    INIT = Connection.INIT
+    READY = Connection.READY
+    PLAYING = Connection.PLAYING
+    EXPECTED_BITRATE = Connection.EXPECTED_BITRATE
+    JITTER_TOLERANCE = Connection.JITTER_TOLERANCE
+    BURST_FACTOR = Connection.BURST_FACTOR
+    CONTROL_TIMEOUT = Connection.CONTROL_TIMEOUT
+
+    def __init__(self, session, address, jitter_buffer=None):
+        '''Creates a connection object. The TCP connection is only established
+        by the connect() coroutine.
+        '''
+        self.session = session
+        self.address = address[0]
+        self.port = int(address[1])
+        self.state = self.INIT
+        self.file_name = None
+        self.seq_num = 0
+        self.session_id = None
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.parser = ResponseParser()
+        self.outstanding = {}
+        self.latency = ControlLatency()
+        self.transport = None
+        self.data_port = None
+        self.receive_buffer = 0
+        self.timer = None
+        self.jitter_buffer = jitter_buffer if jitter_buffer is not None else JitterBuffer()
+        self.depacketizer = JpegDepacketizer()
+        self.statistics = StreamStatistics()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), self.CONTROL_TIMEOUT)
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_responses())
+
+    def send(self, method, include_session=True, extra_headers=''):
+        '''Sends a request and returns a future resolved with its response.'''
+        self.seq_num += 1
+        request = f'{method} {self.file_name} RTSP/1.0\r\nCSeq: {self.seq_num}\r\n'
+        if include_session and self.session_id is not None:
+            request += f'Session: {self.session_id}\r\n'
+        self.writer.write((request + extra_headers + '\r\n').encode('utf-8'))
+        future = asyncio.get_running_loop().create_future()
+        self.outstanding[self.seq_num] = (method, time.monotonic(), future)
+        return future
+
+    async def request(self, method, include_session=True, extra_headers=''):
+        '''Sends a request and waits for its successful response.'''
+        return await self.response(self.send(method, include_session, extra_headers))
+
+    async def response(self, future):
+        '''Waits at most CONTROL_TIMEOUT seconds for the response resolving
+        future, and checks it.
+        '''
+        return (await asyncio.wait_for(future, self.CONTROL_TIMEOUT)).check()
+
+    async def read_responses(self):
+        '''Reads the control channel and resolves the futures of the
+        outstanding requests as their responses arrive.
+        '''
+        try:
+            while True:
+                data = await self.reader.read(Connection.BUFFER_LENGTH)
+                if not data:
+                    break
+                for response in self.parser.feed(data):
+                    if response.cseq not in self.outstanding:
+                        continue
+                    method, sent, future = self.outstanding.pop(response.cseq)
+                    self.latency.record(method, time.monotonic() - sent)
+                    if not future.done():
+                        future.set_result(response)
+        except OSError:
+            pass
+        for _, _, future in self.outstanding.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed by the server'))
+        self.outstanding.clear()
+
+    async def prepare_setup(self, filename):
+        if self.state != self.INIT:
+            return False
+        self.file_name = filename
+        self.statistics.reset()
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: RtpProtocol(self), local_addr=(self.address, 0))
+            self.data_port = self.transport.get_extra_info('sockname')[1]
+            self.receive_buffer = set_receive_buffer(
+                self.transport.get_extra_info('socket'),
+                receive_buffer_size(self.EXPECTED_BITRATE, self.JITTER_TOLERANCE, self.BURST_FACTOR))
+        return True
+
+    def transport_header(self):
+        return f'Transport: RTP/UDP; client_port= {self.data_port}\r\n'
+
+    async def setup(self, filename):
+        if not await self.prepare_setup(filename):
+            return
+        response = await self.request('SETUP', False, self.transport_header())
+        self.session_id = response.session_id
+        self.state = self.READY
+
+    async def setup_and_play(self, filename):
+        '''Pipelines SETUP and PLAY, as Connection.setup_and_play does.'''
+        if not await self.prepare_setup(filename):
+            return
+        setup = self.send('SETUP', False, self.transport_header())
+        play = self.send('PLAY', False)
+        response = await self.response(setup)
+        self.session_id = response.session_id
+        self.state = self.READY
+        try:
+            await self.response(play)
+        except RTSPException:
+            await self.request('PLAY')
+        self.start_playing()
+
+    async def play(self):
+        if self.state != self.READY:
+            return
+        await self.request('PLAY')
+        self.start_playing()
+
+    def start_playing(self):
+        self.jitter_buffer.resync()
+        self.state = self.PLAYING
+
+    async def pause(self):
+        if self.state != self.PLAYING:
+            return
+        await self.request('PAUSE')
+        self.state = self.READY
+        self.cancel_timer()
+
+    async def teardown(self):
+        if self.state == self.INIT:
+            return
+        await self.request('TEARDOWN')
+        self.state = self.INIT
+        self.session_id = None
+        self.cancel_timer()
+        self.depacketizer.reset()
+        self.jitter_buffer.reset()
+
+    async def close(self):
+        self.cancel_timer()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+    def packet_received(self, data):
+        '''Called by the datagram protocol for every packet.'''
+        if self.state != self.PLAYING:
+            return
+        try:
+            packet = RtpPacket(data, len(data))
+        except ValueError:
+            return
+        loop = asyncio.get_running_loop()
+        packet.arrival = loop.time()
+        self.statistics.packet_received(packet.sequence_number, packet.timestamp,
+                                        len(packet.payload), packet.arrival)
+        frame = self.depacketizer.push(packet, packet.arrival)
+        if frame is not None:
+            self.statistics.frame_completed(packet.arrival)
+            if not self.jitter_buffer.push(frame.sequence_number, frame.timestamp,
+                                           frame, packet.arrival):
+                frame.release()
+        self.schedule_playout()
+
+    def schedule_playout(self):
+        '''Arms a timer for the next frame due in the jitter buffer.'''
+        deadline = self.jitter_buffer.next_deadline()
+        if deadline is None:
+            return
+        loop = asyncio.get_running_loop()
+        when = loop.time() + deadline
+        if self.timer is not None:
+            if self.timer.when() <= when:
+                return
+            self.timer.cancel()
+        self.timer = loop.call_at(when, self.release_frames)
+
+    def release_frames(self):
+        self.timer = None
+        self.depacketizer.expire()
+        for frame in self.jitter_buffer.pop_ready():
+            self.session.process_frame(frame.payload_type, frame.marker, frame.sequence_number,
+                                       frame.timestamp, frame.payload, frame.release,
+                                       frame.arrival, frame.completed)
+        self.schedule_playout()
+
+    def pipeline_stats(self):
+        return {
+            'socket': {'receive_buffer': self.receive_buffer},
+            'depacketizer': self.depacketizer.stats(),
+            'jitter_buffer': self.jitter_buffer.stats(),
+        }
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,297 @@
+#! /usr/bin/python3
+
+'''Headless client benchmark.
+
+Plays a video through Session/Connection against the loopback test server
+once per impairment profile, and records delivered frame rate, frame
+latency percentiles, playout stalls, dropped frames, CPU time and peak
+RSS of the client. Results are written as JSON and as a markdown table
+in the format of ANSWERS.md, and can be compared against a stored
+baseline so that regressions make the run fail.
+
+With --lifecycle, it instead measures the CPU used by paused sessions
+and the number of threads left after repeated play/pause/teardown
+cycles.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+from server import RTSPServer, PROFILES
+from session import Session, SessionListener
+
+FRAME_PERIOD = RTSPServer.FRAME_PERIOD / 1000.
+STALL_THRESHOLD = 2 * FRAME_PERIOD
+
+class FrameRecorder(SessionListener):
+    '''Listener recording the delivery time and latency of every frame.'''
+    def __init__(self):
+        self.deliveries = []
+        self.latencies = []
+        self.timestamps = []
+        self.errors = []
+
+    def frame_received(self, frame):
+        if frame is None:
+            return
+        now = time.monotonic()
+        self.deliveries.append(now)
+        self.timestamps.append(frame.timestamp)
+        if frame.arrival is not None:
+            self.latencies.append(now - frame.arrival)
+
+    def exception_thrown(self, exception):
+        self.errors.append(str(exception))
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a list of values (0 if empty).'''
+    if not values:
+        return 0.
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100. * len(ordered)))]
+
+def run_server(profile, seed, video_dir, max_payload, ports):
+    server = RTSPServer(0, impairment=PROFILES[profile], seed=seed,
+                        video_dir=video_dir, max_payload=max_payload)
+    ports.put(server.address[1])
+    server.serve_forever()
+
+def run_client(port, video, duration, idle_timeout, results):
+    '''Plays the video and reports the measurements through results. Runs
+    in its own process, so CPU time and peak RSS belong to this run only.
+    '''
+    recorder = FrameRecorder()
+    cpu_start = time.process_time()
+    session = Session(('127.0.0.1', port))
+    session.add_listener(recorder)
+    session.open(video)
+    start = time.monotonic()
+    session.play()
+    while time.monotonic() - start < duration:
+        time.sleep(0.1)
+        last = recorder.deliveries[-1] if recorder.deliveries else start
+        if time.monotonic() - last > idle_timeout:
+            break
+    statistics = session.get_statistics()
+    pipeline = session.pipeline_stats()
+    session.teardown()
+    session.close()
+    cpu_time = time.process_time() - cpu_start
+    results.put(summarize(recorder, statistics, pipeline, cpu_time,
+                          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def run_lifecycle(port, video, sessions, cycles, idle_time, results):
+    '''Pauses sessions after a short playback and measures the CPU they use
+    while idle, then cycles them through PLAY, PAUSE, TEARDOWN and SETUP
+    and records the thread count after each cycle.
+    '''
+    initial_threads = threading.active_count()
+    clients = [Session(('127.0.0.1', port)) for _ in range(sessions)]
+    for session in clients:
+        session.open(video, play=True)
+    time.sleep(1.)
+    for session in clients:
+        session.pause()
+    time.sleep(0.2)
+    paused_threads = threading.active_count()
+    cpu_start = time.process_time()
+    time.sleep(idle_time)
+    idle_cpu = time.process_time() - cpu_start
+    thread_counts = []
+    for _ in range(cycles):
+        for session in clients:
+            session.play()
+        for session in clients:
+            session.pause()
+        for session in clients:
+            session.play()
+        for session in clients:
+            session.teardown()
+            session.open(video)
+        thread_counts.append(threading.active_count())
+    for session in clients:
+        session.teardown()
+        session.close()
+    time.sleep(0.1)
+    final_threads = threading.active_count()
+    results.put({
+        'sessions': sessions,
+        'idle_cpu_per_session_ms': 1000 * idle_cpu / sessions / idle_time,
+        'initial_threads': initial_threads,
+        'paused_threads': paused_threads,
+        'threads_per_cycle': thread_counts,
+        'final_threads': final_threads,
+    })
+
+def lifecycle(args):
+    ports = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, daemon=True,
+                                     args=('NONE', args.seed, args.video_dir,
+                                           args.max_payload, ports))
+    server.start()
+    try:
+        client = multiprocessing.Process(target=run_lifecycle,
+                                         args=(ports.get(timeout=10), args.video, args.lifecycle,
+                                               args.cycles, args.idle_time, results))
+        client.start()
+        result = results.get(timeout=args.idle_time + 10 * args.cycles + 30)
+        client.join()
+    finally:
+        server.terminate()
+        server.join()
+    return result
+
+def summarize(recorder, statistics, pipeline, cpu_time, peak_rss_kb):
+    deliveries = recorder.deliveries
+    gaps = [b - a for a, b in zip(deliveries, deliveries[1:])]
+    stalls = [gap for gap in gaps if gap > STALL_THRESHOLD]
+    span = deliveries[-1] - deliveries[0] if len(deliveries) > 1 else 0.
+    if recorder.timestamps:
+        expected = (max(recorder.timestamps) - min(recorder.timestamps)) \
+            // RTSPServer.FRAME_PERIOD + 1
+    else:
+        expected = 0
+    return {
+        'frames_delivered': len(deliveries),
+        'fps': (len(deliveries) - 1) / span if span else 0.,
+        'latency_p50_ms': 1000 * percentile(recorder.latencies, 50),
+        'latency_p95_ms': 1000 * percentile(recorder.latencies, 95),
+        'latency_p99_ms': 1000 * percentile(recorder.latencies, 99),
+        'stalls': len(stalls),
+        'stall_time': sum(stalls),
+        'frames_dropped': max(0, expected - len(deliveries)),
+        'packets_received': statistics['packets_received'],
+        'packet_rate': statistics['packets_received'] / statistics['duration']
+            if statistics['duration'] else 0.,
+        'loss_rate': statistics['loss_rate'],
+        'reordered': statistics['reordered'],
+        'jitter_ms': statistics['jitter_ms'],
+        'cpu_time': cpu_time,
+        'peak_rss_kb': peak_rss_kb,
+        'pipeline': pipeline,
+        'errors': recorder.errors,
+    }
+
+def run_profile(profile, args):
+    '''Runs the server and the client in separate processes for one profile.'''
+    ports = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, daemon=True,
+                                     args=(profile, args.seed, args.video_dir,
+                                           args.max_payload, ports))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        client = multiprocessing.Process(target=run_client,
+                                         args=(port, args.video, args.duration,
+                                               args.idle_timeout, results))
+        client.start()
+        result = results.get(timeout=args.duration + 30)
+        client.join()
+    finally:
+        server.terminate()
+        server.join()
+    result['profile'] = profile
+    return result
+
+def markdown_table(results):
+    lines = ['| FUNKY SERVER | FRAME RATE (pkts/sec) | PACKET LOSS RATE (/sec) | OUT OF ORDER '
+             '| PACKETS RECEIVED | DELIVERED FPS | LATENCY p50/p95/p99 (ms) | STALLS '
+             '| DROPPED FRAMES | CPU (s) | PEAK RSS (MB) |',
+             '|:------------:|' + '---|' * 10]
+    for r in results:
+        lines.append(f"| {r['profile']:^12} | {r['packet_rate']:.1f} | {r['loss_rate']:.1f} "
+                     f"| {r['reordered']} | {r['packets_received']} | {r['fps']:.1f} "
+                     f"| {r['latency_p50_ms']:.0f}/{r['latency_p95_ms']:.0f}/{r['latency_p99_ms']:.0f} "
+                     f"| {r['stalls']} | {r['frames_dropped']} | {r['cpu_time']:.2f} "
+                     f"| {r['peak_rss_kb'] / 1024:.1f} |")
+    return '\n'.join(lines)
+
+def compare(results, baseline, tolerance):
+    '''Returns a list describing every metric that got worse than the
+    baseline by more than the tolerance (a fraction).
+    '''
+    previous = {r['profile']: r for r in baseline}
+    regressions = []
+    for r in results:
+        base = previous.get(r['profile'])
+        if base is None:
+            continue
+        checks = [
+            ('fps', r['fps'] < base['fps'] * (1 - tolerance)),
+            ('latency_p95_ms', r['latency_p95_ms'] > base['latency_p95_ms'] * (1 + tolerance) + 5),
+            ('stalls', r['stalls'] > base['stalls'] * (1 + tolerance) + 1),
+            ('frames_dropped', r['frames_dropped'] > base['frames_dropped'] * (1 + tolerance) + 2),
+            ('cpu_time', r['cpu_time'] > base['cpu_time'] * (1 + tolerance) + 0.1),
+        ]
+        for metric, worse in checks:
+            if worse:
+                regressions.append(f"{r['profile']}: {metric} {base[metric]:.2f} -> {r[metric]:.2f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless RTSP client benchmark')
+    parser.add_argument('--profiles', nargs='+', default=sorted(PROFILES),
+                        choices=sorted(PROFILES))
+    parser.add_argument('--video', default='movie1.Mjpeg')
+    parser.add_argument('--video-dir', default=os.path.join(os.path.dirname(__file__), '..'))
+    parser.add_argument('--duration', type=float, default=15.,
+                        help='maximum playback time per profile, in seconds')
+    parser.add_argument('--idle-timeout', type=float, default=2.,
+                        help='stop a run once no frame arrived for this many seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-payload', type=int, default=60000)
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--markdown', help='write the results table to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--lifecycle', type=int, metavar='SESSIONS',
+                        help='measure idle CPU and threads of this many paused sessions instead')
+    parser.add_argument('--cycles', type=int, default=10,
+                        help='play/pause/teardown cycles for --lifecycle')
+    parser.add_argument('--idle-time', type=float, default=5.,
+                        help='seconds over which paused sessions are measured for --lifecycle')
+    args = parser.parse_args()
+
+    if args.lifecycle:
+        result = lifecycle(args)
+        print(f"{result['sessions']} paused sessions: "
+              f"{result['idle_cpu_per_session_ms']:.3f} ms CPU per second each")
+        print(f"threads: {result['initial_threads']} initially, {result['paused_threads']} paused, "
+              f"{' '.join(map(str, result['threads_per_cycle']))} after each cycle, "
+              f"{result['final_threads']} after close")
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump(result, out, indent=2)
+        return
+
+    results = []
+    for profile in args.profiles:
+        print(f'Running profile {profile}...', file=sys.stderr)
+        results.append(run_profile(profile, args))
+
+    table = markdown_table(results)
+    print(table)
+    if args.markdown:
+        with open(args.markdown, 'w') as out:
+            out.write(table + '\n')
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as saved:
+            regressions = compare(results, json.load(saved), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+#! /usr/bin/python3
+
+'''Raw RTP capture and replay.
+
+A capture file starts with MAGIC, followed by one record per datagram: its
+monotonic arrival time (a double) and length (an unsigned short), then the
+datagram itself. Connection.start_capture() logs every datagram received
+on the data socket to such a file, and ReplayConnection feeds a capture
+back into the receive path of Connection, either at the original timing
+(for reproducible latency runs) or as fast as possible (for a pure CPU
+benchmark of parsing, reordering and decoding).
+'''
+
+import argparse
+import contextlib
+import functools
+import logging
+import os
+import struct
+import threading
+import time
+
+from rtsp import Connection
+from rtp import RtpPacket
+from pipeline import BoundedQueue
+from session import Session, SessionListener
+from profiling import profiled, format_report
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'RTPCAP01'
+RECORD = struct.Struct('<dH')
+
+class CaptureWriter:
+    '''Appends datagrams to a capture file through a buffered writer.'''
+    WRITE_BUFFER = 1 << 20
+
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=self.WRITE_BUFFER)
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.packets = 0
+        self.bytes = 0
+
+    def write(self, arrival, data):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD.pack(arrival, len(data)))
+            self.file.write(data)
+            self.packets += 1
+            self.bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def open_capture(path):
+    '''Opens a capture file for reading, checking its header. Raises
+    OSError if it cannot be opened and ValueError if it is not a capture.
+    '''
+    capture = open(path, 'rb')
+    if capture.read(len(MAGIC)) != MAGIC:
+        capture.close()
+        raise ValueError(f'{path} is not an RTP capture file')
+    return capture
+
+def read_records(capture):
+    '''Yields the (arrival, datagram) pairs from a capture file opened by
+    open_capture, stopping at the end of the file or at a truncated
+    record.
+    '''
+    while True:
+        header = capture.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        arrival, length = RECORD.unpack(header)
+        data = capture.read(length)
+        if len(data) < length:
+            return
+        yield arrival, data
+
+class ReplayConnection(Connection):
+    '''Connection playing back capture files from the directory address[0]
+    (address[1] is ignored) instead of talking to a server. Packets go
+    through the same statistics, depacketizer and jitter buffer as live
+    ones.
+
+    With realtime set, datagrams are queued for the playout thread at
+    their original pace, stamped with the current time. Otherwise a
+    single thread processes them back to back, with their captured
+    arrival times as a virtual clock, and finished is set at the end of
+    the capture.
+    '''
+    def __init__(self, session, address, jitter_buffer=None, realtime=True):
+        self.directory = address[0] or '.'
+        self.realtime = realtime
+        self.capture_file = None
+        self.records = None
+        self.clock = None
+        self.finished = threading.Event()
+        super().__init__(session, (self.directory, 0), jitter_buffer)
+        self.seekable = False
+
+    def connect(self):
+        pass
+
+    def send_request(self, command, include_session=True, extra_headers=None):
+        '''There is no server: requests are numbered but never sent.'''
+        self.seqNum += 1
+        return self.seqNum
+
+    def get_response(self, cseq):
+        '''Requests are never sent, so they have no response.'''
+        return None
+
+    def setup(self, filename):
+        if self.state != self.INIT:
+            log.warning("incorrect state")
+            return
+        # opened here, so a missing or invalid file is reported by setup
+        self.capture_file = open_capture(os.path.join(self.directory, filename))
+        self.records = read_records(self.capture_file)
+        self.fileName = filename
+        self.clock = None
+        self.finished.clear()
+        self.statistics.reset()
+        self.state = self.READY
+
+    def setup_and_play(self, filename):
+        self.setup(filename)
+        self.play()
+
+    def play(self):
+        if self.state != self.READY:
+            log.warning("incorrect state")
+            return
+        self.start_playing()
+
+    def start_playing(self):
+        self.jitter_buffer.resync(None if self.realtime else self.clock)
+        self.state = self.PLAYING
+        self.start_rtp_timer()
+
+    def start_rtp_timer(self):
+        self.playEvent = threading.Event()
+        self.packet_queue = BoundedQueue(self.PACKET_QUEUE_LENGTH)
+        self.receiver = threading.Thread(target=self.replay_packets, daemon=True)
+        if self.realtime:
+            self.t = threading.Thread(target=self.process_data, daemon=True)
+            self.t.start()
+        self.receiver.start()
+
+    def stop_rtp_timer(self):
+        self.playEvent.set()
+        self.packet_queue.close()
+        for thread in (self.receiver, self.t):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self.t = self.receiver = None
+
+    def pause(self):
+        if self.state != self.PLAYING:
+            log.warning("incorrect state")
+            return
+        self.stop_rtp_timer()
+        self.state = self.READY
+
+    def teardown(self):
+        if self.state == self.INIT:
+            log.warning("incorrect state")
+            return
+        if self.state == self.PLAYING:
+            self.stop_rtp_timer()
+        self.state = self.INIT
+        self.records = None
+        self.capture_file.close()
+        self.capture_file = None
+        self.packet_queue.clear()
+        self.depacketizer.reset()
+        self.jitter_buffer.reset()
+
+    def close(self):
+        if self.state != self.INIT:
+            self.teardown()
+        self.socket.close()
+
+    def replay_packets(self):
+        '''Replay thread: reads the capture from where it was left and feeds
+        its datagrams to the receive path. finished is set when it ends,
+        whatever the reason; errors are reported to the session.
+        '''
+        try:
+            self.feed_records()
+        except Exception as exception:
+            self.session.handle_exception(exception)
+        finally:
+            self.finished.set()
+
+    def feed_records(self):
+        anchor = None
+        for arrival, data in self.records:
+            buffer = self.buffer_pool.acquire()
+            buffer[:len(data)] = data
+            try:
+                packet = RtpPacket(buffer, len(data), self.buffer_pool)
+            except ValueError:
+                self.buffer_pool.release(buffer)
+                continue
+            if not self.realtime:
+                self.clock = packet.arrival = arrival
+                self.process_packet(packet)
+                self.release_frames(arrival)
+            else:
+                if anchor is None:
+                    anchor = time.monotonic() - arrival
+                delay = anchor + arrival - time.monotonic()
+                if delay > 0 and self.playEvent.wait(delay):
+                    packet.release()
+                    return
+                packet.arrival = time.monotonic()
+                self.packet_queue.put(packet)
+            if self.playEvent.is_set():
+                return
+        if not self.realtime:
+            self.release_frames(float('inf'))
+
+class FrameCounter(SessionListener):
+    def __init__(self):
+        self.frames = 0
+        self.errors = []
+
+    def frame_received(self, frame):
+        if frame is not None:
+            self.frames += 1
+
+    def exception_thrown(self, exception):
+        self.errors.append(str(exception))
+
+def record(args):
+    session = Session((args.host, args.port), decode_workers=0)
+    session.connection.start_capture(CaptureWriter(args.output))
+    session.open(args.video, play=True)
+    start = last = time.monotonic()
+    packets = 0
+    while time.monotonic() - start < args.duration and time.monotonic() - last < args.idle_timeout:
+        time.sleep(0.1)
+        if session.connection.capture.packets != packets:
+            packets = session.connection.capture.packets
+            last = time.monotonic()
+    session.teardown()
+    session.close()
+    return f'Captured {packets} packets to {args.output}'
+
+def replay(args):
+    connection_class = functools.partial(ReplayConnection, realtime=args.realtime)
+    directory, filename = os.path.split(args.capture)
+    counter = FrameCounter()
+    wall_start, cpu_start = time.monotonic(), time.process_time()
+    session = Session((directory, None), decode_workers=0, connection_class=connection_class)
+    session.add_listener(counter)
+    # arrival times are virtual when replaying as fast as possible
+    latency = session.enable_latency(interval=None) if args.realtime else None
+    session.open(filename, play=True)
+    if counter.errors:
+        session.close()
+        raise SystemExit(f'replay failed: {counter.errors[0]}')
+    session.connection.finished.wait()
+    if counter.errors:
+        session.teardown()
+        session.close()
+        raise SystemExit(f'replay failed: {counter.errors[0]}')
+    if args.realtime:
+        while session.connection.jitter_buffer.depth or len(session.connection.packet_queue):
+            time.sleep(0.05)
+    wall_time, cpu_time = time.monotonic() - wall_start, time.process_time() - cpu_start
+    statistics = session.get_statistics()
+    session.teardown()
+    session.close()
+    report = format_report(latency.stats()) + '\n' if latency else ''
+    return report + (f"{statistics['packets_received']} packets, {counter.frames} frames in "
+          f"{wall_time:.2f}s ({counter.frames / wall_time:.1f} fps), CPU {cpu_time:.2f}s, "
+          f"loss {100 * statistics['loss_fraction']:.1f}%, reordered {statistics['reordered']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture RTP streams and replay them')
+    commands = parser.add_subparsers(dest='command', required=True)
+    capture = commands.add_parser('record', help='play a video from a server and capture it')
+    capture.add_argument('host')
+    capture.add_argument('port', type=int)
+    capture.add_argument('output')
+    capture.add_argument('--video', default='movie1.Mjpeg')
+    capture.add_argument('--duration', type=float, default=float('inf'))
+    capture.add_argument('--idle-timeout', type=float, default=2.)
+    playback = commands.add_parser('replay', help='feed a capture through the client')
+    playback.add_argument('capture')
+    playback.add_argument('--realtime', action='store_true',
+                          help='keep the original timing instead of replaying as fast as possible')
+    playback.add_argument('--profile', choices=('sample', 'cprofile'),
+                          help='profile the replay and print the busiest functions')
+    parser.set_defaults(profile=None)
+    args = parser.parse_args()
+    with contextlib.ExitStack() as stack:
+        if args.profile:
+            stack.enter_context(profiled(args.profile))
+        summary = record(args) if args.command == 'record' else replay(args)
+    print(summary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#! /usr/bin/python3
+
+'''Headless command-line client, suitable for scripts and health checks:
+
+    python -m client HOST PORT [--video NAME] [--duration S] [--frames N]
+
+Connects to the server, opens and plays a video for a duration or until a
+number of frames has been received, then prints the stream statistics
+(or writes them as JSON) and exits with status 1 if no frame arrived or
+an error was reported. Frames are not decoded unless --decode is given,
+so neither Pillow nor Tk is loaded; the time spent importing the client
+modules, the peak memory use and the modules loaded are part of the
+output, to keep startup cheap.
+'''
+
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import json
+import resource
+import sys
+
+from session import Session, SessionListener, Concealment
+
+IMPORTED = time.perf_counter()
+
+class HealthProbe(SessionListener):
+    '''Listener counting frames and errors, and waking the client once
+    enough frames have arrived.
+    '''
+    def __init__(self, frames=None):
+        self.target = frames
+        self.frames = 0
+        self.first_frame = None
+        self.errors = []
+
+    def frame_received(self, frame):
+        if frame is None:
+            return
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter()
+        self.frames += 1
+
+    def exception_thrown(self, exception):
+        self.errors.append(str(exception))
+
+    def done(self):
+        return self.target is not None and self.frames >= self.target
+
+def run(args):
+    probe = HealthProbe(args.frames)
+    start = time.perf_counter()
+    session = Session((args.host, args.port), decode_workers=0,
+                      decode_ahead=args.decode)
+    connected = time.perf_counter()
+    session.set_concealment(args.conceal)
+    session.add_listener(probe)
+    session.open(args.video, play=True)
+    playing = time.perf_counter()
+    while not probe.done() and not probe.errors \
+            and time.perf_counter() - playing < args.duration:
+        time.sleep(0.01)
+    statistics = session.get_statistics()
+    concealment = session.concealment.stats()
+    session.teardown()
+    session.close()
+    return {
+        'ok': probe.frames > 0 and not probe.errors and (args.frames is None or probe.done()),
+        'frames': probe.frames,
+        'errors': probe.errors,
+        'startup': {
+            'import_ms': 1000 * (IMPORTED - STARTED),
+            'connect_ms': 1000 * (connected - start),
+            'setup_play_ms': 1000 * (playing - connected),
+            'first_frame_ms': 1000 * (probe.first_frame - start) if probe.first_frame else None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'modules': len(sys.modules),
+            'imaging_loaded': 'PIL' in sys.modules,
+            'tk_loaded': 'tkinter' in sys.modules,
+        },
+        'statistics': statistics,
+        'concealment': concealment,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless RTSP client')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--video', default='movie1.Mjpeg')
+    parser.add_argument('--duration', type=float, default=5.,
+                        help='maximum playback time, in seconds')
+    parser.add_argument('--frames', type=int,
+                        help='stop once this many frames have been received')
+    parser.add_argument('--decode', action='store_true',
+                        help='decode every frame (loads Pillow)')
+    parser.add_argument('--conceal', choices=Concealment.POLICIES, default=Concealment.HOLD,
+                        help='how frames with an invalid payload are hidden')
+    parser.add_argument('--json', help="write the results to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump(result, out, indent=2)
+        startup = result['startup']
+        statistics = result['statistics']
+        print(f"{'OK' if result['ok'] else 'FAIL'}: {result['frames']} frames, "
+              f"{statistics['frame_rate']:.1f} fps, loss {100 * statistics['loss_fraction']:.1f}%, "
+              f"import {startup['import_ms']:.1f}ms, connect {startup['connect_ms']:.1f}ms, "
+              f"first frame {startup['first_frame_ms'] or 0:.1f}ms, "
+              f"peak RSS {startup['peak_rss_kb'] / 1024:.1f}MB")
+        for error in result['errors']:
+            print(f'error: {error}', file=sys.stderr)
+    sys.exit(0 if result['ok'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import collections
+import re
+import time
+
+from playout import SequenceExtender
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+# SOI and EOI cannot occur in entropy-coded data, where 0xff is stuffed
+IMAGE_MARKER = re.compile(b'\xff[\xd8\xd9]')
+MIN_JPEG_LENGTH = 128
+
+def check_jpeg(payload):
+    '''Cheap structural check of a JPEG image, made before spending time
+    decoding it. Returns None if the payload looks complete, or else the
+    reason why not. The image must start with SOI, followed by marker
+    segments that fit in the payload, including a frame header (SOF)
+    before the first scan (SOS), and end with EOI after the scan data,
+    with no other SOI or EOI in between, as happens when the payload is
+    truncated or holds fragments of two different frames.
+    '''
+    length = len(payload)
+    if length < MIN_JPEG_LENGTH:
+        return 'too short'
+    if payload[:2] != SOI:
+        return 'missing SOI'
+    position = 2
+    frame_header = False
+    while True:
+        if position + 4 > length:
+            return 'truncated headers'
+        if payload[position] != 0xff:
+            return 'invalid marker'
+        marker = payload[position + 1]
+        if marker == 0xff:
+            position += 1 # fill byte
+            continue
+        if marker in (0xd8, 0xd9):
+            return 'missing scan'
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            position += 2 # markers without a segment
+            continue
+        segment = payload[position + 2] << 8 | payload[position + 3]
+        if segment < 2 or position + 2 + segment > length:
+            return 'truncated segment'
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            frame_header = True
+        position += 2 + segment
+        if marker == 0xda:
+            break
+    if not frame_header:
+        return 'missing frame header'
+    match = IMAGE_MARKER.search(payload, position)
+    if match is None:
+        return 'missing EOI'
+    if match.group() == SOI:
+        return 'mixed frames'
+    if match.end() != length and any(payload[match.end():]):
+        return 'data after EOI'
+    return None
+
+class JpegFrame:
+    '''A complete JPEG frame assembled from one or more RTP packets. It
+    exposes the same fields as RtpPacket, so later stages handle both alike.
+    '''
+    __slots__ = ('payload_type', 'marker', 'sequence_number', 'timestamp',
+                 'payload', 'fragments', 'packets', 'arrival', 'completed')
+
+    def __init__(self, packets):
+        first = packets[0]
+        self.payload_type = first.payload_type
+        self.marker = packets[-1].marker
+        self.sequence_number = first.sequence_number
+        self.timestamp = first.timestamp
+        self.fragments = len(packets)
+        arrivals = [p.arrival for p in packets if p.arrival is not None]
+        self.arrival = min(arrivals, default=None)
+        self.completed = max(arrivals, default=None)
+        if len(packets) == 1:
+            # single datagram: keep the zero-copy payload
+            self.payload = first.payload
+            self.packets = packets
+        else:
+            self.payload = b''.join(p.payload for p in packets)
+            for p in packets:
+                p.release()
+            self.packets = ()
+
+    def release(self):
+        for p in self.packets:
+            p.release()
+        self.packets = ()
+
+class PendingFrame:
+    __slots__ = ('fragments', 'first_arrival', 'start', 'end')
+
+    def __init__(self, arrival):
+        self.fragments = {}
+        self.first_arrival = arrival
+        self.start = None
+        self.end = None
+
+    def is_complete(self):
+        if self.start is None or self.end is None or self.end < self.start:
+            return False
+        return all(seq in self.fragments for seq in range(self.start, self.end + 1))
+
+    def release(self):
+        for p in self.fragments.values():
+            p.release()
+        self.fragments.clear()
+
+class JpegDepacketizer:
+    '''Reassembles JPEG frames from RTP packets. Fragments are grouped by
+    RTP timestamp and ordered by extended sequence number. A frame starts
+    with the fragment whose payload begins with the JPEG SOI marker and is
+    closed by the packet with the RTP marker bit set (or, for servers that
+    do not set it, the fragment ending with the EOI marker). A frame is
+    complete once every fragment in between has arrived, in any order.
+
+    At most window frames are assembled at once; frames still incomplete
+    after deadline seconds, or pushed out of the window, are abandoned.
+    '''
+    def __init__(self, window=8, deadline=0.5):
+        self.window = window
+        self.deadline = deadline
+        self.sequence = SequenceExtender()
+        self.reset()
+
+    def reset(self):
+        for pending in getattr(self, 'pending', {}).values():
+            pending.release()
+        self.pending = collections.OrderedDict()
+        self.closed = collections.deque(maxlen=4 * self.window)
+        self.sequence.reset()
+        self.fragments_received = 0
+        self.frames_completed = 0
+        self.frames_abandoned = 0
+        self.late_fragments = 0
+        self.duplicate_fragments = 0
+
+    def push(self, packet, arrival=None):
+        '''Adds a packet to the frame it belongs to. Returns the assembled
+        JpegFrame if this packet completed it, or None otherwise.
+        '''
+        if arrival is None:
+            arrival = time.monotonic()
+        self.fragments_received += 1
+        seq = self.sequence.extend(packet.sequence_number)
+        ts = packet.timestamp
+        if ts in self.closed:
+            self.late_fragments += 1
+            packet.release()
+            return None
+        pending = self.pending.get(ts)
+        if pending is None:
+            pending = self.pending[ts] = PendingFrame(arrival)
+            if len(self.pending) > self.window:
+                self.abandon(next(iter(self.pending)))
+        if seq in pending.fragments:
+            self.duplicate_fragments += 1
+            packet.release()
+            return None
+        pending.fragments[seq] = packet
+        payload = packet.payload
+        if payload[:2] == SOI:
+            pending.start = seq
+        if packet.marker or payload[-2:] == EOI:
+            pending.end = seq
+        if not pending.is_complete():
+            return None
+        del self.pending[ts]
+        self.closed.append(ts)
+        self.frames_completed += 1
+        return JpegFrame([pending.fragments[s] for s in range(pending.start, pending.end + 1)])
+
+    def expire(self, now=None):
+        '''Abandons frames that have been incomplete for longer than the
+        deadline.
+        '''
+        if now is None:
+            now = time.monotonic()
+        while self.pending:
+            ts, pending = next(iter(self.pending.items()))
+            if now - pending.first_arrival <= self.deadline:
+                break
+            self.abandon(ts)
+
+    def abandon(self, ts):
+        self.pending.pop(ts).release()
+        self.closed.append(ts)
+        self.frames_abandoned += 1
+
+    def stats(self):
+        return {
+            'fragments_received': self.fragments_received,
+            'frames_completed': self.frames_completed,
+            'frames_abandoned': self.frames_abandoned,
+            'frames_pending': len(self.pending),
+            'late_fragments': self.late_fragments,
+            'duplicate_fragments': self.duplicate_fragments,
+        }
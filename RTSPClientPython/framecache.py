@@ -0,0 +1,202 @@
+import bisect
+import collections
+import hashlib
+import threading
+import time
+
+class FrameCache:
+    '''Least recently used cache of decoded frames, keyed by RTP timestamp
+    (which identifies a frame within one video), holding at most max_bytes
+    bytes of decoded pixels. Frames are added once decoded, so a short
+    rewind or scrubbing over recently played video can be shown, and
+    frames played again need not be decoded a second time. The cache must
+    be cleared when another video is opened.
+
+    Frames are kept with their decoded image only; their payload is not
+    retained. tolerance is the largest distance, in milliseconds, between
+    a position and the timestamp of the frame returned for it by
+    frame_at.
+    '''
+    MAX_BYTES = 64 << 20
+    TOLERANCE = 100
+
+    def __init__(self, max_bytes=MAX_BYTES, tolerance=TOLERANCE):
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.frames = collections.OrderedDict()
+        self.timestamps = []
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.insertions = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame_size(self, frame):
+        image = frame.image
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+    def put(self, frame):
+        '''Adds a decoded frame, evicting the least recently used frames to
+        stay within the budget. Frames larger than the whole budget are
+        not cached.
+        '''
+        if frame.image is None:
+            return
+        size = self.frame_size(frame)
+        with self.lock:
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            self.remove(frame.timestamp)
+            self.frames[frame.timestamp] = (frame, size)
+            bisect.insort(self.timestamps, frame.timestamp)
+            self.bytes += size
+            self.insertions += 1
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.frames)))
+                self.evictions += 1
+
+    def remove(self, timestamp):
+        entry = self.frames.pop(timestamp, None)
+        if entry is not None:
+            del self.timestamps[bisect.bisect_left(self.timestamps, timestamp)]
+            self.bytes -= entry[1]
+
+    def get(self, timestamp, decode_size=None):
+        '''Returns the cached frame with the given timestamp, if it was
+        decoded for decode_size, or None.
+        '''
+        with self.lock:
+            entry = self.frames.get(timestamp)
+            if entry is None or entry[0].decode_size != decode_size:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(timestamp)
+            self.hits += 1
+            return entry[0]
+
+    def frame_at(self, position):
+        '''Returns the cached frame shown at position milliseconds (the last
+        one starting at or before it), or None if there is none within
+        tolerance.
+        '''
+        with self.lock:
+            index = bisect.bisect_right(self.timestamps, position)
+            if index == 0 or position - self.timestamps[index - 1] > self.tolerance:
+                self.misses += 1
+                return None
+            timestamp = self.timestamps[index - 1]
+            self.frames.move_to_end(timestamp)
+            self.hits += 1
+            return self.frames[timestamp][0]
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.timestamps.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'frames': len(self.frames),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'insertions': self.insertions,
+                'evictions': self.evictions,
+                'rejected': self.rejected,
+            }
+
+class DecodeCache:
+    '''Least recently used cache of decoded images keyed by a hash of the
+    JPEG payload and the size it was decoded for, so that identical
+    payloads (static scenes, resent or duplicated frames, or several
+    sessions watching the same feed) are decoded only once. It holds at
+    most max_entries images and max_bytes bytes of pixels. The time spent
+    hashing is counted, to be weighed against the decoding time saved.
+    '''
+    MAX_ENTRIES = 64
+    MAX_BYTES = 32 << 20
+    DIGEST_SIZE = 16
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.images = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.insertions = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.hash_time = 0.
+
+    def __len__(self):
+        return len(self.images)
+
+    def key(self, payload, decode_size=None):
+        '''Returns the cache key of a payload decoded for decode_size.'''
+        start = time.perf_counter()
+        digest = hashlib.blake2b(payload, digest_size=self.DIGEST_SIZE).digest()
+        with self.lock:
+            self.hash_time += time.perf_counter() - start
+        return digest, len(payload), decode_size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.images.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image):
+        size = image.size[0] * image.size[1] * len(image.getbands())
+        with self.lock:
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.images[key] = (image, size)
+            self.bytes += size
+            self.insertions += 1
+            while len(self.images) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self.images.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.images),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'insertions': self.insertions,
+                'evictions': self.evictions,
+                'rejected': self.rejected,
+                'hash_ms': 1000 * self.hash_time,
+            }
@@ -0,0 +1,222 @@
+#! /usr/bin/python3
+
+'''Load generator: runs many headless client sessions against one server.
+
+In async mode (the default) all sessions run as AsyncSession objects on
+a single event loop thread; in thread mode each one is a regular Session
+with its own receive threads, as used by the GUI. Sessions can start
+simultaneously or staggered, and play for a fixed duration or until the
+end of the video. Per-session and aggregate frame rate, loss,
+reordering, decode throughput and control request latency are reported.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import time
+
+from session import Session, SessionListener, AsyncSession, Concealment, decoder_pool
+from framecache import DecodeCache
+
+class SessionProbe(SessionListener):
+    '''Listener counting the frames delivered to one session.'''
+    def __init__(self):
+        self.frames = 0
+        self.first = None
+        self.last = None
+        self.errors = []
+
+    def frame_received(self, frame):
+        if frame is None:
+            return
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+        self.frames += 1
+
+    def exception_thrown(self, exception):
+        self.errors.append(str(exception))
+
+    def idle_for(self, since):
+        return time.monotonic() - (self.last or since)
+
+def session_result(index, probe, session, control):
+    statistics = session.get_statistics()
+    concealment = session.concealment.stats()
+    span = probe.last - probe.first if probe.frames > 1 else 0.
+    return {
+        'session': index,
+        'frames': probe.frames,
+        'fps': (probe.frames - 1) / span if span else 0.,
+        'packets_received': statistics['packets_received'],
+        'loss_fraction': statistics['loss_fraction'],
+        'reordered': statistics['reordered'],
+        'jitter_ms': statistics['jitter_ms'],
+        'decode_ms': session.decode_statistics.stats()['mean_ms'],
+        'frames_rejected': concealment['rejected'],
+        'concealed_ms': concealment['concealed_ms'],
+        'control_ms': control,
+        'errors': probe.errors,
+    }
+
+async def run_async_session(index, args, decoder, cache):
+    await asyncio.sleep(index * args.stagger)
+    probe = SessionProbe()
+    session = AsyncSession((args.host, args.port), decoder=decoder, decode_size=args.decode_size)
+    if cache is not None:
+        session.enable_decode_cache(shared=cache)
+    session.set_concealment(args.conceal)
+    session.add_listener(probe)
+    control = {}
+    for name, request in (('connect', session.connect), ('setup', lambda: session.open(args.video)),
+                          ('play', session.play)):
+        start = time.monotonic()
+        await request()
+        control[name] = 1000 * (time.monotonic() - start)
+    start = time.monotonic()
+    while time.monotonic() - start < args.duration and probe.idle_for(start) < args.idle_timeout:
+        await asyncio.sleep(0.1)
+    result = session_result(index, probe, session, control)
+    start = time.monotonic()
+    await session.teardown()
+    control['teardown'] = 1000 * (time.monotonic() - start)
+    await session.close()
+    return result
+
+def run_blocking_session(index, args, decoder, cache):
+    time.sleep(index * args.stagger)
+    probe = SessionProbe()
+    control = {}
+    start = time.monotonic()
+    # without a shared pool, decode on the receiving thread as in async
+    # mode, rather than starting a private pool per session
+    session = Session((args.host, args.port), decode_workers=0, decoder=decoder,
+                      decode_size=args.decode_size)
+    control['connect'] = 1000 * (time.monotonic() - start)
+    if cache is not None:
+        session.enable_decode_cache(shared=cache)
+    session.set_concealment(args.conceal)
+    session.add_listener(probe)
+    for name, request in (('setup', lambda: session.open(args.video)), ('play', session.play)):
+        start = time.monotonic()
+        request()
+        control[name] = 1000 * (time.monotonic() - start)
+    start = time.monotonic()
+    while time.monotonic() - start < args.duration and probe.idle_for(start) < args.idle_timeout:
+        time.sleep(0.1)
+    result = session_result(index, probe, session, control)
+    start = time.monotonic()
+    session.teardown()
+    control['teardown'] = 1000 * (time.monotonic() - start)
+    session.close()
+    return result
+
+async def run_load(args, decoder, cache=None):
+    if args.mode == 'async':
+        return await asyncio.gather(*(run_async_session(i, args, decoder, cache)
+                                      for i in range(args.sessions)))
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        return await asyncio.gather(*(loop.run_in_executor(executor, run_blocking_session,
+                                                           i, args, decoder, cache)
+                                      for i in range(args.sessions)))
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.
+
+def aggregate(results, decoder, wall_time, cpu_time, cache=None):
+    control = {}
+    for name in ('connect', 'setup', 'play', 'teardown'):
+        samples = sorted(r['control_ms'][name] for r in results if name in r['control_ms'])
+        if samples:
+            control[name] = {'mean': mean(samples), 'max': samples[-1],
+                             'p95': samples[min(len(samples) - 1, int(0.95 * len(samples)))]}
+    frames = sum(r['frames'] for r in results)
+    summary = {
+        'sessions': len(results),
+        'frames': frames,
+        'mean_fps': mean([r['fps'] for r in results]),
+        'min_fps': min((r['fps'] for r in results), default=0.),
+        'mean_loss_fraction': mean([r['loss_fraction'] for r in results]),
+        'reordered': sum(r['reordered'] for r in results),
+        'mean_decode_ms': mean([r['decode_ms'] for r in results]),
+        'frames_rejected': sum(r['frames_rejected'] for r in results),
+        'concealed_ms': sum(r['concealed_ms'] for r in results),
+        'decode_throughput': frames / wall_time if wall_time else 0.,
+        'control_ms': control,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'errors': sum(len(r['errors']) for r in results),
+    }
+    if decoder is not None:
+        stats = decoder.stats()
+        summary['decoder'] = stats
+        summary['decode_fps_per_cpu_second'] = stats['processed'] / stats['busy_time'] \
+            if stats['busy_time'] else 0.
+    if cache is not None:
+        summary['decode_cache'] = cache.stats()
+    return summary
+
+def size(value):
+    width, _, height = value.partition('x')
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent RTSP client load generator')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--video', default='movie1.Mjpeg')
+    parser.add_argument('-n', '--sessions', type=int, default=10)
+    parser.add_argument('--mode', choices=('async', 'thread'), default='async')
+    parser.add_argument('--stagger', type=float, default=0.,
+                        help='delay between session starts, in seconds (0 = simultaneous)')
+    parser.add_argument('--duration', type=float, default=float('inf'),
+                        help='playback time per session; default is until the end of the video')
+    parser.add_argument('--idle-timeout', type=float, default=2.,
+                        help='consider the video finished after this many seconds without frames')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='size of the shared decoder pool (0 decodes on the receiving thread)')
+    parser.add_argument('--decode-size', type=size,
+                        help='decode frames scaled down to fit in WIDTHxHEIGHT')
+    parser.add_argument('--decode-cache', type=int, metavar='ENTRIES',
+                        help='share a cache of this many decoded images, keyed by payload hash')
+    parser.add_argument('--conceal', choices=Concealment.POLICIES, default=Concealment.HOLD,
+                        help='how frames with an invalid payload are hidden')
+    parser.add_argument('--json', help='write per-session and aggregate results to this file')
+    args = parser.parse_args()
+
+    decoder = decoder_pool(args.decode_workers) if args.decode_workers else None
+    cache = DecodeCache(args.decode_cache) if args.decode_cache else None
+    wall_start, cpu_start = time.monotonic(), time.process_time()
+    results = asyncio.run(run_load(args, decoder, cache))
+    summary = aggregate(results, decoder, time.monotonic() - wall_start,
+                        time.process_time() - cpu_start, cache)
+
+    for r in results:
+        control = ' '.join(f'{name}={ms:.1f}ms' for name, ms in r['control_ms'].items())
+        print(f"session {r['session']:4}: {r['frames']:5} frames {r['fps']:6.1f} fps "
+              f"loss {100 * r['loss_fraction']:5.1f}% reordered {r['reordered']:4} {control}")
+    print(f"{summary['sessions']} sessions, {summary['frames']} frames, "
+          f"mean {summary['mean_fps']:.1f} fps (min {summary['min_fps']:.1f}), "
+          f"mean loss {100 * summary['mean_loss_fraction']:.1f}%, "
+          f"{summary['decode_throughput']:.0f} frames/s decoded "
+          f"({summary['mean_decode_ms']:.2f}ms each), "
+          f"{summary['frames_rejected']} rejected ({summary['concealed_ms']}ms concealed), "
+          f"CPU {summary['cpu_time']:.1f}s over {summary['wall_time']:.1f}s")
+    for name, latency in summary['control_ms'].items():
+        print(f"  {name:8} mean {latency['mean']:.1f}ms p95 {latency['p95']:.1f}ms "
+              f"max {latency['max']:.1f}ms")
+    if cache is not None:
+        stats = summary['decode_cache']
+        print(f"  decode cache: hit rate {100 * stats['hit_rate']:.1f}% "
+              f"({stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions), "
+              f"hashing {stats['hash_ms']:.1f}ms")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'summary': summary, 'sessions': results}, out, indent=2)
+    if decoder is not None:
+        decoder.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 #! /usr/bin/python3
 
+import logging
+import time
 import tkinter as tk
-from tkinter import simpledialog, messagebox
+from tkinter import simpledialog, messagebox, filedialog
 from PIL import ImageTk, Image
 from session import Session, SessionListener
+from pipeline import BoundedQueue
+from mjpeg import FileConnection
+from recorder import Recorder
 from os.path import expanduser, join
 
 class SelectServerDialog(simpledialog.Dialog):
@@ -20,6 +25,11 @@ class SelectServerDialog(simpledialog.Dialog):
         self.ent_port.insert(tk.END, "455")
         self.ent_port.grid(row=1, column=1)
 
+        self.local = tk.BooleanVar()
+        chk = tk.Checkbutton(master, text="Play local files (server is the directory)",
+                             variable=self.local)
+        chk.grid(row=2, column=0, columnspan=2)
+
         try:
             with open(join(expanduser("~"), '.rtp.client.txt')) as saved:
                 server = saved.readline().strip()
@@ -36,7 +46,10 @@ class SelectServerDialog(simpledialog.Dialog):
     def validate(self):
         try:
             address = (self.ent_server.get(), self.ent_port.get())
-            self.result = Session(address)
+            if self.local.get():
+                self.result = Session(address, connection_class=FileConnection)
+            else:
+                self.result = Session(address)
             return True
         except Exception as exception:
             messagebox.showerror("Error", str(exception))
@@ -64,6 +77,12 @@ class VideoControlToolbar(tk.Frame):
         
         self.btn_pause = tk.Button(self, text="Pause", command=master.pause)
         self.btn_pause.pack(side=tk.LEFT)
+
+        self.btn_seek = tk.Button(self, text="Seek", command=master.seek)
+        self.btn_seek.pack(side=tk.LEFT)
+
+        self.btn_record = tk.Button(self, text="Record", command=master.record)
+        self.btn_record.pack(side=tk.LEFT)
         
         self.btn_close = tk.Button(self, text="Close", command=master.close_file)
         self.btn_close.pack(side=tk.LEFT)
@@ -72,20 +91,36 @@ class VideoControlToolbar(tk.Frame):
         self.btn_disconnect.pack(side=tk.LEFT)
 
 class MainWindow(tk.Tk, SessionListener):
+    RENDER_INTERVAL = 10
+    STATUS_INTERVAL = 1000
+
     def __init__(self):
         super().__init__()
         self.session = None
+        self.recorder = None
+        self.latency = None
+        self.image_size = None
+        self.mailbox = BoundedQueue(1)
+        self.photo = None
+        self.rendered = 0
+        self.render_time = 0.
         self.title("RTSP Client")
 
         self.toolbar = VideoControlToolbar(self)
 
         self.lbl_image = tk.Label(self)
         self.lbl_image.pack(fill=tk.BOTH, expand=True)
+        self.lbl_image.bind('<Configure>', self.image_resized)
         
         self.lbl_video_name = tk.Label(self)
         self.video_name_changed(None)
         self.lbl_video_name.pack()
+
+        self.lbl_status = tk.Label(self)
+        self.lbl_status.pack()
         
+        self.after(self.RENDER_INTERVAL, self.render)
+        self.after(self.STATUS_INTERVAL, self.update_status)
         self.connect()
 
     def open_file(self):
@@ -99,6 +134,31 @@ class MainWindow(tk.Tk, SessionListener):
     def pause(self):
         return self.session.pause()
     
+    def seek(self):
+        position = simpledialog.askfloat("Seek", "Position (seconds)", parent=self, minvalue=0)
+        if position is not None:
+            self.session.seek(position)
+
+    def record(self):
+        if self.recorder is not None:
+            self.stop_recording()
+            return
+        path = filedialog.asksaveasfilename(parent=self, defaultextension='.Mjpeg',
+                                            filetypes=[('Motion JPEG', '*.Mjpeg')])
+        if path:
+            self.recorder = Recorder(path)
+            self.session.add_listener(self.recorder)
+            self.toolbar.btn_record['text'] = "Stop recording"
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        if self.recorder in self.session.listeners:
+            self.session.remove_listener(self.recorder)
+        self.recorder.close()
+        self.recorder = None
+        self.toolbar.btn_record['text'] = "Record"
+
     def close_file(self):
         return self.session.teardown()
     
@@ -106,23 +166,122 @@ class MainWindow(tk.Tk, SessionListener):
         messagebox.showerror("Error", str(exception))
 
     def frame_received(self, frame):
-        self.lbl_image['image'] = self.image = frame.get_image() if frame else None
+        # called from the decoder threads; Tk is only touched in render
+        self.mailbox.put((frame,))
+
+    def render(self):
+        '''Render stage: runs on the Tk main loop and shows the frame in the
+        mailbox, if any. A frame replaced in the mailbox by a newer one
+        before being shown is dropped, so the display never falls behind.
+        Errors are reported to the session and do not stop the render loop.
+        '''
+        try:
+            item = self.mailbox.get(0)
+            if item is not None:
+                frame, = item
+                start = time.perf_counter()
+                self.show(frame)
+                self.render_time += time.perf_counter() - start
+                if frame and self.image_size is None:
+                    # from now on the window keeps its size when the image gets
+                    # smaller, so the label size is the space available for video
+                    self.geometry(self.geometry())
+                    self.image_size = (self.lbl_image.winfo_width(), self.lbl_image.winfo_height())
+        except Exception as exception:
+            self.session.handle_exception(exception)
+        finally:
+            self.after(self.RENDER_INTERVAL, self.render)
+
+    def show(self, frame):
+        '''Displays a frame, pasting it into the current PhotoImage when it
+        has the same size instead of creating a new one.
+        '''
+        if frame is None:
+            self.photo = None
+            self.lbl_image['image'] = ''
+            return
+        image = self.session.image_to_show(frame)
+        if image is None:
+            return
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == image.size:
+            self.photo.paste(image)
+        else:
+            self.photo = ImageTk.PhotoImage(image)
+            self.lbl_image['image'] = self.photo
+        self.rendered += 1
+        self.session.frame_rendered(frame)
+
+    def render_stats(self):
+        return {
+            'rendered': self.rendered,
+            'dropped': self.mailbox.dropped,
+            'mean_render_ms': 1000 * self.render_time / self.rendered if self.rendered else 0.,
+        }
+
+    def update_status(self):
+        stats = self.render_stats()
+        status = (f"Rendered {stats['rendered']}, dropped {stats['dropped']}, "
+                  f"{stats['mean_render_ms']:.1f} ms per frame")
+        if self.recorder is not None:
+            recording = self.recorder.stats()
+            status += (f" | recorded {recording['frames_written']} frames, "
+                       f"{recording['bytes_written'] / 1e6:.1f} MB, queue {recording['depth']}")
+        if self.session is not None and self.session.frame_cache is not None:
+            cache = self.session.frame_cache.stats()
+            status += (f" | cache {cache['frames']} frames, {cache['bytes'] / 1e6:.0f} MB, "
+                       f"hit rate {100 * cache['hit_rate']:.0f}%")
+        if self.session is not None and self.session.decode_cache is not None:
+            cache = self.session.decode_cache.stats()
+            status += f" | decode cache hit rate {100 * cache['hit_rate']:.0f}%"
+        if self.session is not None:
+            concealment = self.session.concealment.stats()
+            if concealment['rejected']:
+                status += (f" | {concealment['rejected']} bad frames, "
+                           f"{concealment['concealed_ms'] / 1000:.1f} s concealed")
+        if self.latency is not None:
+            total = self.latency['rendered_total']
+            status += f" | latency p50 {total['p50_ms']:.0f} ms, p95 {total['p95_ms']:.0f} ms"
+        self.lbl_status['text'] = status
+        self.after(self.STATUS_INTERVAL, self.update_status)
+
+    def image_resized(self, event):
+        '''Decodes frames at the size of the label once the window size is
+        fixed, so a small window does not pay for full-resolution decoding.
+        '''
+        if self.image_size is not None:
+            self.image_size = (event.width, event.height)
+            self.session.set_decode_size(self.image_size)
+
+    def latency_report(self, report):
+        # called from the decoder threads; shown by update_status
+        self.latency = report
 
     def video_name_changed(self, name):
         self.lbl_video_name['text'] = f'Video: {name}' if name else 'No video open'
 
     def connect(self):
+        self.stop_recording()
         if self.session: self.session.close()
         self.session = SelectServerDialog(self).result
         if self.session is None:
             self.destroy()
         else:
             self.session.add_listener(self)
+            self.session.set_decode_size(self.image_size)
+            self.session.enable_latency(interval=1.)
+            self.session.enable_frame_cache()
+            self.session.enable_decode_cache()
                 
     def destroy(self):
+        self.stop_recording()
         if self.session: self.session.close()
         super().destroy()
 
-window = MainWindow()
-window.mainloop()
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    window = MainWindow()
+    window.mainloop()
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,228 @@
+import array
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from rtsp import Connection, ControlLatency
+from stats import StreamStatistics
+
+log = logging.getLogger(__name__)
+
+class MjpegFile:
+    '''Random access reader for .Mjpeg files, where every JPEG frame is
+    preceded by its length as 5 ASCII digits.
+
+    The file is memory-mapped and the offset of every frame is found in a
+    single pass. The resulting index is cached next to the file (with an
+    .idx suffix) and reused as long as the file size and modification
+    time match. Frames are returned as memoryviews into the mapping,
+    without copying.
+    '''
+    LENGTH_DIGITS = 5
+    FRAME_PERIOD = 40 # ms per frame at the nominal 25 fps
+    INDEX_HEADER = struct.Struct('<4sQQQ')
+    INDEX_MAGIC = b'MJIX'
+
+    def __init__(self, path, frame_period=FRAME_PERIOD, use_cache=True):
+        self.path = path
+        self.frame_period = frame_period
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.offsets = array.array('Q')
+        self.lengths = array.array('I')
+        if not (use_cache and self.load_index()):
+            self.build_index()
+            if use_cache:
+                self.save_index()
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    def build_index(self):
+        '''Scans the file once, recording the offset and length of each frame.
+        A truncated last frame is ignored.
+        '''
+        pos = 0
+        digits = self.LENGTH_DIGITS
+        while pos + digits <= self.size:
+            length = int(self.map[pos:pos + digits])
+            if pos + digits + length > self.size:
+                break
+            self.offsets.append(pos + digits)
+            self.lengths.append(length)
+            pos += digits + length
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'rb') as cache:
+                magic, size, mtime, count = self.INDEX_HEADER.unpack(
+                    cache.read(self.INDEX_HEADER.size))
+                if magic != self.INDEX_MAGIC or size != self.size or mtime != self.mtime:
+                    return False
+                self.offsets.fromfile(cache, count)
+                self.lengths.fromfile(cache, count)
+            return True
+        except (OSError, EOFError, struct.error):
+            self.offsets = array.array('Q')
+            self.lengths = array.array('I')
+            return False
+
+    def save_index(self):
+        try:
+            with open(self.index_path, 'wb') as cache:
+                cache.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, self.size, self.mtime,
+                                                   len(self.offsets)))
+                self.offsets.tofile(cache)
+                self.lengths.tofile(cache)
+        except OSError:
+            pass # read-only location: the index is simply rebuilt next time
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def duration(self):
+        '''Length of the video in milliseconds.'''
+        return len(self) * self.frame_period
+
+    def frame(self, number):
+        '''Returns frame number (starting at 0) as a memoryview.'''
+        offset = self.offsets[number]
+        return memoryview(self.map)[offset:offset + self.lengths[number]]
+
+    def frame_number_at(self, timestamp):
+        '''Returns the number of the frame shown at timestamp milliseconds.'''
+        return max(0, min(len(self) - 1, int(timestamp // self.frame_period)))
+
+    def frame_at(self, timestamp):
+        return self.frame(self.frame_number_at(timestamp))
+
+    def timestamp(self, number):
+        return number * self.frame_period
+
+    def close(self):
+        try:
+            if self.map:
+                self.map.close()
+        except BufferError:
+            pass # frames still referenced; the mapping is released with them
+        self.file.close()
+
+class FileConnection:
+    '''Plays .Mjpeg files from a local directory with the same interface as
+    rtsp.Connection, so a Session can use it in place of a server. Frames
+    are handed to session.process_frame at the nominal frame rate, and
+    seek() moves playback to any position.
+    '''
+    INIT = Connection.INIT
+    READY = Connection.READY
+    PLAYING = Connection.PLAYING
+    PAYLOAD_TYPE = 26
+
+    def __init__(self, session, address):
+        '''Creates a connection serving files from the directory address[0]
+        (the current directory if empty); address[1] is ignored.
+        '''
+        self.session = session
+        self.directory = address[0] or '.'
+        self.state = self.INIT
+        self.video = None
+        self.position = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.statistics = StreamStatistics()
+        self.latency = ControlLatency()
+
+    def setup(self, filename):
+        if self.state != self.INIT:
+            log.warning("incorrect state")
+            return
+        self.video = MjpegFile(os.path.join(self.directory, filename))
+        self.position = 0
+        self.statistics.reset()
+        self.state = self.READY
+
+    def setup_and_play(self, filename):
+        self.setup(filename)
+        self.play()
+
+    def play(self):
+        if self.state != self.READY:
+            log.warning("incorrect state")
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.play_frames, daemon=True)
+        self.state = self.PLAYING
+        self.thread.start()
+
+    def pause(self):
+        if self.state != self.PLAYING:
+            log.warning("incorrect state")
+            return
+        self.stop()
+        self.state = self.READY
+
+    def seek(self, timestamp):
+        '''Moves playback to the frame shown at timestamp milliseconds.'''
+        if self.video is None:
+            return False
+        with self.lock:
+            self.position = self.video.frame_number_at(timestamp)
+        return True
+
+    def teardown(self):
+        if self.state == self.INIT:
+            log.warning("incorrect state")
+            return
+        self.stop()
+        self.video.close()
+        self.video = None
+        self.state = self.INIT
+
+    def close(self):
+        if self.state != self.INIT:
+            self.teardown()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def play_frames(self):
+        '''Hands frames to the session on the video timeline, re-anchoring
+        the clock whenever the position is changed by a seek.
+        '''
+        period = self.video.frame_period / 1000.
+        anchor = None
+        expected = None
+        while not self.stop_event.is_set():
+            with self.lock:
+                number = self.position
+                if number >= len(self.video):
+                    break
+                self.position = number + 1
+            if number != expected:
+                anchor = time.monotonic() - number * period
+            expected = number + 1
+            delay = anchor + number * period - time.monotonic()
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            payload = self.video.frame(number)
+            timestamp = self.video.timestamp(number)
+            now = time.monotonic()
+            self.statistics.packet_received(number & 0xffff, timestamp, len(payload), now)
+            self.statistics.frame_completed(now)
+            self.session.process_frame(self.PAYLOAD_TYPE, 1, number & 0xffff, timestamp,
+                                       payload, None, now, now)
+
+    def pipeline_stats(self):
+        return {'frames': len(self.video) if self.video else 0, 'position': self.position}
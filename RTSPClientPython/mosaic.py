@@ -0,0 +1,205 @@
+#! /usr/bin/python3
+
+'''Grid viewer showing several streams in one window:
+
+    python mosaic.py HOST PORT --tiles 9 [--video NAME ...] [--tile-size WxH]
+
+Each tile has its own Session, but all of them share a single pool of
+decoding threads, and each tile decodes at its own (reduced) size. One
+render tick on the Tk loop shows the frames that arrived since the last
+tick, only touching tiles that have a new one. The status line reports
+the frame rate of every tile and the CPU use of the whole process, to
+find how many tiles a core can sustain; with --duration the viewer
+closes after that many seconds and prints the same figures.
+'''
+
+import argparse
+import os
+import time
+import tkinter as tk
+from PIL import ImageTk
+
+from rtsp import Connection
+from session import Session, SessionListener, decoder_pool
+from pipeline import BoundedQueue
+from mjpeg import FileConnection
+
+class Tile(SessionListener):
+    '''One stream of the mosaic: its session, the label showing it and a
+    one-frame mailbox between the decoder pool and the render tick.
+    '''
+    def __init__(self, master, number, session, video):
+        self.number = number
+        self.session = session
+        self.video = video
+        self.mailbox = BoundedQueue(1)
+        self.photo = None
+        self.error = None
+        self.rendered = 0
+        self.last_rendered = 0
+        self.frame_rate = 0.
+        self.frame = tk.Frame(master, borderwidth=1, relief=tk.SUNKEN)
+        self.label = tk.Label(self.frame)
+        self.label.pack()
+        self.caption = tk.Label(self.frame)
+        self.caption.pack()
+        session.add_listener(self)
+
+    def frame_received(self, frame):
+        # called from the decoder pool; Tk is only touched in render
+        if frame is not None:
+            self.mailbox.put(frame)
+
+    def exception_thrown(self, exception):
+        self.error = str(exception)
+
+    def render(self):
+        '''Shows the frame in the mailbox, if any. Returns True if the tile
+        was updated.
+        '''
+        frame = self.mailbox.get(0)
+        if frame is None:
+            return False
+        image = self.session.image_to_show(frame)
+        if image is None:
+            return False
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == image.size:
+            self.photo.paste(image)
+        else:
+            self.photo = ImageTk.PhotoImage(image)
+            self.label['image'] = self.photo
+        self.rendered += 1
+        return True
+
+    def update_rate(self, elapsed):
+        self.frame_rate = (self.rendered - self.last_rendered) / elapsed
+        self.last_rendered = self.rendered
+        self.caption['text'] = self.error or f'{self.number}: {self.video} {self.frame_rate:.1f} fps'
+
+class MosaicWindow(tk.Tk):
+    RENDER_INTERVAL = 10
+    STATUS_INTERVAL = 1000
+
+    def __init__(self, address, videos, tiles, columns=None, tile_size=(320, 240),
+                 decode_workers=2, connection_class=Connection):
+        '''Opens tiles sessions to address, playing the videos in turn,
+        laid out in columns columns (by default, as square a grid as
+        possible). Frames are decoded to fit in tile_size by
+        decode_workers threads shared by all tiles.
+        '''
+        super().__init__()
+        self.title(f'RTSP Mosaic ({tiles} streams)')
+        columns = columns or max(1, round(tiles ** 0.5))
+        self.decoder = decoder_pool(decode_workers, 2 * tiles)
+        self.tiles = []
+        self.tick_time = 0.
+        self.ticks = 0
+        self.tiles_updated = 0
+        self.last_status = time.monotonic()
+        self.last_cpu = time.process_time()
+        self.cpu_load = 0.
+        grid = tk.Frame(self)
+        grid.pack()
+        for number in range(tiles):
+            session = Session(address, connection_class=connection_class,
+                              decoder=self.decoder, decode_size=tile_size)
+            tile = Tile(grid, number, session, videos[number % len(videos)])
+            tile.frame.grid(row=number // columns, column=number % columns)
+            self.tiles.append(tile)
+            session.open(tile.video, play=True)
+        self.lbl_status = tk.Label(self)
+        self.lbl_status.pack()
+        self.after(self.RENDER_INTERVAL, self.render)
+        self.after(self.STATUS_INTERVAL, self.update_status)
+
+    def render(self):
+        '''Render tick: updates the tiles that received a frame since the
+        previous tick. An error in one tile is reported to its session and
+        neither stops the other tiles nor the render loop.
+        '''
+        try:
+            start = time.perf_counter()
+            for tile in self.tiles:
+                try:
+                    self.tiles_updated += tile.render()
+                except Exception as exception:
+                    tile.session.handle_exception(exception)
+            self.tick_time += time.perf_counter() - start
+            self.ticks += 1
+        finally:
+            self.after(self.RENDER_INTERVAL, self.render)
+
+    def stats(self):
+        rates = [tile.frame_rate for tile in self.tiles]
+        return {
+            'tiles': len(self.tiles),
+            'frame_rates': rates,
+            'mean_fps': sum(rates) / len(rates) if rates else 0.,
+            'min_fps': min(rates, default=0.),
+            'cpu_load': self.cpu_load,
+            'cpus': os.cpu_count(),
+            'mean_tick_ms': 1000 * self.tick_time / self.ticks if self.ticks else 0.,
+            'tiles_updated': self.tiles_updated,
+            'decoder': self.decoder.stats(),
+        }
+
+    def update_status(self):
+        '''Updates the frame rate of each tile and the CPU use of the
+        process (1.0 is one core fully busy) over the last interval.
+        '''
+        now, cpu = time.monotonic(), time.process_time()
+        elapsed = now - self.last_status
+        self.cpu_load = (cpu - self.last_cpu) / elapsed
+        self.last_status, self.last_cpu = now, cpu
+        for tile in self.tiles:
+            tile.update_rate(elapsed)
+        stats = self.stats()
+        self.lbl_status['text'] = (
+            f"{stats['tiles']} tiles, {stats['mean_fps']:.1f} fps per tile "
+            f"(min {stats['min_fps']:.1f}), CPU {100 * stats['cpu_load']:.0f}% "
+            f"of {stats['cpus']} cores, render {stats['mean_tick_ms']:.2f} ms per tick, "
+            f"decoder queue dropped {stats['decoder']['dropped']}")
+        self.after(self.STATUS_INTERVAL, self.update_status)
+
+    def destroy(self):
+        for tile in self.tiles:
+            tile.session.teardown()
+            tile.session.close()
+        self.decoder.close(join=False)
+        super().destroy()
+
+def main():
+    parser = argparse.ArgumentParser(description='Show several RTSP streams in a grid')
+    parser.add_argument('host', help='server address, or directory with --local')
+    parser.add_argument('port', type=int, nargs='?', default=0)
+    parser.add_argument('--video', action='append',
+                        help='video to play (may be repeated; tiles cycle through them)')
+    parser.add_argument('--tiles', type=int, default=4)
+    parser.add_argument('--columns', type=int)
+    parser.add_argument('--tile-size', default='320x240',
+                        help='largest decoded size of each tile, as WxH')
+    parser.add_argument('--decode-workers', type=int, default=2)
+    parser.add_argument('--local', action='store_true', help='play files from a directory')
+    parser.add_argument('--duration', type=float,
+                        help='close after this many seconds and print the statistics')
+    args = parser.parse_args()
+    tile_size = tuple(int(v) for v in args.tile_size.lower().split('x'))
+    window = MosaicWindow((args.host, args.port), args.video or ['movie1.Mjpeg'], args.tiles,
+                          args.columns, tile_size, args.decode_workers,
+                          FileConnection if args.local else Connection)
+    result = None
+    if args.duration is not None:
+        def finish():
+            nonlocal result
+            result = window.stats()
+            window.destroy()
+        window.after(int(args.duration * 1000), finish)
+    window.mainloop()
+    if result is not None:
+        print(f"{result['tiles']} tiles: {result['mean_fps']:.1f} fps per tile "
+              f"(min {result['min_fps']:.1f}), CPU {100 * result['cpu_load']:.0f}%, "
+              f"{100 * result['cpu_load'] / result['tiles']:.1f}% per tile, "
+              f"render {result['mean_tick_ms']:.2f} ms per tick")
+
+if __name__ == '__main__':
+    main()
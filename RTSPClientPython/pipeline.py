@@ -0,0 +1,157 @@
+import collections
+import threading
+import time
+
+class QueueClosed(Exception):
+    pass
+
+def release_item(item):
+    '''Default on_drop callback: releases items holding a pooled buffer.'''
+    release = getattr(item, 'release', None)
+    if release is not None:
+        release()
+
+class BoundedQueue:
+    '''Thread-safe FIFO queue with a fixed capacity, used to connect the
+    stages of the receive pipeline. What happens when the queue is full
+    depends on the policy:
+    - BLOCK: put() waits for room (back-pressure on the producer);
+    - DROP_OLDEST: the oldest queued item is discarded, so the producer
+      never waits and consumers always see the most recent data.
+    Items discarded by DROP_OLDEST or by clear() are passed to on_drop,
+    which by default releases them if they have a release method.
+    '''
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+
+    def __init__(self, capacity, policy=DROP_OLDEST, on_drop=release_item):
+        if capacity < 1:
+            raise ValueError('Queue capacity must be at least 1')
+        if policy not in (self.BLOCK, self.DROP_OLDEST):
+            raise ValueError(f'Unknown queue policy: {policy}')
+        self.capacity = capacity
+        self.policy = policy
+        self.on_drop = on_drop
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item, timeout=None):
+        '''Adds an item to the queue. Returns False if the item could not be
+        queued (blocking put timed out, or queue closed).
+        '''
+        evicted = None
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.items) >= self.capacity:
+                if self.policy == self.DROP_OLDEST:
+                    evicted = self.items.popleft()
+                    self.dropped += 1
+                elif not self.not_full.wait_for(
+                        lambda: self.closed or len(self.items) < self.capacity, timeout):
+                    self.dropped += 1
+                    return False
+                elif self.closed:
+                    return False
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.not_empty.notify()
+        # outside the lock, as releasing may take the lock of a buffer pool
+        if evicted is not None and self.on_drop:
+            self.on_drop(evicted)
+        return True
+
+    def get(self, timeout=None):
+        '''Removes and returns the oldest item. Returns None if no item
+        arrives within timeout seconds; raises QueueClosed once the queue is
+        closed and empty.
+        '''
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.closed or self.items, timeout):
+                return None
+            if not self.items:
+                raise QueueClosed()
+            item = self.items.popleft()
+            self.not_full.notify()
+            return item
+
+    def clear(self):
+        '''Discards the queued items, passing them to on_drop.'''
+        with self.lock:
+            items = list(self.items)
+            self.items.clear()
+            self.not_full.notify_all()
+        if self.on_drop:
+            for item in items:
+                self.on_drop(item)
+
+    def close(self):
+        '''Wakes up all waiting producers and consumers. Items already queued
+        can still be retrieved.
+        '''
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {'depth': len(self.items), 'capacity': self.capacity,
+                'high_water': self.high_water, 'dropped': self.dropped}
+
+class WorkerPool:
+    '''Small pool of threads applying a function to items submitted through
+    a bounded queue. Exceptions raised by the function are passed to
+    on_error, if given, and never stop the workers. Items dropped from
+    the queue are passed to on_drop.
+    '''
+    def __init__(self, function, workers=2, capacity=4, policy=BoundedQueue.DROP_OLDEST,
+                 on_error=None, name='worker', on_drop=release_item):
+        self.function = function
+        self.on_error = on_error
+        self.queue = BoundedQueue(capacity, policy, on_drop)
+        self.processed = 0
+        self.busy_time = 0.
+        self.threads = [threading.Thread(target=self.run, name=f'{name}-{i}', daemon=True)
+                        for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, item):
+        return self.queue.put(item)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except QueueClosed:
+                return
+            start = time.perf_counter()
+            try:
+                self.function(item)
+            except Exception as exception:
+                if self.on_error:
+                    self.on_error(exception)
+            self.busy_time += time.perf_counter() - start
+            self.processed += 1
+
+    def close(self, join=True):
+        '''Stops the workers once the queued items have been processed.'''
+        self.queue.close()
+        if join:
+            for t in self.threads:
+                if t is not threading.current_thread():
+                    t.join()
+
+    def stats(self):
+        stats = self.queue.stats()
+        stats.update(workers=len(self.threads), processed=self.processed,
+                     busy_time=self.busy_time)
+        return stats
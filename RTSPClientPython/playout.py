@@ -0,0 +1,338 @@
+import collections
+import heapq
+import threading
+import time
+
+class SequenceExtender:
+    '''Converts 16-bit RTP sequence numbers into extended sequence numbers
+    that keep increasing across wraparound, so that ordering and
+    comparisons keep working on long streams.
+    '''
+    SEQ_MOD = 1 << 16
+
+    def __init__(self):
+        self.cycles = 0
+        self.max_seq = None
+
+    def extend(self, seq):
+        '''Returns the extended sequence number corresponding to the 16-bit
+        sequence number seq. Packets far behind the highest sequence number
+        seen so far are assumed to belong to the previous cycle.
+        '''
+        if self.max_seq is None:
+            self.max_seq = seq
+            return seq
+        delta = (seq - self.max_seq) % self.SEQ_MOD
+        if delta < self.SEQ_MOD // 2:
+            if seq < self.max_seq:
+                self.cycles += self.SEQ_MOD
+            self.max_seq = seq
+            return self.cycles + seq
+        if seq > self.max_seq:
+            return self.cycles - self.SEQ_MOD + seq
+        return self.cycles + seq
+
+    def reset(self):
+        self.cycles = 0
+        self.max_seq = None
+
+class DriftEstimator:
+    '''Estimates the rate of the sender's media clock relative to the local
+    monotonic clock, as the least-squares slope of the RTP timestamps
+    (in seconds) of the frames received during the last window seconds
+    against their arrival times. A rate of 1 means the sender follows the
+    nominal timeline; 2 means it sends twice as fast. drift is the total
+    media time gained (or lost, if negative) over local time since the
+    first frame.
+    '''
+    MIN_SPAN = 0.5
+
+    def __init__(self, clock_rate=1000, window=2.):
+        self.clock_rate = clock_rate
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.samples = collections.deque()
+        self.first = None
+        self.last = None
+
+    def add(self, arrival, timestamp):
+        media = timestamp / self.clock_rate
+        if self.first is None:
+            self.first = (arrival, media)
+        self.last = (arrival, media)
+        self.samples.append(self.last)
+        while arrival - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    @property
+    def rate(self):
+        # a copy taken in one step, as add may run on another thread
+        samples = list(self.samples)
+        if not samples or samples[-1][0] - samples[0][0] < self.MIN_SPAN:
+            return 1.
+        n = len(samples)
+        mean_x = sum(x for x, _ in samples) / n
+        mean_y = sum(y for _, y in samples) / n
+        sxx = sum((x - mean_x) ** 2 for x, _ in samples)
+        sxy = sum((x - mean_x) * (y - mean_y) for x, y in samples)
+        return sxy / sxx if sxx else 1.
+
+    @property
+    def drift(self):
+        if self.first is None:
+            return 0.
+        return (self.last[1] - self.first[1]) - (self.last[0] - self.first[0])
+
+class JitterBuffer:
+    '''Playout buffer that holds received frames ordered by extended
+    sequence number and releases them on the RTP timestamp clock.
+
+    The playout time of a frame is its timestamp mapped to local time,
+    plus a target delay. The target delay adapts to the interarrival
+    jitter measured as in RFC 3550, bounded by min_delay and max_delay.
+    Frames arriving after a later frame has already been released, as
+    well as duplicates, are dropped instead of being played out of order.
+
+    The mapping from timestamps to local time follows the fastest transit
+    seen, unless the sender's clock runs faster than nominal by more than
+    drift_tolerance: then frames are paced to real time, and the buffer
+    catches up once the newest frame is due more than catchup_delay
+    after the target delay, by playing catchup_speed times faster. If the
+    newest frame is due more than max_latency from now, older frames are
+    dropped so that it plays after the target delay.
+
+    The public methods hold a lock, so that stats() can be read from other
+    threads while frames are pushed and released.
+    '''
+    def __init__(self, clock_rate=1000, target_delay=0.05, min_delay=0.02,
+                 max_delay=0.5, jitter_factor=3.0, capacity=64, adaptive=True,
+                 max_latency=1., catchup_delay=0.2, catchup_speed=1.25, drift_tolerance=0.05):
+        '''Creates a new buffer.
+	- clock_rate: RTP timestamp units per second (the server uses ms).
+	- target_delay: initial playout delay, in seconds.
+	- min_delay, max_delay: bounds for the adaptive playout delay.
+	- jitter_factor: the target delay follows this multiple of the
+	  measured jitter.
+	- capacity: maximum number of frames held; when full, the oldest frame
+	  is dropped to make room.
+	- adaptive: if False, target_delay is kept fixed.
+	- max_latency: the longest a frame may wait in the buffer, in seconds.
+	- catchup_delay: excess delay, in seconds, at which playback speeds up.
+	- catchup_speed: playback speed while catching up.
+	- drift_tolerance: relative sender clock error below which frames are
+	  not paced.
+        '''
+        self.clock_rate = clock_rate
+        self.initial_delay = target_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter_factor = jitter_factor
+        self.capacity = capacity
+        self.adaptive = adaptive
+        self.max_latency = max_latency
+        self.catchup_delay = catchup_delay
+        self.catchup_speed = catchup_speed
+        self.drift_tolerance = drift_tolerance
+        self.sequence = SequenceExtender()
+        self.drift = DriftEstimator(clock_rate)
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        '''Discards all buffered frames, timing state and counters.'''
+        with self.lock:
+            while getattr(self, 'heap', None):
+                self.drop()
+            self.heap = []
+            self.pending = set()
+            self.sequence.reset()
+            self.last_released = None
+            self.target_delay = self.initial_delay
+            self.jitter = 0.
+            self.last_transit = None
+            self.offset = None
+            self.newest = None
+            self.catching_up = False
+            self.last_check = None
+            self.drift.reset()
+            self.late_drops = 0
+            self.duplicate_drops = 0
+            self.overflow_drops = 0
+            self.released = 0
+            self.catchup_events = 0
+            self.catchup_time = 0.
+            self.skip_events = 0
+            self.skip_drops = 0
+
+    def resync(self, now=None):
+        '''Re-anchors the playout clock so that the oldest buffered frame (or
+        else the next frame received) is played after the target delay,
+        keeping buffered frames and sequence state. Used when playback
+        resumes after a pause.
+        '''
+        with self.lock:
+            if now is None:
+                now = time.monotonic()
+            self.last_transit = None
+            self.offset = None
+            self.catching_up = False
+            self.last_check = None
+            self.drift.reset()
+            if self.heap:
+                self.offset = now - min(ts for _, ts, _ in self.heap) / self.clock_rate
+
+    @property
+    def depth(self):
+        '''Number of frames currently buffered.'''
+        return len(self.heap)
+
+    def push(self, seq, timestamp, item, arrival=None):
+        '''Adds a frame to the buffer. Returns False if the frame was dropped
+        because it is late or a duplicate.
+        '''
+        with self.lock:
+            if arrival is None:
+                arrival = time.monotonic()
+            ext = self.sequence.extend(seq)
+            if self.last_released is not None and ext <= self.last_released:
+                self.late_drops += 1
+                return False
+            if ext in self.pending:
+                self.duplicate_drops += 1
+                return False
+
+            transit = arrival - timestamp / self.clock_rate
+            if self.last_transit is not None:
+                d = abs(transit - self.last_transit)
+                self.jitter += (d - self.jitter) / 16.
+                if self.adaptive:
+                    self.target_delay = min(self.max_delay,
+                                            max(self.min_delay, self.jitter_factor * self.jitter))
+            self.last_transit = transit
+            self.drift.add(arrival, timestamp)
+            # anchor on the fastest transit seen, so early frames never wait less
+            # than the target delay, unless the sender runs fast
+            if self.offset is None or (transit < self.offset and
+                                       self.drift.rate - 1 <= self.drift_tolerance):
+                self.offset = transit
+            if self.newest is None or timestamp > self.newest:
+                self.newest = timestamp
+
+            heapq.heappush(self.heap, (ext, timestamp, item))
+            self.pending.add(ext)
+            if len(self.heap) > self.capacity:
+                self.overflow_drops += 1
+                self.drop()
+            return True
+
+    def playout_time(self, timestamp):
+        '''Local monotonic time at which a frame with the given timestamp is due.'''
+        return self.offset + timestamp / self.clock_rate + self.target_delay
+
+    def next_deadline(self, now=None):
+        '''Seconds until the next frame is due, or None if the buffer is empty.'''
+        with self.lock:
+            if not self.heap:
+                return None
+            if now is None:
+                now = time.monotonic()
+            delay = max(0., self.playout_time(self.heap[0][1]) - now)
+            # the clock advances catchup_speed times faster while catching up
+            return delay / self.catchup_speed if self.catching_up else delay
+
+    def release(self):
+        '''Removes and returns the oldest buffered item, regardless of its
+        playout time.
+        '''
+        with self.lock:
+            item = self._pop()
+            self.released += 1
+            return item
+
+    def drop(self):
+        '''Removes the oldest buffered item without playing it, releasing
+        it if it has a release method.
+        '''
+        item = self._pop()
+        release = getattr(item, 'release', None)
+        if release is not None:
+            release()
+
+    def _pop(self):
+        ext, _, item = heapq.heappop(self.heap)
+        self.pending.discard(ext)
+        self.last_released = ext
+        return item
+
+    def pop_ready(self, now=None):
+        '''Removes and returns, in sequence order, all items whose playout
+        time has been reached.
+        '''
+        with self.lock:
+            if now is None:
+                now = time.monotonic()
+            self.catch_up(now)
+            ready = []
+            while self.heap and self.playout_time(self.heap[0][1]) <= now:
+                ready.append(self.release())
+            return ready
+
+    def buffered_delay(self, now=None):
+        '''Seconds until the newest buffered frame is due.'''
+        with self.lock:
+            if not self.heap:
+                return 0.
+            if now is None:
+                now = time.monotonic()
+            return max(0., self.playout_time(self.newest) - now)
+
+    def catch_up(self, now):
+        '''Brings the delay of the newest frame back towards the target
+        delay when it grows, by speeding up the playout clock or, beyond
+        max_latency, by dropping the oldest frames.
+        '''
+        elapsed = now - self.last_check if self.last_check is not None else 0.
+        self.last_check = now
+        if self.catching_up:
+            self.offset -= elapsed * (self.catchup_speed - 1)
+            self.catchup_time += elapsed
+        if not self.heap:
+            self.catching_up = False
+            return
+        delay = self.playout_time(self.newest) - now
+        if delay > self.max_latency:
+            self.skip_events += 1
+            self.offset = now - self.newest / self.clock_rate
+            oldest = self.newest - self.target_delay * self.clock_rate
+            while self.heap and self.heap[0][1] < oldest:
+                self.drop()
+                self.skip_drops += 1
+            self.catching_up = False
+        elif delay > self.target_delay + self.catchup_delay:
+            if not self.catching_up:
+                self.catchup_events += 1
+                self.catching_up = True
+        elif delay <= self.target_delay + self.catchup_delay / 2:
+            self.catching_up = False
+
+    def stats(self):
+        '''Returns a dictionary with the current buffer depth, delay and drop counters.'''
+        with self.lock:
+            return {
+                'depth': self.depth,
+                'target_delay': self.target_delay,
+                'jitter': self.jitter,
+                'released': self.released,
+                'late_drops': self.late_drops,
+                'duplicate_drops': self.duplicate_drops,
+                'overflow_drops': self.overflow_drops,
+                'sender_rate': self.drift.rate,
+                'drift_ms': 1000 * self.drift.drift,
+                'buffered_delay': self.buffered_delay(),
+                'catchup_events': self.catchup_events,
+                'catchup_time': self.catchup_time,
+                'skip_events': self.skip_events,
+                'skip_drops': self.skip_drops,
+            }
@@ -0,0 +1,263 @@
+import collections
+import contextlib
+import io
+import math
+import sys
+import threading
+import time
+
+class LatencyHistogram:
+    '''Fixed-memory histogram of durations. Buckets grow geometrically by
+    2**(1/RESOLUTION) from MINIMUM seconds, so percentiles are accurate to
+    about 20% whatever the number of samples.
+    '''
+    MINIMUM = 1e-5
+    RESOLUTION = 4
+    BUCKETS = 96
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        if seconds <= self.MINIMUM:
+            bucket = 0
+        else:
+            bucket = min(self.BUCKETS - 1,
+                         int(math.log2(seconds / self.MINIMUM) * self.RESOLUTION) + 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p-th percentile, in seconds.'''
+        if not self.count:
+            return 0.
+        rank = p / 100. * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.max, self.MINIMUM * 2 ** (bucket / self.RESOLUTION))
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0.,
+            'p50_ms': 1000 * self.percentile(50),
+            'p95_ms': 1000 * self.percentile(95),
+            'p99_ms': 1000 * self.percentile(99),
+            'max_ms': 1000 * self.max,
+        }
+
+class FrameLatency:
+    '''Per-stage latency of the frames of one session. Each frame carries the
+    times at which it was
+    - received: its first packet arrived;
+    - depacketized: its last packet arrived;
+    - released: the jitter buffer handed it to the session;
+    - decoded: its image was decoded (or it was delivered undecoded);
+    - rendered: a renderer reported it as shown, through
+      Session.frame_rendered.
+    The time between consecutive steps is recorded in one histogram per
+    stage, and the time from reception to decoding and to rendering in two
+    more. Every interval seconds a report with the statistics of all
+    histograms is built, passed to the report function and, if output is
+    a file, written to it.
+    '''
+    STAGES = ('depacketize', 'playout', 'decode', 'render', 'decoded_total', 'rendered_total')
+
+    def __init__(self, report=None, interval=5., output=None):
+        self.report = report
+        self.interval = interval
+        self.output = output
+        self.lock = threading.Lock()
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.last_report = time.monotonic()
+
+    def frame_decoded(self, frame):
+        with self.lock:
+            if frame.arrival is not None:
+                if frame.completed is not None:
+                    self.histograms['depacketize'].record(frame.completed - frame.arrival)
+                    self.histograms['playout'].record(frame.released - frame.completed)
+                self.histograms['decoded_total'].record(frame.decoded - frame.arrival)
+            self.histograms['decode'].record(frame.decoded - frame.released)
+        self.check_report()
+
+    def frame_rendered(self, frame):
+        with self.lock:
+            if frame.decoded is not None:
+                self.histograms['render'].record(frame.rendered - frame.decoded)
+            if frame.arrival is not None:
+                self.histograms['rendered_total'].record(frame.rendered - frame.arrival)
+        self.check_report()
+
+    def check_report(self):
+        if self.interval is None or time.monotonic() - self.last_report < self.interval:
+            return
+        self.last_report = time.monotonic()
+        report = self.stats()
+        if self.output is not None:
+            self.output.write(format_report(report) + '\n')
+            self.output.flush()
+        if self.report is not None:
+            self.report(report)
+
+    def stats(self):
+        with self.lock:
+            return {stage: histogram.stats() for stage, histogram in self.histograms.items()}
+
+def format_report(report):
+    '''One line per stage with the count and percentiles, in milliseconds.'''
+    return '\n'.join(f"{stage:15} n={s['count']:<6} p50 {s['p50_ms']:7.2f} p95 {s['p95_ms']:7.2f} "
+                     f"p99 {s['p99_ms']:7.2f} max {s['max_ms']:7.2f}"
+                     for stage, s in report.items())
+
+class SamplingProfiler:
+    '''Statistical profiler covering every thread. A background thread takes
+    a snapshot of all stacks every interval seconds; each sample is
+    weighted by the CPU time the thread used since the previous one, so
+    threads blocked in socket or queue waits do not show up. Functions
+    are identified by their qualified name (such as
+    Connection.process_packet) and module.
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.inclusive = collections.Counter()
+        self.exclusive = collections.Counter()
+        self.total = 0.
+        self.cpu_times = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def thread_cpu_time(self, ident):
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            cpu = self.thread_cpu_time(ident)
+            if cpu is None:
+                weight = self.interval
+            else:
+                weight = cpu - self.cpu_times.get(ident, cpu)
+                self.cpu_times[ident] = cpu
+            if weight <= 0:
+                continue
+            self.total += weight
+            self.exclusive[self.function(frame)] += weight
+            seen = set()
+            while frame is not None:
+                name = self.function(frame)
+                if name not in seen:
+                    seen.add(name)
+                    self.inclusive[name] += weight
+                frame = frame.f_back
+
+    def function(self, frame):
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        return f'{module}.{getattr(code, "co_qualname", code.co_name)}'
+
+    def report(self, top=25):
+        '''Returns the functions using the most CPU time, including callees,
+        with their own time, as text.
+        '''
+        lines = [f'{self.total:.3f}s CPU sampled', f'{"total":>8} {"self":>8}  function']
+        for name, seconds in self.inclusive.most_common(top):
+            lines.append(f'{seconds:8.3f} {self.exclusive[name]:8.3f}  {name}')
+        return '\n'.join(lines)
+
+class ThreadProfiler:
+    '''Runs cProfile in the calling thread and in every thread started while
+    it is active, and merges the results. Profiles of threads that are
+    still running when stop() is called (such as those of a session that
+    was not closed) only cover their activity up to that point.
+    '''
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.main = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        # cProfile and pstats are only loaded when profiling is used
+        import cProfile
+        threading.setprofile(self.thread_started)
+        self.main = cProfile.Profile()
+        self.main.enable()
+
+    def thread_started(self, frame, event, arg):
+        import cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self):
+        threading.setprofile(None)
+        self.main.disable()
+
+    def stats(self):
+        import pstats
+        stats = pstats.Stats(self.main, stream=io.StringIO())
+        with self.lock:
+            for profile in self.profiles:
+                stats.add(profile)
+        return stats
+
+    def report(self, top=25, sort='cumulative'):
+        stream = io.StringIO()
+        stats = self.stats()
+        stats.stream = stream
+        stats.sort_stats(sort).print_stats(top)
+        return stream.getvalue()
+
+@contextlib.contextmanager
+def profiled(kind='sample', output=sys.stderr, top=25):
+    '''Profiles the enclosed block, including the session threads started
+    in it, with the sampling profiler ('sample') or cProfile ('cprofile'),
+    and writes the report to output.
+    '''
+    profiler = SamplingProfiler() if kind == 'sample' else ThreadProfiler()
+    with profiler:
+        yield profiler
+    output.write(profiler.report(top) + '\n')
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+
+from pipeline import BoundedQueue, QueueClosed
+from session import SessionListener
+
+class Recorder(SessionListener):
+    '''Session listener writing the frames it receives to disk in the .Mjpeg
+    layout (each JPEG preceded by its length as 5 ASCII digits), so that
+    recordings can be played back like movie1.Mjpeg. A sidecar CSV file
+    next to each recording lists the sequence number, RTP timestamp,
+    arrival time, offset and length of every frame.
+
+    frame_received only copies the payload into a queue; a background
+    thread writes the frames in batches through large buffered writes,
+    so disk latency never reaches the receive path. If the writer falls
+    behind and the queue is full, new frames are dropped and counted.
+
+    A new file is started once the current one reaches max_bytes bytes
+    or max_duration seconds of video; the n-th file is named after the
+    path with -n added before the extension.
+    '''
+    LENGTH_DIGITS = 5
+    QUEUE_LENGTH = 256
+    BATCH_SIZE = 32
+    FLUSH_INTERVAL = 0.5
+    WRITE_BUFFER = 1 << 20
+
+    def __init__(self, path, max_bytes=None, max_duration=None, capacity=QUEUE_LENGTH,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = BoundedQueue(capacity, BoundedQueue.BLOCK)
+        self.segment = -1
+        self.file = None
+        self.index = None
+        self.segment_bytes = 0
+        self.segment_start = None
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_time = 0.
+        self.oversized = 0
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.write_frames, daemon=True)
+        self.thread.start()
+
+    def frame_received(self, frame):
+        if frame is None or frame.payload is None:
+            return
+        if len(frame.payload) >= 10 ** self.LENGTH_DIGITS:
+            self.oversized += 1
+            return
+        self.queue.put((frame.sequence_number, frame.timestamp, frame.arrival,
+                        bytes(frame.payload)), timeout=0)
+
+    def segment_path(self, number):
+        if number == 0:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        return f'{root}-{number}{ext}'
+
+    def start_segment(self):
+        self.close_segment()
+        self.segment += 1
+        path = self.segment_path(self.segment)
+        self.file = open(path, 'wb', buffering=self.WRITE_BUFFER)
+        self.index = open(path + '.csv', 'w', buffering=self.WRITE_BUFFER)
+        self.index.write('sequence_number,timestamp,arrival,offset,length\n')
+        self.segment_bytes = 0
+        self.segment_start = None
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = self.index = None
+
+    def segment_full(self, timestamp):
+        if self.file is None:
+            return True
+        if self.max_bytes is not None and self.segment_bytes >= self.max_bytes:
+            return True
+        return self.max_duration is not None and self.segment_start is not None and \
+            (timestamp - self.segment_start) / 1000. >= self.max_duration
+
+    def write_frames(self):
+        '''Writer thread: waits for a frame, collects whatever else is queued
+        up to batch_size frames and writes them together.
+        '''
+        while True:
+            try:
+                item = self.queue.get(self.flush_interval)
+            except QueueClosed:
+                break
+            if item is None:
+                if self.file is not None:
+                    self.file.flush()
+                    self.index.flush()
+                continue
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(0)
+                except QueueClosed:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            self.write_batch(batch)
+        self.close_segment()
+
+    def write_batch(self, batch):
+        start = time.perf_counter()
+        chunks = []
+        rows = []
+        for sequence_number, timestamp, arrival, payload in batch:
+            if self.segment_full(timestamp):
+                self.flush_chunks(chunks, rows)
+                chunks, rows = [], []
+                self.start_segment()
+            if self.segment_start is None:
+                self.segment_start = timestamp
+            offset = self.segment_bytes + self.LENGTH_DIGITS
+            chunks.append(b'%05d' % len(payload))
+            chunks.append(payload)
+            rows.append(f'{sequence_number},{timestamp},'
+                        f'{"" if arrival is None else f"{arrival:.6f}"},{offset},{len(payload)}\n')
+            self.segment_bytes = offset + len(payload)
+            self.frames_written += 1
+            self.bytes_written += self.LENGTH_DIGITS + len(payload)
+        self.flush_chunks(chunks, rows)
+        self.write_time += time.perf_counter() - start
+
+    def flush_chunks(self, chunks, rows):
+        if chunks:
+            self.file.writelines(chunks)
+            self.index.writelines(rows)
+
+    def close(self):
+        '''Writes the frames still queued and closes the files.'''
+        self.queue.close()
+        self.thread.join()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        stats = self.queue.stats()
+        stats.update({
+            'frames_written': self.frames_written,
+            'bytes_written': self.bytes_written,
+            'segments': self.segment + 1,
+            'oversized': self.oversized,
+            'write_time': self.write_time,
+            'write_throughput': self.bytes_written / self.write_time if self.write_time else 0.,
+            'frame_rate': self.frames_written / elapsed if elapsed else 0.,
+        })
+        return stats
@@ -0,0 +1,82 @@
+import collections
+import struct
+import threading
+
+HEADER = struct.Struct('!BBHII')
+EXTENSION_HEADER = struct.Struct('!HH')
+
+class BufferPool:
+    '''Pool of reusable receive buffers. Buffers are allocated on demand and
+    up to max_free released buffers are kept for reuse, so the steady state
+    receive path does not allocate.
+    '''
+    def __init__(self, size, max_free=32):
+        self.size = size
+        self.max_free = max_free
+        self.free = collections.deque()
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                self.reused += 1
+                return self.free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+    def stats(self):
+        return {'allocated': self.allocated, 'reused': self.reused, 'free': len(self.free)}
+
+class RtpPacket:
+    '''An RTP packet parsed in place from a receive buffer. The payload is a
+    memoryview into that buffer: it is only valid until release() is
+    called, so consumers that keep it longer must copy it first.
+    '''
+    __slots__ = ('version', 'padding', 'extension', 'csrc_count', 'marker',
+                 'payload_type', 'sequence_number', 'timestamp', 'ssrc',
+                 'payload', 'buffer', 'pool', 'arrival')
+
+    def __init__(self, buffer, length, pool=None):
+        '''Parses the fixed header, skipping CSRC identifiers, the header
+        extension and padding. Raises ValueError on malformed packets.
+        '''
+        if length < HEADER.size:
+            raise ValueError('RTP packet shorter than the fixed header')
+        b0, b1, self.sequence_number, self.timestamp, self.ssrc = HEADER.unpack_from(buffer)
+        self.version = b0 >> 6
+        self.padding = (b0 >> 5) & 1
+        self.extension = (b0 >> 4) & 1
+        self.csrc_count = b0 & 0x0f
+        self.marker = b1 >> 7
+        self.payload_type = b1 & 0x7f
+
+        start = HEADER.size + 4 * self.csrc_count
+        if self.extension:
+            if start + EXTENSION_HEADER.size > length:
+                raise ValueError('RTP header extension exceeds packet')
+            _, words = EXTENSION_HEADER.unpack_from(buffer, start)
+            start += EXTENSION_HEADER.size + 4 * words
+        end = length
+        if self.padding:
+            end -= buffer[length - 1]
+        if start > end:
+            raise ValueError('RTP header exceeds packet length')
+
+        self.payload = memoryview(buffer)[start:end]
+        self.buffer = buffer
+        self.pool = pool
+        self.arrival = None
+
+    def release(self):
+        '''Returns the underlying buffer to its pool.'''
+        if self.pool is not None and self.buffer is not None:
+            self.payload.release()
+            self.pool.release(self.buffer)
+        self.buffer = None
@@ -1,38 +1,175 @@
 import io, socket
+import logging
+import collections
 import random
 import re
+import selectors
+import struct
+import sys
 from threading import Thread, Event
 import threading
 import time
 import _thread
+from playout import JitterBuffer
+from pipeline import BoundedQueue, QueueClosed
+from rtp import BufferPool, RtpPacket
+from depacketizer import JpegDepacketizer
+from stats import StreamStatistics
+
+log = logging.getLogger(__name__)
+
+# Linux socket options missing from the socket module
+SO_RCVBUFFORCE = 33 if sys.platform.startswith('linux') else None
+SO_RXQ_OVFL = 40 if sys.platform.startswith('linux') else None
+
+def set_receive_buffer(sock, size):
+    '''Asks for a kernel receive buffer of size bytes, above the rmem_max
+    limit where the process is allowed to, and returns the size obtained
+    (Linux reports twice the requested size, to account for overhead).
+    '''
+    for option in (SO_RCVBUFFORCE, socket.SO_RCVBUF):
+        if option is None:
+            continue
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+            break
+        except OSError:
+            pass
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+def receive_buffer_size(bitrate, jitter_tolerance, burst_factor):
+    '''Bytes needed to hold jitter_tolerance seconds of a stream of bitrate
+    bits per second arriving burst_factor times faster than nominal.
+    '''
+    return int(bitrate / 8 * jitter_tolerance * burst_factor)
+
+def enable_overflow_count(sock):
+    '''Asks the kernel to attach its count of datagrams dropped for lack of
+    buffer space to every datagram received. Returns False if unsupported.
+    '''
+    if SO_RXQ_OVFL is None or not hasattr(sock, 'recvmsg_into'):
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        return True
+    except OSError:
+        return False
+
+class SocketStatistics:
+    '''Receive buffer size, kernel drops and batching of a datagram socket.'''
+    def __init__(self):
+        self.receive_buffer = 0
+        self.kernel_drops = 0
+        self.overflow_count = False
+        self.batches = 0
+        self.packets = 0
+        self.max_batch = 0
+
+    def batch(self, packets):
+        self.batches += 1
+        self.packets += packets
+        self.max_batch = max(self.max_batch, packets)
+
+    def ancillary(self, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                self.kernel_drops = struct.unpack('I', data[:4])[0]
+
+    def stats(self):
+        return {
+            'receive_buffer': self.receive_buffer,
+            'kernel_drops': self.kernel_drops if self.overflow_count else None,
+            'batches': self.batches,
+            'mean_batch': self.packets / self.batches if self.batches else 0.,
+            'max_batch': self.max_batch,
+        }
 
 class RTSPException(Exception):
     def __init__(self, response):
+        self.response = response
         super().__init__(f'Server error: {response.message} (error code: {response.response_code})')
 
 class Response:
     def __init__(self, reader):
-        '''Reads and parses the data associated to an RTSP response'''
-        first_line = reader.readline().split(' ', 2)
+        '''Reads and parses the status line and headers of an RTSP response.
+        Use check() to raise an RTSPException for unsuccessful responses.
+        '''
+        first_line = reader.readline().strip().split(' ', 2)
         if len(first_line) != 3:
             raise Exception('Invalid response format. Expected first line with version, code and message')
         self.version, _, self.message = first_line
         if self.version != 'RTSP/1.0':
             raise Exception('Invalid response version. Expected RTSP/1.0')
         self.response_code = int(first_line[1])
+        self.headers = {}
+        self.cseq = None
+        self.session_id = None
 
         while True:
             line = reader.readline().strip()
             if not line or ':' not in line: break
             hdr_name, hdr_value = line.split(':', 1)
+            hdr_value = hdr_value.strip()
             self.headers[hdr_name.lower()] = hdr_value
             if hdr_name.lower() == 'cseq':
                 self.cseq = int(hdr_value)
             elif hdr_name.lower() == 'session':
-                self.session_id = int(hdr_value)
+                self.session_id = int(hdr_value.split(';')[0])
+        self.body = b''
 
+    def check(self):
         if self.response_code != 200:
             raise RTSPException(self)
+        return self
+
+class ResponseParser:
+    '''Incremental parser for the RTSP control channel. Data read from the
+    socket is fed in arbitrary pieces, and complete responses (including
+    any Content-Length body) are returned as soon as they are available.
+    Lines may end with CRLF or a bare LF, as written by the Java server's
+    println; the headers end at the first empty line of either kind.
+    '''
+    HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        '''Adds data to the buffer and returns the list of responses it
+        completed.
+        '''
+        self.buffer += data
+        responses = []
+        while True:
+            match = self.HEADER_END.search(self.buffer)
+            if match is None:
+                break
+            head = self.buffer[:match.start()].decode('utf-8')
+            response = Response(io.StringIO(head + '\n', newline=None))
+            total = match.end() + int(response.headers.get('content-length', 0))
+            if len(self.buffer) < total:
+                break
+            response.body = bytes(self.buffer[match.end():total])
+            del self.buffer[:total]
+            responses.append(response)
+        return responses
+
+class ControlLatency:
+    '''Round-trip times of the last SAMPLES requests of each method.'''
+    SAMPLES = 100
+
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.SAMPLES))
+
+    def record(self, method, seconds):
+        self.samples[method].append(seconds)
+
+    def stats(self):
+        '''Returns count, last, mean and max round-trip time (in ms) per method.'''
+        return {method: {'count': len(samples), 'last_ms': 1000 * samples[-1],
+                         'mean_ms': 1000 * sum(samples) / len(samples),
+                         'max_ms': 1000 * max(samples)}
+                for method, samples in self.samples.items() if samples}
 
 class Connection:
     BUFFER_LENGTH = 0x10000
@@ -45,13 +182,23 @@ class Connection:
     PLAY = 1
     PAUSE = 2
     TEARDOWN = 3
-    SESSION_PATTERN = r".*Session: (\d+)"
-    RTSP_PATTERN = r"RTSP/1.0 (\d+) ([a-zA-Z]+)"
+    METHODS = {SETUP: 'SETUP', PLAY: 'PLAY', PAUSE: 'PAUSE', TEARDOWN: 'TEARDOWN'}
+    INVALID_RANGE = 457
     RTP_SOFT_TIMEOUT = 5
+    # seconds to wait for the server to accept the connection or answer
+    CONTROL_TIMEOUT = 10
+    PACKET_QUEUE_LENGTH = 256
+    # the socket buffer holds JITTER_TOLERANCE seconds of traffic at
+    # BURST_FACTOR times the expected bitrate
+    EXPECTED_BITRATE = 2000000
+    JITTER_TOLERANCE = 0.5
+    BURST_FACTOR = 4
+    MAX_BATCH = 64
 
-    def __init__(self, session, address):
+    def __init__(self, session, address, jitter_buffer=None):
         '''Establishes a new connection with an RTSP server. No message is
-	sent at this point, and no stream is set up.
+	sent at this point, and no stream is set up. A JitterBuffer may be
+	given to tune the playout delay; otherwise a default one is used.
         '''
         self.session = session
         # TODO
@@ -62,48 +209,74 @@ class Connection:
         self.address = address[0]
         self.portNum = int(address[1])
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(self.CONTROL_TIMEOUT)
         self.data_sock = None
-        self.seqList = []
-        self.timeStamps = {}
-        self.dataBuffer = {}
+        self.wakeup = None
+        self.stopping = False
+        self.jitter_buffer = jitter_buffer if jitter_buffer is not None else JitterBuffer()
+        self.packet_queue = BoundedQueue(self.PACKET_QUEUE_LENGTH)
+        self.buffer_pool = BufferPool(self.BUFFER_LENGTH)
+        self.depacketizer = JpegDepacketizer()
         self.t = None
-        self.numData = 0
-        self.lastData = 0
-        self.numOutOrder = 0
-        self.lastTime = 0
+        self.receiver = None
+        self.statistics = StreamStatistics()
+        self.parser = ResponseParser()
+        self.responses = {}
+        self.outstanding = {}
+        self.latency = ControlLatency()
+        self.capture = None
+        self.socket_stats = SocketStatistics()
+        self.seek_position = None
+        self.seekable = True
+        self.connect()
+
+    def connect(self):
         # CONNECT TO SERVER
         try:
             self.socket.connect((self.address, self.portNum))
         except:
-            print('Connection to port \'%s\' failed.' %self.portNum)
+            log.warning("Connection to port '%s' failed.", self.portNum)
             return
 
-        print("[SUCCESS] Connection established.")
+        log.info("Connection established.")
 
     def send_request(self, command, include_session=True, extra_headers=None):
         '''Helper function that generates an RTSP request and sends it to the
-        RTSP connection.
+        RTSP connection. Returns the CSeq of the request, which is passed to
+        get_response to wait for the reply. Several requests may be sent
+        before reading their responses (pipelining).
         '''
-        # TODO
         self.seqNum += 1
-        if command == self.SETUP and self.state == self.INIT:
-            request = "SETUP " + self.fileName + " RTSP/1.0\r\n" + "CSeq: " + str(self.seqNum) + "\r\n" + "Transport: RTP/UDP; client_port= " + str(self.data_port) + "\r\n\r\n"
-            pass
-        elif command == self.PLAY and self.state == self.READY:
-            request = "PLAY " + self.fileName + " RTSP/1.0\r\n" + "CSeq: " + str(self.seqNum) + "\r\n" + "Session: " + str(self.sessionNum) + "\r\n\r\n"
-            pass
-        elif command == self.PAUSE and self.state == self.PLAYING:
-            request = "PAUSE " + self.fileName + " RTSP/1.0\r\n" + "CSeq: " + str(self.seqNum) + "\r\n" + "Session: " + str(self.sessionNum) + "\r\n\r\n"
-            pass
-        elif command == self.TEARDOWN and self.state != self.INIT:
-            request = "TEARDOWN " + self.fileName + " RTSP/1.0\r\n" + "CSeq: " + str(self.seqNum) + "\r\n" + "Session: " + str(self.sessionNum) + "\r\n\r\n"
-            pass
-        else:
-            print('Invalid command %s' %command)
-            return
-        req = bytes(request, 'utf-8')
-        self.socket.send(req)
-        print("Request sent: %s" %request)
+        method = self.METHODS[command]
+        request = f"{method} {self.fileName} RTSP/1.0\r\nCSeq: {self.seqNum}\r\n"
+        if command == self.SETUP:
+            request += f"Transport: RTP/UDP; client_port= {self.data_port}\r\n"
+        if include_session:
+            request += f"Session: {self.sessionNum}\r\n"
+        for name, value in (extra_headers or {}).items():
+            request += f"{name}: {value}\r\n"
+        self.socket.sendall(bytes(request + "\r\n", 'utf-8'))
+        self.outstanding[self.seqNum] = (method, time.monotonic())
+        log.debug("Request sent: %s", request)
+        return self.seqNum
+
+    def get_response(self, cseq):
+        '''Reads from the control connection until the response to the
+        request with the given CSeq has arrived, keeping responses to other
+        outstanding requests for later. Raises RTSPException if the request
+        failed, and socket.timeout if no response arrives within
+        CONTROL_TIMEOUT seconds.
+        '''
+        while cseq not in self.responses:
+            buf = self.socket.recv(self.BUFFER_LENGTH)
+            if not buf:
+                raise ConnectionError('Connection closed by the server')
+            for response in self.parser.feed(buf):
+                if response.cseq in self.outstanding:
+                    method, sent = self.outstanding.pop(response.cseq)
+                    self.latency.record(method, time.monotonic() - sent)
+                self.responses[response.cseq] = response
+        return self.responses.pop(cseq).check()
 
     def start_rtp_timer(self):
         '''Starts a thread that reads RTP packets repeatedly and process the
@@ -113,21 +286,39 @@ class Connection:
 	and the method `self.session.process_frame()` is called with
 	the resulting data. In case of timeout no exception should be
 	thrown.
+
+	Receiving and processing run on separate threads connected by
+	a bounded drop-oldest queue, so the socket is drained even when
+	the session is slow to consume frames. Both threads block
+	without polling while the stream is paused and are reused when
+	it resumes; if they are already running, nothing is done.
         '''
 
         # TODO
-        self.t = Thread(target = self.process_data)
+        if self.t is not None:
+            return
+        self.stopping = False
+        self.packet_queue = BoundedQueue(self.PACKET_QUEUE_LENGTH)
+        self.receiver = Thread(target = self.receive_packets, daemon = True, name = 'rtp-receive')
+        self.t = Thread(target = self.process_data, daemon = True, name = 'rtp-playout')
+        self.receiver.start()
         self.t.start()
-        self.playEvent = threading.Event()
-        self.playEvent.clear()
 
     def stop_rtp_timer(self):
-        '''Stops the thread that reads RTP packets'''
+        '''Stops the threads that read and process RTP packets and waits for
+        them to end'''
 
         # TODO
-        # self.t.join()
-        self.playEvent.set()
-        # print("ACTIVE THREADS: " + str(threading.active_count()))
+        if self.t is None:
+            return
+        self.stopping = True
+        self.wakeup[1].send(b'\0')
+        self.packet_queue.close()
+        for thread in (self.receiver, self.t):
+            if thread is not threading.current_thread():
+                thread.join()
+        self.t = None
+        self.receiver = None
 
     def setup(self, filename):
         '''Sends a SETUP request to the server. This method is responsible for
@@ -143,34 +334,54 @@ class Connection:
         '''
 
         # TODO
-        # print("setup triggered")
-        if self.state != self.INIT:
-            print("incorrect state")
+        if not self.prepare_setup(filename):
             return
+        response = self.get_response(self.send_request(self.SETUP, include_session=False))
+        self.sessionNum = response.session_id
+        self.state = self.READY
+
+    def prepare_setup(self, filename):
+        '''Helper function that creates the RTP datagram socket before a SETUP'''
+        if self.state != self.INIT:
+            log.warning("incorrect state")
+            return False
         self.fileName = filename
+        self.seek_position = None
+        self.statistics.reset()
         # Create RTP datagram socket
         if self.data_sock is None:
             self.data_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.data_port = random.randint(0, 65353)
             self.data_sock.bind((self.address, self.data_port))
-            # self.data_sock.connect(self.address, self.data_port)
-        # print("before send")
-        self.send_request(self.SETUP)
-        # Get and process reply
-        buf = self.socket.recv(self.BUFFER_LENGTH)
-        if not buf:
-            print("nothing received")
-            return
-        reply = buf.decode("utf-8")
-        if not self.check_rtsp_head(reply):
-            print("transmission failed")
-            print(reply)
+            self.data_sock.setblocking(False)
+            self.socket_stats.receive_buffer = set_receive_buffer(
+                self.data_sock, self.receive_buffer_size())
+            self.socket_stats.overflow_count = enable_overflow_count(self.data_sock)
+            self.wakeup = socket.socketpair()
+        return True
+
+    def receive_buffer_size(self):
+        '''Size of the kernel receive buffer needed to absorb bursts.'''
+        return receive_buffer_size(self.EXPECTED_BITRATE, self.JITTER_TOLERANCE, self.BURST_FACTOR)
+
+    def setup_and_play(self, filename):
+        '''Sends SETUP immediately followed by PLAY, without waiting for the
+        SETUP response, saving a round trip before the first frame. The
+        pipelined PLAY cannot carry the session identification yet; if the
+        server rejects it, PLAY is sent again once SETUP has completed.
+        '''
+        if not self.prepare_setup(filename):
             return
-        # check if we are in the correct session
-        session_match = re.search(self.SESSION_PATTERN, reply)
-        if session_match:
-            self.sessionNum = session_match.group(1)
+        setup_cseq = self.send_request(self.SETUP, include_session=False)
+        play_cseq = self.send_request(self.PLAY, include_session=False)
+        response = self.get_response(setup_cseq)
+        self.sessionNum = response.session_id
         self.state = self.READY
+        try:
+            self.get_response(play_cseq)
+        except RTSPException:
+            self.get_response(self.send_request(self.PLAY))
+        self.start_playing()
 
     def play(self):
         '''Sends a PLAY request to the server. This method is responsible for
@@ -181,25 +392,31 @@ class Connection:
 
         # TODO
         if self.state != self.READY:
-            print("incorrect state")
-            return
-        self.send_request(self.PLAY)
-        # Get and process reply
-        buf = self.socket.recv(self.BUFFER_LENGTH)
-        if not buf:
-            print("nothing received")
-            return
-        reply = buf.decode("utf-8")
-        if not self.check_rtsp_head(reply):
-            print("transmission failed")
-            print(reply)
+            log.warning("incorrect state")
             return
-        session_match = re.search(self.SESSION_PATTERN, reply)
-        if session_match:
-            sessionNum = session_match.group(1)
-            if sessionNum == self.sessionNum:
-                self.start_rtp_timer()
+        if self.seek_position is None:
+            self.get_response(self.send_request(self.PLAY))
+        else:
+            position, self.seek_position = self.seek_position, None
+            try:
+                response = self.get_response(self.send_request(
+                    self.PLAY, extra_headers={'Range': f'npt={position / 1000:.3f}-'}))
+            except RTSPException as exception:
+                # resume where the stream was paused
+                self.seekable = exception.response.response_code == self.INVALID_RANGE
+                self.get_response(self.send_request(self.PLAY))
+                self.start_playing()
+                raise
+            if 'range' not in response.headers:
+                # the server ignored the header and resumed where it was
+                self.seekable = False
+        self.start_playing()
+
+    def start_playing(self):
+        self.jitter_buffer.resync()
+        # datagrams are discarded until the state is PLAYING
         self.state = self.PLAYING
+        self.start_rtp_timer()
 
     def pause(self):
         '''Sends a PAUSE request to the server. This method is responsible for
@@ -210,27 +427,50 @@ class Connection:
 
         # TODO
         if self.state != self.PLAYING:
-            print("incorrect state")
+            log.warning("incorrect state")
             return
-        self.send_request(self.PAUSE)
-        # Get and process reply
-        buf = self.socket.recv(self.BUFFER_LENGTH)
-        self.playEvent.set()
-        if not buf:
-            print("nothing received")
-            return
-        reply = buf.decode("utf-8")
-        if not self.check_rtsp_head(reply):
-            print("transmission failed")
-            print(reply)
-            return
-        session_match = re.search(self.SESSION_PATTERN, reply)
-        if session_match:
-            sessionNum = session_match.group(1)
-            if sessionNum == self.sessionNum:
-                self.stop_rtp_timer()
+        self.get_response(self.send_request(self.PAUSE))
+        # the threads stay blocked until playback resumes
         self.state = self.READY
 
+    def seek(self, timestamp):
+        '''Moves playback to timestamp milliseconds from the start of the
+        video, with a Range header on the PLAY request. A playing stream is
+        paused and restarted at the new position; for a paused stream the
+        position is sent with the next PLAY. Frames buffered for the old
+        position are discarded. Returns False if the server is known not to
+        support seeking.
+        '''
+        if self.state == self.INIT:
+            log.warning("incorrect state")
+            return False
+        if not self.seekable:
+            return False
+        playing = self.state == self.PLAYING
+        if playing:
+            self.get_response(self.send_request(self.PAUSE))
+            self.state = self.READY
+        self.flush()
+        self.seek_position = timestamp
+        if playing:
+            self.play()
+        return True
+
+    def flush(self):
+        '''Helper function that stops the receive threads and discards the
+        packets and frames received so far'''
+        self.stop_rtp_timer()
+        while True:
+            try:
+                self.recv_rtp_packet().release()
+            except BlockingIOError:
+                break
+            except ValueError:
+                continue
+        self.packet_queue.clear()
+        self.depacketizer.reset()
+        self.jitter_buffer.reset()
+
     def teardown(self):
         '''Sends a TEARDOWN request to the server. This method is responsible
 	for sending the request, receiving the response and, in case
@@ -244,42 +484,15 @@ class Connection:
 
         # TODO
         if self.state == self.INIT:
-            print("incorrect state")
+            log.warning("incorrect state")
             return
-        self.send_request(self.TEARDOWN)
-
-        buf = self.socket.recv(self.BUFFER_LENGTH)
-        self.playEvent.set()
-        '''These prints are for showing stats'''
-        # print("PACKETS RECEIVED: " + str(self.numData))
-        # print("TIME STAMPS: " + str(self.timeStamps))
-        # print("SEQUENCE LIST: " + str(self.seqList[-1]))
-        # print("FRAME RATE: " + str(self.calculate_frame_rate()))
-        # print("LOSS RATE: " + str(self.calculate_loss_rate()))
-        # print("OUT OF ORDER RATE: " + str(self.calculate_out_of_order_rate()))
-        # print("OUT OF ORDER PACKETS: " + str(self.numOutOrder))
-        if not buf:
-            print("nothing received")
-            return
-        reply = buf.decode("utf-8")
-        if not self.check_rtsp_head(reply):
-            print("transmission failed")
-            print(reply)
-            return
-        session_match = re.search(self.SESSION_PATTERN, reply)
-        if session_match:
-            sessionNum = session_match.group(1)
-            if sessionNum == self.sessionNum:
-                self.stop_rtp_timer()
+        self.get_response(self.send_request(self.TEARDOWN))
+        self.stop_rtp_timer()
         self.state = self.INIT
-        self.numData = 0
-        self.numOutOrder = 0
-        self.lastData = 0
-        self.seqList = []
-        self.dataBuffer = {}
-        self.lastTime = 0
-        self.t = None
-        self.timeStamps = {}
+        self.seek_position = None
+        self.packet_queue.clear()
+        self.depacketizer.reset()
+        self.jitter_buffer.reset()
 
     def close(self):
         '''Closes the connection with the RTSP server. This method should also
@@ -288,94 +501,157 @@ class Connection:
         '''
 
         # TODO
-        if self.t != None:
-            print("thread still running")
-            self.stop_rtp_timer()
-        print("ACTIVE THREADS: " + str(threading.active_count()))
+        self.stop_rtp_timer()
+        self.stop_capture()
         if self.data_sock != None:
             self.data_sock.close()
+            self.data_sock = None
+        if self.wakeup is not None:
+            for sock in self.wakeup:
+                sock.close()
+            self.wakeup = None
         self.socket.close()
 
-    def check_rtsp_head(self, reply):
-        '''Helper function to check if the rtsp header indicates successful transmisson'''
-        resp_match = re.match(self.RTSP_PATTERN, reply)
-        if not resp_match:
-            return False
-        if resp_match.group(1) and resp_match.group(2):
-            return resp_match.group(1) == "200" and resp_match.group(2) == "OK"
-        return False
+    def receive_packets(self):
+        '''Network stage: blocks until the datagram socket is readable or
+        the thread is woken up to stop, then drains every datagram already
+        queued in the kernel in a tight non-blocking loop, queueing them for
+        processing without ever waiting on later stages'''
+        selector = selectors.DefaultSelector()
+        selector.register(self.data_sock, selectors.EVENT_READ, self.drain_socket)
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        try:
+            while not self.stopping:
+                for key, _ in selector.select():
+                    if key.data is None:
+                        self.wakeup[0].recv(self.BUFFER_LENGTH)
+                    elif not self.stopping:
+                        key.data()
+        except OSError:
+            if not self.stopping:
+                raise
+        finally:
+            selector.close()
 
-    def process_data(self):
-        '''This function will receive data frames from server and process it'''
-        self.data_sock.settimeout(self.RTP_SOFT_TIMEOUT / 1000.)
-        while True:
-            if self.state != self.PLAYING:
-                time.sleep(self.RTP_SOFT_TIMEOUT/1000.)  # diminish cpu hogging
-                continue
+    def drain_socket(self):
+        '''Reads up to MAX_BATCH datagrams without blocking. Datagrams
+        arriving while the stream is not playing are discarded.'''
+        count = 0
+        while count < self.MAX_BATCH:
             try:
                 packet = self.recv_rtp_packet()
-                #print(len(packet))
-                marker = packet[1] >> 7
-                #print(marker)
-                payloadType = (packet[1] << 1) >> 1
-                #print(payloadType)
-                seqNum = packet[2] * 256 + packet[3]
-                timeStamp = packet[4] * 16777216 + packet[5] * 65536 + packet[6] *256 + packet[7]
-                #print(seqNum)
-                #print(timeStamp)
-                self.dataBuffer[seqNum] = packet[12:]
-                frame= packet[12:]
-                wait = 0
-                if self.seqList != [] and int(seqNum) != (self.seqList[-1] + 1): # check if the order is correct
-                    self.numOutOrder += 1
-                    if seqNum in self.timeStamps: # drop duplicated data
-                        continue
-                    if (self.seqList[-1] + 1) in self.timeStamps: # check if we received the right ordered data
-                        frame = self.dataBuffer[self.seqList[-1] + 1]
-                    else:                                              # wait for a certain period based on lagging
-                        timeDiff = time.time() - self.lastTime
-                        wait = timeDiff * 0.002 * abs(timeStamp - self.timeStamps[self.seqList[-1]])
-                self.seqList.append(seqNum)
-                self.timeStamps[seqNum] = timeStamp
-                if seqNum > self.lastData:
-                    self.lastData = seqNum
-                if self.lastTime == 0:
-                    wait = self.RTP_SOFT_TIMEOUT/100. # set initial waiting period to 50 ms
-                self.lastTime = time.time()
-                self.handle_frame(payloadType, marker, seqNum, timeStamp, frame, wait)
-            except:
-                if self.playEvent.isSet():
-                    break
+            except BlockingIOError:
+                break
+            except ValueError:
+                continue
+            if self.state != self.PLAYING:
+                packet.release()
+                continue
+            self.packet_queue.put(packet)
+            count += 1
+        if count:
+            self.socket_stats.batch(count)
 
-    def recv_rtp_packet(self):
-        '''Helper function to receive data'''
-        packet = bytes()
-        # packet = self.data_sock.recv(self.BUFFER_LENGTH)
+    def process_data(self):
+        '''This function will process the data frames received from server.
+        Packets are assembled into frames by the depacketizer, and complete
+        frames are queued in the jitter buffer and handed to the session when
+        their playout time is reached, so a late packet never stalls the
+        packets behind it.
+        '''
         while True:
-            # try:
-            packet += self.data_sock.recv(self.BUFFER_LENGTH)
-            if packet.endswith(b'\xff\xd9'):
+            # no timeout while paused or with nothing buffered: only a new
+            # packet (or closing the queue) can make anything due
+            timeout = None
+            if self.state == self.PLAYING:
+                timeout = self.jitter_buffer.next_deadline()
+            try:
+                packet = self.packet_queue.get(timeout)
+            except QueueClosed:
                 break
-            # except socket.timeout:
-            #     continue
-        self.numData += 1
+            if packet is not None:
+                self.process_packet(packet)
+            if self.state == self.PLAYING:
+                self.release_frames()
+
+    def process_packet(self, packet):
+        '''Passes one packet through the statistics and the depacketizer, and
+        queues the frame it completes, if any, in the jitter buffer.
+        '''
+        self.statistics.packet_received(packet.sequence_number, packet.timestamp,
+                                        len(packet.payload), packet.arrival)
+        frame = self.depacketizer.push(packet, packet.arrival)
+        if frame is not None:
+            self.statistics.frame_completed(packet.arrival)
+            if not self.jitter_buffer.push(frame.sequence_number, frame.timestamp,
+                                           frame, packet.arrival):
+                frame.release()
+
+    def release_frames(self, now=None):
+        '''Hands the frames whose playout time has been reached at time now
+        (by default the current time) to the session.
+        '''
+        self.depacketizer.expire(now)
+        for frame in self.jitter_buffer.pop_ready(now):
+            self.handle_frame(frame)
+
+    def recv_rtp_packet(self):
+        '''Helper function to receive data. Each datagram is read into a
+        pooled buffer and parsed in place; the returned packet must be
+        released once its payload is no longer needed.
+        '''
+        buffer = self.buffer_pool.acquire()
+        try:
+            if self.socket_stats.overflow_count:
+                length, ancdata, _, _ = self.data_sock.recvmsg_into([buffer],
+                                                                    socket.CMSG_SPACE(4))
+                if ancdata:
+                    self.socket_stats.ancillary(ancdata)
+            else:
+                length = self.data_sock.recv_into(buffer)
+            arrival = time.monotonic()
+            if self.capture is not None:
+                self.capture.write(arrival, memoryview(buffer)[:length])
+            packet = RtpPacket(buffer, length, self.buffer_pool)
+        except:
+            self.buffer_pool.release(buffer)
+            raise
+        packet.arrival = arrival
         return packet
 
-    def handle_frame(self, payloadType, marker, seqNum, timeStamp, frame, wait):
-        '''helper function for waiting before sending frames to play
-            I know we need a seperate thread for better performance, don't have the time to implement it'''
-        time.sleep(wait)
-        self.session.process_frame(payloadType, marker, seqNum, timeStamp, frame)
+    def start_capture(self, capture):
+        '''Starts logging every datagram received to capture, a
+        capture.CaptureWriter.'''
+        self.capture = capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def handle_frame(self, frame):
+        '''Helper function that hands a frame whose playout time has been
+        reached to the session'''
+        self.session.process_frame(frame.payload_type, frame.marker, frame.sequence_number,
+                                   frame.timestamp, frame.payload, frame.release, frame.arrival,
+                                   frame.completed)
+
+    def pipeline_stats(self):
+        '''Returns the state of each receive stage.'''
+        return {
+            'socket': self.socket_stats.stats(),
+            'packets': self.packet_queue.stats(),
+            'depacketizer': self.depacketizer.stats(),
+            'jitter_buffer': self.jitter_buffer.stats(),
+        }
 
     '''Functions to show stats'''
     def calculate_frame_rate(self):
-        time_range = self.timeStamps[self.lastData] / 1000
-        return self.numData / time_range
+        return self.statistics.snapshot()['packet_rate']
 
     def calculate_loss_rate(self):
-        time_range = self.timeStamps[self.lastData] / 1000
-        return (self.lastData + 1 - self.numData) / time_range
+        return self.statistics.snapshot()['loss_rate']
 
     def calculate_out_of_order_rate(self):
-        time_range = self.timeStamps[self.lastData] / 1000
-        return self.numOutOrder / time_range
+        stats = self.statistics.snapshot()
+        return stats['reordered'] / stats['elapsed'] if stats['elapsed'] else 0.
@@ -0,0 +1,332 @@
+#! /usr/bin/python3
+
+'''Loopback RTSP/RTP test server.
+
+Serves .Mjpeg files (5-digit ASCII length before each JPEG frame) over
+the RTSP subset used by the client (SETUP, PLAY, PAUSE and TEARDOWN with
+CSeq and Session headers) and can impair the RTP stream with loss,
+reordering, duplication, rate scaling, jitter and periodic stalls. The
+PROFILES table reproduces the FUNKY A-H server scenarios; all random
+decisions come from a seeded generator, so a given profile and seed
+always drops, duplicates and delays the same packets.
+'''
+
+import argparse
+import heapq
+import os
+import random
+import re
+import socket
+import struct
+import threading
+import time
+
+from mjpeg import MjpegFile
+
+class Impairment:
+    '''Description of how the RTP stream is degraded.
+	- loss: probability of dropping a packet.
+	- duplicate: probability of sending a packet twice.
+	- reorder: probability of delaying a packet by reorder_delay seconds
+	  (a (min, max) range), so that later packets overtake it.
+	- rate: playback speed; 2 sends frames twice as fast, 0.5 half as fast.
+	- jitter: maximum random delay, in seconds, added to every packet.
+	- stall_every, stall_length: every stall_every seconds, sending stops
+	  for stall_length seconds and the held packets are sent in a burst.
+    '''
+    def __init__(self, loss=0., duplicate=0., reorder=0., reorder_delay=(0.05, 0.2),
+                 rate=1., jitter=0., stall_every=0., stall_length=0.):
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rate = rate
+        self.jitter = jitter
+        self.stall_every = stall_every
+        self.stall_length = stall_length
+
+PROFILES = {
+    'NONE': Impairment(),
+    'A': Impairment(loss=0.1, reorder=0.1, reorder_delay=(0.04, 0.08)),
+    'B': Impairment(loss=0.35, reorder=0.2, reorder_delay=(0.1, 0.4)),
+    'C': Impairment(reorder=0.4, reorder_delay=(0.05, 0.2)),
+    'D': Impairment(loss=0.45, reorder=0.4, reorder_delay=(0.1, 0.4)),
+    'E': Impairment(rate=2.),
+    'F': Impairment(rate=0.5),
+    'G': Impairment(loss=0.2, reorder=0.2, rate=0.8, jitter=0.03),
+    'H': Impairment(stall_every=2., stall_length=0.5),
+}
+
+class RTSPServer:
+    '''Accepts RTSP connections on a loopback address and serves each one on
+    its own thread.
+    '''
+    FRAME_PERIOD = 40 # ms per frame at the nominal 25 fps
+
+    def __init__(self, port=0, host='127.0.0.1', impairment=None, seed=0,
+                 video_dir='.', max_payload=60000):
+        if not host.startswith('127.') and host != 'localhost':
+            raise ValueError('The test server only listens on loopback addresses')
+        self.impairment = impairment or PROFILES['NONE']
+        self.seed = seed
+        self.video_dir = video_dir
+        self.max_payload = max_payload
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.address = self.socket.getsockname()
+        self.thread = None
+        self.connections = []
+        self.sessions = 0
+
+    def start(self):
+        '''Starts accepting connections in a background thread.'''
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            self.sessions += 1
+            connection = ServerConnection(self, client, self.seed + self.sessions - 1)
+            self.connections.append(connection)
+            threading.Thread(target=connection.run, daemon=True).start()
+
+    def close(self):
+        self.socket.close()
+        for connection in self.connections:
+            connection.close()
+
+class ServerConnection:
+    '''Handles the RTSP requests of one client and streams its video.'''
+    INIT = 0
+    READY = 1
+    PLAYING = 2
+
+    def __init__(self, server, client, seed):
+        self.server = server
+        self.client = client
+        self.reader = client.makefile('r', encoding='utf-8', newline='\r\n')
+        self.random = random.Random(seed)
+        self.state = self.INIT
+        self.session_id = None
+        self.video = None
+        self.rtp_socket = None
+        self.rtp_address = None
+        self.sender = None
+        self.stop_event = threading.Event()
+        self.sequence_number = 0
+        self.frame_number = 0
+        self.packets_sent = 0
+
+    def run(self):
+        try:
+            while True:
+                request = self.read_request()
+                if request is None:
+                    break
+                self.handle(*request)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def read_request(self):
+        line = self.reader.readline()
+        while line and not line.strip():
+            line = self.reader.readline()
+        if not line:
+            return None
+        parts = line.split()
+        headers = {}
+        while True:
+            line = self.reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(parts) != 3:
+            return 'INVALID', '', headers
+        return parts[0], parts[1], headers
+
+    def respond(self, cseq, code=200, message='OK', extra_headers=None):
+        response = f'RTSP/1.0 {code} {message}\r\nCSeq: {cseq}\r\n'
+        if code == 200 and self.session_id is not None:
+            response += f'Session: {self.session_id}\r\n'
+        for name, value in (extra_headers or {}).items():
+            response += f'{name}: {value}\r\n'
+        self.client.sendall((response + '\r\n').encode('utf-8'))
+
+    def handle(self, method, video_name, headers):
+        cseq = headers.get('cseq', '0')
+        if method == 'SETUP':
+            if self.state != self.INIT:
+                return self.respond(cseq, 455, 'Method Not Valid In This State')
+            port = re.search(r'client_port=\s*(\d+)', headers.get('transport', ''))
+            if not port:
+                return self.respond(cseq, 461, 'Unsupported Transport')
+            path = os.path.join(self.server.video_dir, video_name)
+            if not os.path.isfile(path):
+                return self.respond(cseq, 404, 'Not Found')
+            self.video = MjpegFile(path)
+            self.rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.rtp_address = (self.client.getpeername()[0], int(port.group(1)))
+            self.session_id = self.random.randint(100000, 999999)
+            self.sequence_number = self.frame_number = 0
+            self.state = self.READY
+            return self.respond(cseq)
+        if method not in ('PLAY', 'PAUSE', 'TEARDOWN'):
+            return self.respond(cseq, 405, 'Method Not Allowed')
+        if self.state == self.INIT:
+            return self.respond(cseq, 455, 'Method Not Valid In This State')
+        # a PLAY pipelined right after SETUP may come without a Session header
+        if headers.get('session', str(self.session_id)) != str(self.session_id):
+            return self.respond(cseq, 454, 'Session Not Found')
+        if method == 'PLAY':
+            if self.state != self.READY:
+                return self.respond(cseq, 455, 'Method Not Valid In This State')
+            extra_headers = None
+            if 'range' in headers:
+                start = self.parse_range(headers['range'])
+                if start is None:
+                    return self.respond(cseq, 457, 'Invalid Range')
+                self.frame_number = self.video.frame_number_at(start)
+                extra_headers = {'Range': f'npt={self.video.timestamp(self.frame_number) / 1000:.3f}-'}
+            self.state = self.PLAYING
+            self.respond(cseq, extra_headers=extra_headers)
+            self.start_sending()
+        elif method == 'PAUSE':
+            if self.state != self.PLAYING:
+                return self.respond(cseq, 455, 'Method Not Valid In This State')
+            self.stop_sending()
+            self.state = self.READY
+            self.respond(cseq)
+        else:
+            self.stop_sending()
+            self.respond(cseq)
+            self.close_stream()
+
+    def parse_range(self, value):
+        '''Returns the start, in milliseconds, of an npt Range header such as
+        npt=12.5- (or npt=now- for the current position), or None if it is
+        not valid.
+        '''
+        match = re.fullmatch(r'npt\s*=\s*(now|\d+(?:\.\d*)?)\s*-\s*(\d+(?:\.\d*)?)?', value)
+        if not match:
+            return None
+        if match.group(1) == 'now':
+            return self.video.timestamp(self.frame_number)
+        start = int(float(match.group(1)) * 1000)
+        return start if start <= self.video.duration else None
+
+    def start_sending(self):
+        self.stop_event.clear()
+        self.sender = threading.Thread(target=self.send_frames, daemon=True)
+        self.sender.start()
+
+    def stop_sending(self):
+        self.stop_event.set()
+        if self.sender is not None and self.sender is not threading.current_thread():
+            self.sender.join()
+        self.sender = None
+
+    def close_stream(self):
+        if self.video is not None:
+            self.video.close()
+            self.video = None
+        if self.rtp_socket is not None:
+            self.rtp_socket.close()
+            self.rtp_socket = None
+        self.session_id = None
+        self.state = self.INIT
+
+    def close(self):
+        self.stop_sending()
+        self.close_stream()
+        self.client.close()
+
+    def next_frame(self):
+        if self.frame_number >= len(self.video):
+            return None
+        return self.video.frame(self.frame_number)
+
+    def packetize(self, frame, timestamp):
+        max_payload = self.server.max_payload
+        chunks = [frame[i:i + max_payload] for i in range(0, len(frame), max_payload)] or [b'']
+        packets = []
+        for i, chunk in enumerate(chunks):
+            marker = 0x80 if i == len(chunks) - 1 else 0
+            header = struct.pack('!BBHII', 0x80, marker | 26, self.sequence_number, timestamp,
+                                 self.session_id)
+            self.sequence_number = (self.sequence_number + 1) & 0xffff
+            packets.append(header + chunk)
+        return packets
+
+    def send_frames(self):
+        '''Reads frames at the scenario rate and schedules their packets,
+        applying the configured impairments.
+        '''
+        imp = self.server.impairment
+        period = self.server.FRAME_PERIOD / 1000. / imp.rate
+        start = time.monotonic() - self.frame_number * period
+        queue = []
+        order = 0
+        frame = self.next_frame()
+        while not self.stop_event.is_set() and (frame is not None or queue):
+            now = time.monotonic()
+            next_frame_time = start + self.frame_number * period
+            if frame is not None and next_frame_time <= now:
+                timestamp = self.frame_number * self.server.FRAME_PERIOD
+                for packet in self.packetize(frame, timestamp):
+                    if self.random.random() < imp.loss:
+                        continue
+                    copies = 2 if self.random.random() < imp.duplicate else 1
+                    for _ in range(copies):
+                        delay = self.random.uniform(0, imp.jitter)
+                        if self.random.random() < imp.reorder:
+                            delay += self.random.uniform(*imp.reorder_delay)
+                        send_time = next_frame_time + delay
+                        if imp.stall_every:
+                            elapsed = (send_time - start) % imp.stall_every
+                            if elapsed < imp.stall_length:
+                                send_time += imp.stall_length - elapsed
+                        heapq.heappush(queue, (send_time, order, packet))
+                        order += 1
+                self.frame_number += 1
+                frame = self.next_frame()
+                continue
+            while queue and queue[0][0] <= now:
+                _, _, packet = heapq.heappop(queue)
+                self.rtp_socket.sendto(packet, self.rtp_address)
+                self.packets_sent += 1
+            wakeup = next_frame_time if frame is not None else float('inf')
+            if queue:
+                wakeup = min(wakeup, queue[0][0])
+            if wakeup > now:
+                self.stop_event.wait(min(wakeup - now, 0.1))
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback RTSP test server with network impairments')
+    parser.add_argument('--port', type=int, default=455)
+    parser.add_argument('--profile', default='NONE', choices=sorted(PROFILES),
+                        help='impairment scenario (FUNKY server A-H)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--video-dir', default='.')
+    parser.add_argument('--max-payload', type=int, default=60000,
+                        help='largest RTP payload; bigger frames are fragmented')
+    args = parser.parse_args()
+    server = RTSPServer(args.port, impairment=PROFILES[args.profile], seed=args.seed,
+                        video_dir=args.video_dir, max_payload=args.max_payload)
+    print(f'Serving {args.video_dir} on port {server.address[1]} (profile {args.profile})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__ == '__main__':
+    main()
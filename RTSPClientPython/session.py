@@ -1,7 +1,13 @@
+import collections
 import io
-from PIL import Image, ImageTk
+import threading
+import time
 
 from rtsp import Connection
+from depacketizer import check_jpeg
+from pipeline import WorkerPool
+from framecache import FrameCache, DecodeCache
+from profiling import FrameLatency
 
 class SessionListener:
     '''Interface for listener methods for session events.'''
@@ -14,8 +20,136 @@ class SessionListener:
     def video_name_changed(self, name):
         pass
 
+    def latency_report(self, report):
+        pass
+
+class DecodeStatistics:
+    '''Time spent decoding frames, shared by the threads decoding them.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.reduced = 0
+        self.total_time = 0.
+        self.max_time = 0.
+
+    def record(self, seconds, reduced):
+        with self.lock:
+            self.frames += 1
+            self.reduced += reduced
+            self.total_time += seconds
+            self.max_time = max(self.max_time, seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'frames': self.frames,
+                'reduced': self.reduced,
+                'mean_ms': 1000 * self.total_time / self.frames if self.frames else 0.,
+                'max_ms': 1000 * self.max_time,
+                'total_time': self.total_time,
+            }
+
+class Concealment:
+    '''Checks the structure of each JPEG payload before it is decoded (see
+    depacketizer.check_jpeg) and hides the frames that fail, or that the
+    decoder rejects, according to the policy:
+    - HOLD: the last good frame is delivered again in place of the bad one;
+    - SKIP: nothing is delivered until the next good frame;
+    - DECODE: payloads are not checked and decoding errors are reported
+      as exceptions, as if there were no concealment.
+    A run of bad frames up to the next good one is a concealed interval,
+    whose length in media time is added to concealed_ms.
+    '''
+    HOLD = 'hold'
+    SKIP = 'skip'
+    DECODE = 'decode'
+    POLICIES = (HOLD, SKIP, DECODE)
+    DECODE_ERROR = 'decode error'
+
+    def __init__(self, policy=HOLD):
+        self.lock = threading.Lock()
+        self.set_policy(policy)
+        self.last_good = None
+        self.concealing_since = None
+        self.checked = 0
+        self.check_time = 0.
+        self.reasons = collections.Counter()
+        self.intervals = 0
+        self.concealed_ms = 0
+        self.held = 0
+
+    def set_policy(self, policy):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown concealment policy: {policy}')
+        self.policy = policy
+
+    @property
+    def enabled(self):
+        return self.policy != self.DECODE
+
+    def check(self, frame):
+        '''Returns the reason why the payload of a frame cannot be decoded,
+        or None if it looks valid.
+        '''
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        reason = check_jpeg(frame.payload)
+        with self.lock:
+            self.checked += 1
+            self.check_time += time.perf_counter() - start
+        return reason
+
+    def accept(self, frame):
+        '''Records a good frame, ending the concealed interval, if any.'''
+        with self.lock:
+            if self.concealing_since is not None:
+                self.concealed_ms += (frame.timestamp - self.concealing_since) & 0xffffffff
+                self.concealing_since = None
+            self.last_good = frame
+
+    def reject(self, frame, reason):
+        '''Records a bad frame. Returns the frame to deliver in its place,
+        or None.
+        '''
+        with self.lock:
+            self.reasons[reason] += 1
+            if self.concealing_since is None:
+                self.intervals += 1
+                self.concealing_since = frame.timestamp
+            if self.policy != self.HOLD or self.last_good is None:
+                return None
+            self.held += 1
+            return self.last_good.copy(frame)
+
+    def reset(self):
+        '''Forgets the last good frame, for a new video.'''
+        with self.lock:
+            self.last_good = None
+            self.concealing_since = None
+
+    def stats(self, mean_decode_ms=0.):
+        '''Returns the counters; decode_ms_saved estimates the decoding time
+        not spent on frames rejected before decoding, from the mean decode
+        time.
+        '''
+        with self.lock:
+            rejected = sum(self.reasons.values())
+            return {
+                'policy': self.policy,
+                'checked': self.checked,
+                'rejected': rejected,
+                'reasons': dict(self.reasons),
+                'held': self.held,
+                'intervals': self.intervals,
+                'concealed_ms': self.concealed_ms,
+                'check_ms': 1000 * self.check_time,
+                'decode_ms_saved': (rejected - self.reasons[self.DECODE_ERROR]) * mean_decode_ms,
+            }
+
 class VideoFrame:
-    def __init__(self, payload_type, marker, sequence_number, timestamp, payload):
+    def __init__(self, payload_type, marker, sequence_number, timestamp, payload, release=None,
+                 arrival=None, completed=None):
         '''Creates a new frame.
 	- payload_type: The numeric type of payload found in the frame. The most
 	  common type is 26 (JPEG).
@@ -27,27 +161,129 @@ class VideoFrame:
 	- timestamp: The number of milliseconds after the logical start of the
 	  stream when this frame is expected to be played.
 	- payload: A byte array containing the payload (contents) of the frame.
+	  It may be a memoryview into a receive buffer, valid until release()
+	  is called.
+	- release: Optional function returning the receive buffer to its pool.
+	- arrival: Monotonic time at which the first packet of the frame was
+	  received, if known.
+	- completed: Monotonic time at which the last packet of the frame was
+	  received, if known.
         '''
         self.payload_type = payload_type
         self.marker = marker
         self.sequence_number = sequence_number
         self.timestamp = timestamp
         self.payload = payload
+        self.image = None
+        self.release_buffer = release
+        self.arrival = arrival
+        self.completed = completed
+        self.released = None
+        self.decoded = None
+        self.rendered = None
+        self.decode_size = None
+        self.decode_statistics = None
+
+    def decode(self):
+        '''Decodes the JPEG payload into a PIL Image. This does not touch Tk,
+        so it can run on any thread; the result is kept for get_image.
+
+        If decode_size is set to a (width, height) tuple, the JPEG decoder
+        is put in draft mode, so that it scales the image down by 1/2, 1/4
+        or 1/8 while decoding, and the result is then reduced to fit in
+        that size. The decode time is recorded in decode_statistics.
+        '''
+        if self.image is None:
+            # imported on first use, so sessions that never decode do not
+            # load Pillow
+            from PIL import Image
+            start = time.perf_counter()
+            image = Image.open(io.BytesIO(self.payload))
+            size = self.decode_size
+            reduced = size is not None and (image.size[0] > size[0] or image.size[1] > size[1])
+            if reduced:
+                image.draft('RGB', size)
+            image.load()
+            if reduced:
+                image.thumbnail(size)
+            self.image = image
+            if self.decode_statistics is not None:
+                self.decode_statistics.record(time.perf_counter() - start, reduced)
+        return self.image
+
+    def copy(self, like=None):
+        '''Returns a new frame with the decoded image of this one (or its
+        payload, if it was not decoded), without timing information. If
+        like is given, the new frame takes its sequence number and
+        timestamp, to stand in for it.
+        '''
+        header = like if like is not None else self
+        copy = VideoFrame(self.payload_type, self.marker, header.sequence_number,
+                          header.timestamp, self.payload if self.image is None else None)
+        copy.image = self.image
+        copy.decode_size = self.decode_size
+        copy.decode_statistics = self.decode_statistics
+        return copy
+
+    def detach(self):
+        '''Copies the payload out of the receive buffer and releases the
+        buffer, so that the frame can still be decoded later.
+        '''
+        if self.release_buffer is not None and self.payload is not None:
+            self.payload = bytes(self.payload)
+            self.release_buffer()
+            self.release_buffer = None
+
+    def release(self):
+        '''Releases the receive buffer holding the payload. The payload cannot
+        be used after this point, but a decoded image remains available.
+        '''
+        if self.release_buffer is not None:
+            self.release_buffer()
+            self.release_buffer = None
+            self.payload = None
 
     def get_image(self):
         '''Creates an Image based on the payload of the frame.'''
-        image = Image.open(io.BytesIO(self.payload))
-        return ImageTk.PhotoImage(image)
+        from PIL import ImageTk
+        return ImageTk.PhotoImage(self.decode())
     
 class Session:
-    def __init__(self, address):
+    DECODE_WORKERS = 2
+    DECODE_QUEUE_LENGTH = 4
+
+    def __init__(self, address, decode_workers=DECODE_WORKERS, connection_class=Connection,
+                 decoder=None, decode_size=None, decode_ahead=True):
         '''Creates a new RTSP session. This constructor will also create a
         new network connection with the server. No stream setup is
-        established at this point.
+        established at this point. Frames are decoded by a pool of
+        decode_workers threads before reaching the listeners, or directly
+        on the receiving thread if decode_workers is 0. A pool created by
+        decoder_pool() may be given instead, to share it between sessions.
+
+        Frames are decoded to fit in decode_size (a (width, height) tuple,
+        see set_decode_size), or at full resolution if it is None. If
+        decode_ahead is False, frames reach the listeners undecoded and
+        are only decoded by get_image, so frames that are never shown are
+        never decoded.
         '''
-        self.connection = Connection(self, address)
+        self.connection = connection_class(self, address)
+        self.decode_size = decode_size
+        self.decode_ahead = decode_ahead
+        self.decode_statistics = DecodeStatistics()
+        self.frame_latency = None
+        self.frame_cache = None
+        self.decode_cache = None
+        self.concealment = Concealment()
         self.video_name = None
         self.listeners = []
+        self.submitted = 0
+        self.last_delivered = 0
+        self.delivery_lock = threading.Lock()
+        self.owns_decoder = decoder is None and decode_workers > 0
+        if self.owns_decoder:
+            decoder = decoder_pool(decode_workers, self.DECODE_QUEUE_LENGTH)
+        self.decoder = decoder
 
     def add_listener(self, listener):
         '''Adds a new listener interface to be called every time a session
@@ -58,11 +294,20 @@ class Session:
         self.listeners.append(listener)
         listener.video_name_changed(self.video_name)
 
-    def open(self, video_name):
-        '''Opens a new video file in the interface.'''
+    def remove_listener(self, listener):
+        '''Stops notifying a listener added by add_listener.'''
+        self.listeners.remove(listener)
+
+    def open(self, video_name, play=False):
+        '''Opens a new video file in the interface. If play is True, playback
+        starts right away, with the PLAY request pipelined behind SETUP.
+        '''
         try:
-            self.video_name = video_name
-            self.connection.setup(self.video_name)
+            self.reset_video(video_name)
+            if play:
+                self.connection.setup_and_play(self.video_name)
+            else:
+                self.connection.setup(self.video_name)
             for l in self.listeners:
                 l.video_name_changed(video_name)
         except Exception as exception:
@@ -93,13 +338,45 @@ class Session:
         except Exception as exception:
             self.handle_exception(exception)
 
+    def seek(self, position):
+        '''Moves playback to position seconds from the start of the video.
+        If the frame at that position is in the frame cache, it is shown
+        right away, without waiting for the server or decoding, so that
+        short rewinds and scrubbing while paused are instant. The
+        connection is then moved to the position (for RTSP, with a Range
+        header on the next PLAY). If it cannot seek, the cached frame is
+        all that is shown.
+        '''
+        try:
+            timestamp = int(position * 1000)
+            cached = None
+            if self.frame_cache is not None:
+                cached = self.frame_cache.frame_at(timestamp)
+            if cached is not None:
+                self.show_cached(cached)
+            seek = getattr(self.connection, 'seek', None)
+            if (seek is None or not seek(timestamp)) and cached is None:
+                raise Exception('Seeking is not supported by this connection')
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    def show_cached(self, frame):
+        '''Delivers a copy of a cached frame to the listeners. Frames still
+        being decoded for the previous position are discarded.
+        '''
+        copy = frame.copy()
+        with self.delivery_lock:
+            self.last_delivered = self.submitted
+            for l in self.listeners:
+                l.frame_received(copy)
+
     def teardown(self):
         '''Closes the currently open file. It should only be called once a
 	file has been open.
         '''
         try:
             self.connection.teardown()
-            self.video_name = None
+            self.reset_video(None)
             for l in self.listeners:
                 l.frame_received(None)
                 l.video_name_changed(None)
@@ -112,12 +389,75 @@ class Session:
         '''
         try:
             self.connection.close()
+            if self.owns_decoder:
+                self.decoder.close(join=False)
             for l in self.listeners:
                 l.video_name_changed(None)
                 l.frame_received(None)
         except Exception as exception:
             self.handle_exception(exception)
 
+    def reset_video(self, video_name):
+        '''Switches to another video (None once torn down), dropping the
+        frames cached for the previous one, whose timestamps would match
+        other frames of the new video, and the frame held by concealment.
+        '''
+        self.video_name = video_name
+        if self.frame_cache is not None:
+            self.frame_cache.clear()
+        self.concealment.reset()
+
+    def set_decode_size(self, size):
+        '''Sets the largest size, as a (width, height) tuple, at which
+        following frames are decoded; None decodes them at full resolution.
+        This is normally the size of the widget showing the video.
+        '''
+        self.decode_size = size
+
+    def set_concealment(self, policy):
+        '''Sets how frames with an invalid payload are hidden: by showing
+        the last good frame again (Concealment.HOLD, the default), by
+        skipping them (SKIP), or not at all (DECODE).
+        '''
+        self.concealment.set_policy(policy)
+
+    def enable_latency(self, interval=5., output=None):
+        '''Starts measuring the latency of each stage a frame goes through.
+        Every interval seconds the statistics are passed to the
+        latency_report method of the listeners and, if output is a file,
+        written to it. Renderers report shown frames with frame_rendered.
+        '''
+        self.frame_latency = FrameLatency(self.report_latency, interval, output)
+        return self.frame_latency
+
+    def enable_frame_cache(self, max_bytes=FrameCache.MAX_BYTES):
+        '''Keeps up to max_bytes bytes of recently decoded frames, used by
+        seek and to avoid decoding frames played again. Only frames decoded
+        by the session (with decode_ahead) are cached.
+        '''
+        self.frame_cache = FrameCache(max_bytes)
+        return self.frame_cache
+
+    def enable_decode_cache(self, max_entries=DecodeCache.MAX_ENTRIES,
+                            max_bytes=DecodeCache.MAX_BYTES, shared=None):
+        '''Reuses the decoded image of any recent frame with an identical
+        payload instead of decoding it again. shared may be a DecodeCache
+        already used by other sessions; otherwise one holding up to
+        max_entries images and max_bytes bytes is created.
+        '''
+        self.decode_cache = shared if shared is not None else DecodeCache(max_entries, max_bytes)
+        return self.decode_cache
+
+    def report_latency(self, report):
+        for l in self.listeners:
+            l.latency_report(report)
+
+    def frame_rendered(self, frame):
+        '''Called by renderers once a frame has been shown.'''
+        if self.frame_latency is not None:
+            frame.rendered = time.monotonic()
+            self.frame_latency.frame_rendered(frame)
+
     def handle_exception(self, exception):
         '''Helper function that notifies the main window that an exception has
         happened.
@@ -125,13 +465,211 @@ class Session:
         for l in self.listeners:
             l.exception_thrown(exception)
         
-    def process_frame(self, payload_type, marker, sequence_number, timestamp, payload):
+    def process_frame(self, payload_type, marker, sequence_number, timestamp, payload, release=None,
+                      arrival=None, completed=None):
         '''Creates and processes a frame received from the RTSP server. This
 	method will direct the frame to the user interface to be
 	processed and presented to the user. A description of the
 	parameters can be found on the VideoFrame class comments.
         '''
-        frame = VideoFrame(payload_type, marker, sequence_number, timestamp, payload)
-        if (self.video_name):
+        frame = VideoFrame(payload_type, marker, sequence_number, timestamp, payload, release, arrival,
+                           completed)
+        if self.frame_latency is not None:
+            frame.released = time.monotonic()
+        frame.decode_size = self.decode_size
+        frame.decode_statistics = self.decode_statistics
+        if not self.video_name:
+            frame.release()
+            return
+        self.submitted += 1
+        if self.decoder is None:
+            self.decode_frame(self.submitted, frame)
+        else:
+            self.decoder.submit((self, self.submitted, frame))
+
+    def decode_frame(self, order, frame):
+        '''Decode stage: runs on the decoder pool and passes the decoded frame
+        to the listeners. Frames finishing after a newer one has already
+        been delivered are discarded, and are not decoded if that is already
+        known before decoding. Frames whose payload is invalid, or fails to
+        decode, are replaced or dropped by the concealment policy. Listeners
+        keeping the payload beyond frame_received must copy it, as its
+        buffer is then reused.
+        '''
+        try:
+            if order <= self.last_delivered:
+                return
+            reason = self.concealment.check(frame)
+            if reason is None:
+                try:
+                    if self.decode_ahead:
+                        self.decode_cached(frame)
+                    else:
+                        frame.detach()
+                except (OSError, SyntaxError):
+                    if not self.concealment.enabled:
+                        raise
+                    reason = Concealment.DECODE_ERROR
+            if reason is None:
+                self.concealment.accept(frame)
+                delivered = frame
+                if self.frame_latency is not None:
+                    frame.decoded = time.monotonic()
+                    self.frame_latency.frame_decoded(frame)
+            else:
+                delivered = self.concealment.reject(frame, reason)
+                if delivered is None:
+                    return
+            with self.delivery_lock:
+                if order <= self.last_delivered or not self.video_name:
+                    return
+                self.last_delivered = order
+                for l in self.listeners:
+                    l.frame_received(delivered)
+        except Exception as exception:
+            self.handle_exception(exception)
+        finally:
+            frame.release()
+
+    def decode_cached(self, frame):
+        '''Decodes a frame, unless a frame with the same timestamp is in the
+        frame cache or one with the same payload is in the decode cache,
+        and returns its image. Frames that already have an image, such as
+        copies of a held or cached frame, which have no payload, are
+        returned as they are.
+        '''
+        if frame.image is not None:
+            return frame.image
+        if self.frame_cache is not None:
+            cached = self.frame_cache.get(frame.timestamp, frame.decode_size)
+            if cached is not None:
+                frame.image = cached.image
+                return frame.image
+        key = None
+        if self.decode_cache is not None and frame.payload is not None:
+            key = self.decode_cache.key(frame.payload, frame.decode_size)
+            frame.image = self.decode_cache.get(key)
+        if frame.image is None:
+            frame.decode()
+            if key is not None:
+                self.decode_cache.put(key, frame.image)
+        if self.frame_cache is not None:
+            self.frame_cache.put(frame)
+        return frame.image
+
+    def image_to_show(self, frame):
+        '''Returns the image a renderer should show for a delivered frame,
+        decoding it if that was not done yet. A frame that fails to decode
+        is replaced according to the concealment policy, as on the decoder
+        pool; None means nothing should be shown.
+        '''
+        try:
+            return frame.decode()
+        except (OSError, SyntaxError):
+            if not self.concealment.enabled:
+                raise
+            held = self.concealment.reject(frame, Concealment.DECODE_ERROR)
+            return held.decode() if held is not None else None
+
+    def get_statistics(self):
+        '''Returns the current receive statistics of the stream (packet
+        loss, reordering, jitter, frame rate and bitrate) and the round-trip
+        time of control requests as a dictionary.
+        '''
+        statistics = self.connection.statistics.snapshot()
+        statistics['control_latency'] = self.connection.latency.stats()
+        return statistics
+
+    def pipeline_stats(self):
+        '''Returns the depth and drop counters of each pipeline queue.'''
+        stats = self.connection.pipeline_stats()
+        stats['decoder'] = self.decoder.stats() if self.decoder else {}
+        stats['decode'] = self.decode_statistics.stats()
+        stats['concealment'] = self.concealment.stats(stats['decode']['mean_ms'])
+        if self.frame_cache is not None:
+            stats['frame_cache'] = self.frame_cache.stats()
+        if self.decode_cache is not None:
+            stats['decode_cache'] = self.decode_cache.stats()
+        if self.frame_latency is not None:
+            stats['latency'] = self.frame_latency.stats()
+        return stats
+
+def decoder_pool(workers=Session.DECODE_WORKERS, capacity=Session.DECODE_QUEUE_LENGTH):
+    '''Creates a pool of decoding threads that can be shared by several
+    sessions.
+    '''
+    return WorkerPool(run_decode, workers, capacity, name='decoder', on_drop=drop_decode)
+
+def run_decode(item):
+    session, order, frame = item
+    session.decode_frame(order, frame)
+
+def drop_decode(item):
+    '''Releases the frame of a decode request dropped from a full queue.'''
+    session, order, frame = item
+    frame.release()
+
+class AsyncSession(Session):
+    '''Session running on an asyncio event loop on top of AsyncConnection.
+    Listeners are notified exactly as with Session, from the event loop
+    thread (or the decoder pool, if any). The operations are coroutines,
+    and the server connection is only made by connect(). By default frames
+    are decoded inline, so that each session needs no thread of its own.
+    '''
+    def __init__(self, address, decode_workers=0, decoder=None, decode_size=None,
+                 decode_ahead=True):
+        from asyncrtsp import AsyncConnection
+        super().__init__(address, decode_workers, AsyncConnection, decoder, decode_size,
+                         decode_ahead)
+
+    async def connect(self):
+        '''Establishes the connection with the server.'''
+        try:
+            await self.connection.connect()
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    async def open(self, video_name, play=False):
+        try:
+            self.reset_video(video_name)
+            if play:
+                await self.connection.setup_and_play(self.video_name)
+            else:
+                await self.connection.setup(self.video_name)
             for l in self.listeners:
-                l.frame_received(frame)
+                l.video_name_changed(video_name)
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    async def play(self):
+        try:
+            await self.connection.play()
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    async def pause(self):
+        try:
+            await self.connection.pause()
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    async def teardown(self):
+        try:
+            await self.connection.teardown()
+            self.reset_video(None)
+            for l in self.listeners:
+                l.frame_received(None)
+                l.video_name_changed(None)
+        except Exception as exception:
+            self.handle_exception(exception)
+
+    async def close(self):
+        try:
+            await self.connection.close()
+            if self.owns_decoder:
+                self.decoder.close(join=False)
+            for l in self.listeners:
+                l.video_name_changed(None)
+                l.frame_received(None)
+        except Exception as exception:
+            self.handle_exception(exception)
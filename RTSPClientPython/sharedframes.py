@@ -0,0 +1,247 @@
+#! /usr/bin/python3
+
+'''Fan-out of decoded frames to local viewer processes through shared memory.
+
+A FramePublisher, added as a listener of a Session, writes every decoded
+frame into a ring of slots in a multiprocessing.shared_memory block, so
+that any number of FrameReader objects in other processes can show the
+stream without their own connection or decoding.
+
+Layout: a header (magic, slot count, slot size and the count of frames
+published so far), followed by the slots. Each slot starts with a
+generation counter, the frame sequence number, RTP timestamp, width,
+height, number of bands and pixel data length, followed by the pixels.
+The generation is odd while the slot is being written and is increased
+again once it is complete, so readers never lock: they check that the
+generation did not change while they read the slot, and retry
+otherwise.
+'''
+
+import argparse
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+from session import Session, SessionListener
+
+MAGIC = b'SFRB'
+HEADER = struct.Struct('<4sIIIQ')
+WRITE_INDEX = 16 # offset of the published frame count in HEADER
+SLOT_HEADER = struct.Struct('<QIIIIII')
+SLOT_ALIGNMENT = 64
+MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+def slot_stride(slot_size):
+    stride = SLOT_HEADER.size + slot_size
+    return (stride + SLOT_ALIGNMENT - 1) // SLOT_ALIGNMENT * SLOT_ALIGNMENT
+
+def slot_offset(slot, slot_size):
+    return SLOT_ALIGNMENT + slot * slot_stride(slot_size)
+
+class FramePublisher(SessionListener):
+    '''Session listener publishing decoded frames into a shared memory
+    ring. Slots hold frames of up to max_width x max_height pixels; larger
+    frames are skipped, so the session should decode at most at that size
+    (see Session.set_decode_size).
+    '''
+    SLOTS = 4
+
+    def __init__(self, name=None, max_width=640, max_height=480, slots=SLOTS):
+        self.slots = slots
+        self.slot_size = max_width * max_height * 3
+        size = slot_offset(slots, self.slot_size)
+        self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = self.memory.name
+        HEADER.pack_into(self.memory.buf, 0, MAGIC, slots, self.slot_size, 0, 0)
+        self.published = 0
+        self.oversized = 0
+
+    def frame_received(self, frame):
+        if frame is None:
+            return
+        image = frame.decode()
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        data = image.tobytes()
+        if len(data) > self.slot_size:
+            self.oversized += 1
+            return
+        self.publish(frame.sequence_number, frame.timestamp, image.size, len(image.getbands()),
+                     data)
+
+    def publish(self, sequence_number, timestamp, size, bands, data):
+        '''Writes a frame into the next slot and makes it the latest one.'''
+        buf = self.memory.buf
+        offset = slot_offset(self.published % self.slots, self.slot_size)
+        generation = 2 * self.published
+        struct.pack_into('<Q', buf, offset, generation + 1)
+        start = offset + SLOT_HEADER.size
+        buf[start:start + len(data)] = data
+        SLOT_HEADER.pack_into(buf, offset, generation + 1, sequence_number, timestamp,
+                              size[0], size[1], bands, len(data))
+        struct.pack_into('<Q', buf, offset, generation + 2)
+        self.published += 1
+        struct.pack_into('<Q', buf, WRITE_INDEX, self.published)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+class SharedFrame:
+    '''A frame read from the ring. data is a memoryview of the pixels in
+    shared memory, valid only as long as valid() returns True: the
+    publisher may overwrite the slot at any time.
+    '''
+    def __init__(self, reader, index, generation, header, data):
+        self.reader = reader
+        self.index = index
+        self.generation = generation
+        _, self.sequence_number, self.timestamp, width, height, bands, _ = header
+        self.size = (width, height)
+        self.mode = MODES.get(bands, 'RGB')
+        self.data = data
+
+    def valid(self):
+        return self.reader.generation(self.index) == self.generation
+
+    def image(self):
+        '''Returns a copy of the frame as a PIL Image, or None if the slot
+        was overwritten while it was copied.
+        '''
+        from PIL import Image
+        image = Image.frombytes(self.mode, self.size, bytes(self.data))
+        return image if self.valid() else None
+
+class FrameReader:
+    '''Reads the latest frame published in a shared memory ring, without
+    locks. overruns counts reads that found their slot being overwritten
+    and had to be retried; missed counts frames that were published but
+    never returned by latest().
+    '''
+    RETRIES = 8
+
+    def __init__(self, name):
+        try:
+            self.memory = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13, the resource tracker would unlink the
+            # publisher's memory when this process exits
+            self.memory = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        magic, self.slots, self.slot_size, _, _ = HEADER.unpack_from(self.memory.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{name} is not a shared frame ring')
+        self.last_index = 0
+        self.frames_read = 0
+        self.overruns = 0
+        self.missed = 0
+
+    def published(self):
+        return struct.unpack_from('<Q', self.memory.buf, WRITE_INDEX)[0]
+
+    def generation(self, index):
+        offset = slot_offset(index % self.slots, self.slot_size)
+        return struct.unpack_from('<Q', self.memory.buf, offset)[0]
+
+    def latest(self):
+        '''Returns the most recent complete frame as a SharedFrame, or None
+        if no new frame was published since the previous call.
+        '''
+        for _ in range(self.RETRIES):
+            published = self.published()
+            if published == self.last_index:
+                return None
+            index = published - 1
+            offset = slot_offset(index % self.slots, self.slot_size)
+            header = SLOT_HEADER.unpack_from(self.memory.buf, offset)
+            generation = 2 * index + 2
+            if header[0] != generation:
+                self.overruns += 1
+                continue
+            start = offset + SLOT_HEADER.size
+            data = self.memory.buf[start:start + header[6]]
+            # the header copy is consistent only if no write started meanwhile
+            if self.generation(index) != generation:
+                data.release()
+                self.overruns += 1
+                continue
+            if self.frames_read:
+                self.missed += index - self.last_index
+            self.frames_read += 1
+            self.last_index = published
+            return SharedFrame(self, index, generation, header, data)
+        return None
+
+    def stats(self):
+        return {'published': self.published(), 'read': self.frames_read,
+                'overruns': self.overruns, 'missed': self.missed}
+
+    def close(self):
+        try:
+            self.memory.close()
+        except BufferError:
+            pass # frames still referenced; the mapping is released with them
+
+def publish(args):
+    session = Session((args.host, args.port))
+    session.set_decode_size((args.width, args.height))
+    publisher = FramePublisher(args.name, args.width, args.height)
+    session.add_listener(publisher)
+    print(f'Publishing to shared memory {publisher.name}', flush=True)
+    session.open(args.video, play=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.teardown()
+        session.close()
+        publisher.close()
+
+def view(args):
+    import tkinter as tk
+    from PIL import ImageTk
+    reader = FrameReader(args.name)
+    window = tk.Tk()
+    window.title(f'Shared frames: {args.name}')
+    label = tk.Label(window)
+    label.pack()
+    photo = None
+
+    def render():
+        nonlocal photo
+        frame = reader.latest()
+        image = frame.image() if frame is not None else None
+        if image is not None:
+            if photo is not None and (photo.width(), photo.height()) == image.size:
+                photo.paste(image)
+            else:
+                photo = ImageTk.PhotoImage(image)
+                label['image'] = photo
+        window.after(10, render)
+
+    window.after(10, render)
+    window.mainloop()
+    reader.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Share decoded frames between processes')
+    commands = parser.add_subparsers(dest='command', required=True)
+    publisher = commands.add_parser('publish', help='play a stream and publish its frames')
+    publisher.add_argument('host')
+    publisher.add_argument('port', type=int)
+    publisher.add_argument('--video', default='movie1.Mjpeg')
+    publisher.add_argument('--name', help='shared memory name (default: generated)')
+    publisher.add_argument('--width', type=int, default=640)
+    publisher.add_argument('--height', type=int, default=480)
+    viewer = commands.add_parser('view', help='show the frames published under a name')
+    viewer.add_argument('name')
+    args = parser.parse_args()
+    if args.command == 'publish':
+        publish(args)
+    else:
+        view(args)
+
+if __name__ == '__main__':
+    main()
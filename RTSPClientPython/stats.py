@@ -0,0 +1,179 @@
+import collections
+import time
+
+class StreamStatistics:
+    '''Receive statistics for an RTP stream, kept in constant memory.
+
+    Sequence numbers are extended to 32 bits to survive wraparound, and
+    loss, reordering and interarrival jitter are computed as described
+    in RFC 3550 (appendix A). Duplicates are detected within the last
+    DUPLICATE_WINDOW sequence numbers. Frame rate and bitrate are measured
+    over a sliding window of at most RATE_SAMPLES recent arrivals.
+
+    A packet at most max_misorder sequence numbers older than the highest
+    one seen is counted as reordered; an older one is taken as a restart
+    of the sender. RFC 3550 suggests 100, but frames fragmented into many
+    packets go past that in well under a second of delay, so the default
+    is larger. It must be below DUPLICATE_WINDOW.
+    '''
+    SEQ_MOD = 1 << 16
+    MAX_DROPOUT = 3000
+    MAX_MISORDER = 1000
+    DUPLICATE_WINDOW = 1024
+    RATE_SAMPLES = 512
+
+    def __init__(self, clock_rate=1000, rate_window=2., max_misorder=MAX_MISORDER):
+        if not 0 < max_misorder < self.DUPLICATE_WINDOW:
+            raise ValueError(f'max_misorder must be positive and below {self.DUPLICATE_WINDOW}')
+        self.clock_rate = clock_rate
+        self.rate_window = rate_window
+        self.max_misorder = max_misorder
+        self.reset()
+
+    def reset(self):
+        self.start_time = None
+        self.last_arrival = None
+        self.base_seq = None
+        self.max_seq = 0
+        self.cycles = 0
+        self.bad_seq = None
+        self.received = 0
+        self.bytes_received = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.seen = 0 # bitmap of received sequence numbers below max_seq
+        self.jitter = 0.
+        self.last_transit = None
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.packet_times = collections.deque(maxlen=self.RATE_SAMPLES)
+        self.frame_times = collections.deque(maxlen=self.RATE_SAMPLES)
+        self.frames = 0
+
+    @property
+    def extended_max(self):
+        return self.cycles + self.max_seq
+
+    @property
+    def expected(self):
+        if self.base_seq is None:
+            return 0
+        return self.extended_max - self.base_seq + 1
+
+    @property
+    def lost(self):
+        '''Cumulative number of packets lost (never negative).'''
+        return max(0, self.expected - self.received)
+
+    def packet_received(self, seq, timestamp, size, arrival=None):
+        '''Updates the statistics with a packet received at the given
+        monotonic arrival time.
+        '''
+        if arrival is None:
+            arrival = time.monotonic()
+        if self.base_seq is None:
+            self.start_time = arrival
+            self.base_seq = seq
+            self.max_seq = seq
+            self.seen = 1
+        else:
+            delta = (seq - self.max_seq) % self.SEQ_MOD
+            if delta == 0:
+                self.duplicates += 1
+                return
+            if delta < self.MAX_DROPOUT:
+                # in order, possibly with a gap
+                if seq < self.max_seq:
+                    self.cycles += self.SEQ_MOD
+                self.max_seq = seq
+                self.seen = ((self.seen << delta) | 1) & ((1 << self.DUPLICATE_WINDOW) - 1)
+            elif self.SEQ_MOD - delta <= self.max_misorder:
+                # older than the highest sequence number seen
+                bit = 1 << (self.SEQ_MOD - delta)
+                if self.seen & bit:
+                    self.duplicates += 1
+                    return
+                self.seen |= bit
+                self.reordered += 1
+            elif seq == self.bad_seq:
+                # two sequential packets after a large jump: the sender
+                # restarted, so resynchronise
+                self.cycles = 0
+                self.base_seq = self.max_seq = seq
+                self.received = 0
+                self.expected_prior = self.received_prior = 0
+                self.seen = 1
+            else:
+                self.bad_seq = (seq + 1) % self.SEQ_MOD
+                return
+
+        self.received += 1
+        self.bytes_received += size
+        self.packet_times.append((arrival, size))
+        self.last_arrival = arrival
+
+        transit = arrival * self.clock_rate - timestamp
+        if self.last_transit is not None:
+            d = abs(transit - self.last_transit)
+            self.jitter += (d - self.jitter) / 16.
+        self.last_transit = transit
+
+    def frame_completed(self, arrival=None):
+        '''Records a complete frame for the frame rate.'''
+        if arrival is None:
+            arrival = time.monotonic()
+        self.frames += 1
+        self.frame_times.append(arrival)
+
+    def interval_loss(self):
+        '''Returns the fraction of packets lost since the previous call, as
+        used in RTCP receiver reports.
+        '''
+        expected_interval = self.expected - self.expected_prior
+        received_interval = self.received - self.received_prior
+        self.expected_prior = self.expected
+        self.received_prior = self.received
+        lost_interval = expected_interval - received_interval
+        if expected_interval <= 0 or lost_interval <= 0:
+            return 0.
+        return lost_interval / expected_interval
+
+    def window_rates(self, now=None):
+        '''Returns (packets per second, bits per second, frames per second)
+        over the sliding window.
+        '''
+        if now is None:
+            now = time.monotonic()
+        start = now - self.rate_window
+        # the receive path appends while other threads read the statistics:
+        # list() copies a deque in one step, where iterating it could fail
+        packets = [size for t, size in list(self.packet_times) if t >= start]
+        frames = sum(1 for t in list(self.frame_times) if t >= start)
+        span = min(self.rate_window, now - self.start_time) if self.start_time is not None else 0
+        if span <= 0:
+            return 0., 0., 0.
+        return len(packets) / span, 8 * sum(packets) / span, frames / span
+
+    def snapshot(self, now=None):
+        '''Returns all statistics as a dictionary.'''
+        if now is None:
+            now = time.monotonic()
+        packet_rate, bitrate, frame_rate = self.window_rates(now)
+        elapsed = now - self.start_time if self.start_time is not None else 0.
+        return {
+            'packets_received': self.received,
+            'packets_expected': self.expected,
+            'packets_lost': self.lost,
+            'loss_fraction': self.lost / self.expected if self.expected else 0.,
+            'loss_rate': self.lost / elapsed if elapsed else 0.,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'jitter_ms': 1000. * self.jitter / self.clock_rate,
+            'frames': self.frames,
+            'frame_rate': frame_rate,
+            'packet_rate': packet_rate,
+            'bitrate': bitrate,
+            'bytes_received': self.bytes_received,
+            'elapsed': elapsed,
+            'duration': self.last_arrival - self.start_time if self.last_arrival is not None else 0.,
+        }
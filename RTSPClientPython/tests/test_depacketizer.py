@@ -0,0 +1,157 @@
+import pytest
+
+from depacketizer import JpegDepacketizer, check_jpeg
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+def segment(marker, body):
+    return bytes([0xff, marker]) + (len(body) + 2).to_bytes(2, 'big') + body
+
+APP0 = segment(0xe0, b'JFIF\x00' + bytes(9))
+SOF0 = segment(0xc0, bytes(15))
+SOS = segment(0xda, bytes(10))
+SCAN = b'\x11' * 100
+JPEG = SOI + APP0 + SOF0 + SOS + SCAN + EOI
+
+def test_valid_image():
+    assert check_jpeg(JPEG) is None
+    assert check_jpeg(memoryview(JPEG)) is None
+
+def test_zero_padding_after_eoi_is_accepted():
+    assert check_jpeg(JPEG + bytes(3)) is None
+
+def test_fill_bytes_and_restart_markers_are_skipped():
+    assert check_jpeg(SOI + b'\xff' + APP0 + b'\xff\xd0' + SOF0 + SOS + SCAN + EOI) is None
+
+@pytest.mark.parametrize('payload, reason', [
+    (JPEG[:100], 'too short'),
+    (b'\x00\x00' + JPEG[2:], 'missing SOI'),
+    (SOI + segment(0xe0, bytes(120)) + b'\xff\xc0', 'truncated headers'),
+    (SOI + bytes(200), 'invalid marker'),
+    (SOI + APP0 + EOI + bytes(120), 'missing scan'),
+    (SOI + b'\xff\xe0\xff\xff' + bytes(200), 'truncated segment'),
+    (SOI + APP0 + SOS + SCAN + EOI, 'missing frame header'),
+    (JPEG[:-2] + b'\x11\x11', 'missing EOI'),
+    (JPEG[:-50] + JPEG, 'mixed frames'),
+    (JPEG + b'\x01', 'data after EOI'),
+])
+def test_rejection_reasons(payload, reason):
+    assert check_jpeg(payload) == reason
+
+class Packet:
+    def __init__(self, seq, timestamp, payload, marker=0, arrival=None):
+        self.payload_type = 26
+        self.sequence_number = seq
+        self.timestamp = timestamp
+        self.payload = payload
+        self.marker = marker
+        self.arrival = arrival
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+def fragments(first_seq, timestamp, payload=JPEG, size=40, marker=True):
+    '''Splits a payload into packets of at most size bytes.'''
+    chunks = [payload[n:n + size] for n in range(0, len(payload), size)]
+    return [Packet((first_seq + n) % 65536, timestamp, chunk,
+                   marker and n == len(chunks) - 1, arrival=1.)
+            for n, chunk in enumerate(chunks)]
+
+def push_all(depacketizer, packets, arrival=1.):
+    return [frame for frame in (depacketizer.push(p, arrival) for p in packets)
+            if frame is not None]
+
+def test_fragments_are_assembled():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(10, 0)
+    frames = push_all(depacketizer, packets)
+    assert len(frames) == 1
+    frame = frames[0]
+    assert bytes(frame.payload) == JPEG
+    assert (frame.sequence_number, frame.timestamp, frame.fragments) == (10, 0, len(packets))
+    # the payload was copied, so the packets were given back
+    assert all(p.released for p in packets)
+
+def test_single_packet_frame_keeps_its_packet():
+    depacketizer = JpegDepacketizer()
+    packet, = fragments(0, 0, size=len(JPEG))
+    frame = depacketizer.push(packet, 1.)
+    assert frame.payload is packet.payload
+    assert not packet.released
+    frame.release()
+    assert packet.released
+
+def test_reordered_fragments_within_the_window():
+    depacketizer = JpegDepacketizer()
+    first, second = fragments(0, 0), fragments(len(fragments(0, 0)), 40)
+    # the two frames interleaved, each in reverse order
+    packets = [p for pair in zip(reversed(first), reversed(second)) for p in pair]
+    frames = push_all(depacketizer, packets)
+    assert [frame.timestamp for frame in frames] == [0, 40]
+    assert all(bytes(frame.payload) == JPEG for frame in frames)
+
+def test_fragments_across_sequence_wraparound():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(65534, 0)
+    frame, = push_all(depacketizer, packets[::-1])
+    assert bytes(frame.payload) == JPEG
+
+def test_duplicate_fragments_are_dropped():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(0, 0)
+    duplicate = Packet(1, 0, packets[1].payload)
+    frames = push_all(depacketizer, packets[:2] + [duplicate] + packets[2:])
+    assert len(frames) == 1
+    assert bytes(frames[0].payload) == JPEG
+    assert depacketizer.duplicate_fragments == 1
+    assert duplicate.released
+
+def test_late_fragments_of_a_completed_frame_are_dropped():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(0, 0)
+    push_all(depacketizer, packets)
+    late = Packet(1, 0, packets[1].payload)
+    assert depacketizer.push(late, 1.) is None
+    assert depacketizer.late_fragments == 1
+    assert late.released
+    assert depacketizer.stats()['frames_pending'] == 0
+
+def test_incomplete_frame_expires_after_the_deadline():
+    depacketizer = JpegDepacketizer(deadline=0.5)
+    packets = fragments(0, 0)
+    missing = packets.pop(2)
+    assert push_all(depacketizer, packets, arrival=1.) == []
+    depacketizer.expire(now=1.4)
+    assert depacketizer.frames_abandoned == 0
+    depacketizer.expire(now=1.6)
+    assert depacketizer.frames_abandoned == 1
+    assert all(p.released for p in packets)
+    # the missing fragment arriving after that is late
+    assert depacketizer.push(missing, 1.7) is None
+    assert depacketizer.late_fragments == 1
+
+def test_frames_pushed_out_of_the_window_are_abandoned():
+    depacketizer = JpegDepacketizer(window=2)
+    stalled = fragments(0, 0)[:-1]
+    push_all(depacketizer, stalled)
+    push_all(depacketizer, fragments(100, 40)[:1])
+    push_all(depacketizer, fragments(200, 80)[:1])
+    assert depacketizer.frames_abandoned == 1
+    assert all(p.released for p in stalled)
+
+def test_frame_ending_with_eoi_without_marker_bit():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(0, 0, marker=False)
+    frames = push_all(depacketizer, packets)
+    assert len(frames) == 1
+    assert bytes(frames[0].payload) == JPEG
+
+def test_reset_releases_pending_fragments():
+    depacketizer = JpegDepacketizer()
+    packets = fragments(0, 0)[:-1]
+    push_all(depacketizer, packets)
+    depacketizer.reset()
+    assert all(p.released for p in packets)
+    assert depacketizer.stats()['frames_pending'] == 0
@@ -0,0 +1,48 @@
+import os
+
+from mjpeg import MjpegFile
+
+FRAMES = [bytes([n]) * (100 + n) for n in range(5)]
+
+def write_video(path, frames, tail=b''):
+    with open(path, 'wb') as video:
+        for frame in frames:
+            video.write(b'%05d' % len(frame) + frame)
+        video.write(tail)
+    return str(path)
+
+def test_index_finds_every_frame(tmp_path):
+    video = MjpegFile(write_video(tmp_path / 'clip.Mjpeg', FRAMES))
+    assert len(video) == len(FRAMES)
+    assert [bytes(video.frame(n)) for n in range(len(video))] == FRAMES
+    assert video.duration == len(FRAMES) * MjpegFile.FRAME_PERIOD
+    video.close()
+
+def test_truncated_last_frame_is_ignored(tmp_path):
+    video = MjpegFile(write_video(tmp_path / 'clip.Mjpeg', FRAMES, b'00200' + bytes(10)))
+    assert len(video) == len(FRAMES)
+    video.close()
+
+def test_index_is_cached_and_reused(tmp_path, monkeypatch):
+    path = write_video(tmp_path / 'clip.Mjpeg', FRAMES)
+    MjpegFile(path).close()
+    assert os.path.exists(path + '.idx')
+    monkeypatch.setattr(MjpegFile, 'build_index', None) # must not be needed
+    video = MjpegFile(path)
+    assert bytes(video.frame(3)) == FRAMES[3]
+    video.close()
+
+def test_stale_index_is_rebuilt(tmp_path):
+    path = write_video(tmp_path / 'clip.Mjpeg', FRAMES)
+    MjpegFile(path).close()
+    write_video(tmp_path / 'clip.Mjpeg', FRAMES[:2])
+    video = MjpegFile(path)
+    assert len(video) == 2
+    video.close()
+
+def test_frame_at_clamps_to_the_video(tmp_path):
+    video = MjpegFile(write_video(tmp_path / 'clip.Mjpeg', FRAMES), use_cache=False)
+    assert video.frame_number_at(-10) == 0
+    assert video.frame_number_at(85) == 2
+    assert video.frame_number_at(10 ** 6) == len(FRAMES) - 1
+    video.close()
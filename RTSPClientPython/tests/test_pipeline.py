@@ -0,0 +1,63 @@
+from pipeline import BoundedQueue, WorkerPool
+from rtp import BufferPool, RtpPacket
+from session import drop_decode
+
+class Item:
+    def __init__(self, number):
+        self.number = number
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+def test_drop_oldest_releases_evicted_items():
+    queue = BoundedQueue(2)
+    items = [Item(n) for n in range(4)]
+    for item in items:
+        assert queue.put(item)
+    assert queue.dropped == 2
+    assert [item.released for item in items] == [True, True, False, False]
+    assert queue.get(0) is items[2]
+    assert not items[2].released
+
+def test_clear_releases_queued_items():
+    queue = BoundedQueue(4)
+    items = [Item(n) for n in range(3)]
+    for item in items:
+        queue.put(item)
+    queue.clear()
+    assert len(queue) == 0
+    assert all(item.released for item in items)
+
+def test_on_drop_callback():
+    dropped = []
+    queue = BoundedQueue(1, on_drop=dropped.append)
+    queue.put((1,))
+    queue.put((2,))
+    queue.put((3,))
+    queue.clear()
+    assert dropped == [(1,), (2,), (3,)]
+
+def test_items_without_release_are_dropped():
+    queue = BoundedQueue(1)
+    queue.put('first')
+    queue.put('second')
+    assert queue.get(0) == 'second'
+
+def test_evicted_packets_return_their_buffer():
+    pool = BufferPool(2048)
+    header = bytes([0x80, 26, 0, 1, 0, 0, 0, 40, 0, 0, 0, 1])
+    queue = BoundedQueue(1)
+    for _ in range(3):
+        buffer = pool.acquire()
+        buffer[:len(header)] = header
+        queue.put(RtpPacket(buffer, len(header), pool))
+    # each evicted packet's buffer is reused by the next one
+    assert pool.stats() == {'allocated': 2, 'reused': 1, 'free': 1}
+
+def test_decoder_pool_releases_dropped_frames():
+    pool = WorkerPool(lambda item: None, workers=0, capacity=1, on_drop=drop_decode)
+    frames = [Item(n) for n in range(3)]
+    for order, frame in enumerate(frames):
+        pool.submit((None, order, frame))
+    assert [frame.released for frame in frames] == [True, True, False]
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from playout import DriftEstimator, JitterBuffer
+
+class Frame:
+    def __init__(self, number):
+        self.number = number
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+def test_overflow_drops_and_releases_oldest():
+    buffer = JitterBuffer(capacity=4, adaptive=False)
+    frames = [Frame(n) for n in range(6)]
+    for n, frame in enumerate(frames):
+        assert buffer.push(n, 40 * n, frame, arrival=1. + 0.04 * n)
+    assert buffer.depth == 4
+    assert buffer.overflow_drops == 2
+    assert buffer.released == 0
+    assert [frame.released for frame in frames] == [True, True] + [False] * 4
+    # the dropped frames count as played out, so they are late if resent
+    assert not buffer.push(1, 40, Frame(1), arrival=1.3)
+    assert buffer.late_drops == 1
+
+def test_released_frames_are_not_released_by_the_buffer():
+    buffer = JitterBuffer(adaptive=False)
+    frames = [Frame(n) for n in range(3)]
+    for n, frame in enumerate(frames):
+        buffer.push(n, 40 * n, frame, arrival=1. + 0.04 * n)
+    ready = buffer.pop_ready(now=10.)
+    assert ready == frames
+    assert buffer.released == 3
+    assert not any(frame.released for frame in frames)
+
+def test_reset_releases_buffered_frames():
+    buffer = JitterBuffer(adaptive=False)
+    frames = [Frame(n) for n in range(3)]
+    for n, frame in enumerate(frames):
+        buffer.push(n, 40 * n, frame, arrival=1.)
+    buffer.reset()
+    assert buffer.depth == 0
+    assert all(frame.released for frame in frames)
+
+def test_items_without_release_can_be_dropped():
+    buffer = JitterBuffer(capacity=1, adaptive=False)
+    buffer.push(0, 0, 'first', arrival=1.)
+    buffer.push(1, 40, 'second', arrival=1.04)
+    assert buffer.overflow_drops == 1
+    assert buffer.pop_ready(now=10.) == ['second']
+
+def test_catch_up_skip_releases_dropped_frames():
+    buffer = JitterBuffer(adaptive=False, target_delay=0.05, max_latency=1.)
+    frames = [Frame(n) for n in range(50)]
+    # two seconds of video buffered is more than max_latency ahead
+    for n, frame in enumerate(frames):
+        buffer.push(n, 40 * n, frame, arrival=1. + 0.04 * n)
+    ready = buffer.pop_ready(now=1.)
+    assert buffer.skip_events == 1
+    assert buffer.skip_drops > 0
+    assert buffer.released == len(ready)
+    dropped = frames[:buffer.skip_drops]
+    assert all(frame.released for frame in dropped)
+    assert not any(frame.released for frame in frames[buffer.skip_drops:])
+    assert buffer.skip_drops + len(ready) + buffer.depth == len(frames)
+
+def read_while_running(target, read, seconds=0.5):
+    stop = threading.Event()
+    thread = threading.Thread(target=target, args=(stop,))
+    thread.start()
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            read()
+    finally:
+        stop.set()
+        thread.join()
+
+def test_drift_rate_read_while_samples_arrive():
+    drift = DriftEstimator()
+
+    def receive(stop):
+        n = 0
+        while not stop.is_set():
+            # a millisecond apart, so the window holds thousands of samples
+            drift.add(n / 1000., n)
+            n += 1
+
+    read_while_running(receive, lambda: drift.rate)
+
+def test_stats_read_while_frames_arrive():
+    buffer = JitterBuffer()
+
+    def receive(stop):
+        n = 0
+        while not stop.is_set():
+            buffer.push(n % 65536, n, Frame(n), arrival=1. + n / 1000.)
+            buffer.pop_ready(now=1. + n / 1000.)
+            n += 1
+
+    read_while_running(receive, buffer.stats)
@@ -0,0 +1,97 @@
+import struct
+
+import pytest
+
+from rtp import BufferPool, RtpPacket
+
+PAYLOAD = b'\xff\xd8jpeg data\xff\xd9'
+
+def packet(payload=PAYLOAD, marker=1, csrcs=(), extension=None, padding=0,
+           seq=4660, timestamp=123456, ssrc=0xdeadbeef):
+    '''Builds an RTP packet; extension is a list of 32-bit words.'''
+    b0 = 2 << 6 | bool(padding) << 5 | (extension is not None) << 4 | len(csrcs)
+    data = struct.pack('!BBHII', b0, marker << 7 | 26, seq, timestamp, ssrc)
+    data += b''.join(struct.pack('!I', csrc) for csrc in csrcs)
+    if extension is not None:
+        data += struct.pack('!HH', 0xbede, len(extension))
+        data += b''.join(struct.pack('!I', word) for word in extension)
+    data += payload
+    if padding:
+        data += bytes(padding - 1) + bytes([padding])
+    return data
+
+def parse(data, size=None):
+    '''Parses data from a receive buffer larger than the packet.'''
+    buffer = bytearray(size or len(data) + 64)
+    buffer[:len(data)] = data
+    return RtpPacket(buffer, len(data))
+
+def test_fixed_header():
+    p = parse(packet())
+    assert (p.version, p.padding, p.extension, p.csrc_count) == (2, 0, 0, 0)
+    assert (p.marker, p.payload_type) == (1, 26)
+    assert (p.sequence_number, p.timestamp, p.ssrc) == (4660, 123456, 0xdeadbeef)
+    assert bytes(p.payload) == PAYLOAD
+
+def test_csrc_identifiers_are_skipped():
+    p = parse(packet(csrcs=(1, 2, 3)))
+    assert p.csrc_count == 3
+    assert bytes(p.payload) == PAYLOAD
+
+def test_header_extension_is_skipped():
+    p = parse(packet(extension=[7, 8]))
+    assert p.extension == 1
+    assert bytes(p.payload) == PAYLOAD
+
+def test_empty_header_extension():
+    assert bytes(parse(packet(extension=[])).payload) == PAYLOAD
+
+def test_padding_is_removed():
+    p = parse(packet(padding=4))
+    assert p.padding == 1
+    assert bytes(p.payload) == PAYLOAD
+
+def test_csrc_extension_and_padding_together():
+    p = parse(packet(csrcs=(9,), extension=[1], padding=3, marker=0))
+    assert p.marker == 0
+    assert bytes(p.payload) == PAYLOAD
+
+def test_empty_payload():
+    assert bytes(parse(packet(payload=b'')).payload) == b''
+
+def test_shorter_than_fixed_header():
+    with pytest.raises(ValueError):
+        parse(packet()[:11])
+
+def test_csrc_list_exceeds_packet():
+    data = packet(payload=b'', csrcs=(1, 2))
+    with pytest.raises(ValueError):
+        parse(data[:-4])
+
+def test_extension_header_exceeds_packet():
+    data = packet(payload=b'', extension=[])
+    with pytest.raises(ValueError):
+        parse(data[:-2])
+
+def test_extension_words_exceed_packet():
+    data = packet(payload=b'', extension=[1, 2, 3])
+    with pytest.raises(ValueError):
+        parse(data[:-4])
+
+def test_padding_exceeds_payload():
+    data = bytearray(packet(payload=b'ab', padding=1))
+    data[-1] = 200
+    with pytest.raises(ValueError):
+        parse(bytes(data))
+
+def test_release_returns_the_buffer_once():
+    pool = BufferPool(128)
+    buffer = pool.acquire()
+    data = packet()
+    buffer[:len(data)] = data
+    p = RtpPacket(buffer, len(data), pool)
+    p.release()
+    p.release()
+    assert pool.stats()['free'] == 1
+    with pytest.raises(ValueError):
+        bytes(p.payload)
@@ -0,0 +1,101 @@
+import socket
+
+import pytest
+
+from rtsp import Connection, ResponseParser
+
+def reply(cseq, session=123456, extra='', body=b'', newline='\r\n'):
+    lines = ['RTSP/1.0 200 OK', f'CSeq: {cseq}', f'Session: {session}']
+    if body:
+        lines.append(f'Content-Length: {len(body)}')
+    if extra:
+        lines.append(extra)
+    return (newline.join(lines) + newline * 2).encode() + body
+
+def test_complete_response():
+    responses = ResponseParser().feed(reply(1))
+    assert len(responses) == 1
+    response = responses[0]
+    assert (response.response_code, response.cseq, response.session_id) == (200, 1, 123456)
+    assert response.body == b''
+
+def test_lf_only_response():
+    # the Java server writes its replies with println
+    responses = ResponseParser().feed(b'RTSP/1.0 200 OK\nCSeq: 1\nSession: 123456\n\n')
+    assert [(r.cseq, r.session_id) for r in responses] == [(1, 123456)]
+
+def test_lf_only_responses_split_and_pipelined():
+    data = reply(1, newline='\n') + reply(2, newline='\n')
+    parser = ResponseParser()
+    responses = []
+    for n in range(0, len(data), 3):
+        responses += parser.feed(data[n:n + 3])
+    assert [r.cseq for r in responses] == [1, 2]
+
+def test_response_split_across_segments():
+    data = reply(7, extra='Range: npt=1.000-')
+    parser = ResponseParser()
+    for n in range(len(data) - 1):
+        assert parser.feed(data[n:n + 1]) == []
+    responses = parser.feed(data[-1:])
+    assert responses[0].cseq == 7
+    assert responses[0].headers['range'] == 'npt=1.000-'
+
+def test_split_between_crlf_pairs():
+    data = reply(3)
+    parser = ResponseParser()
+    assert parser.feed(data[:-2]) == []
+    assert [r.cseq for r in parser.feed(data[-2:])] == [3]
+
+def test_content_length_body():
+    body = b'v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\n\r\n'
+    data = reply(2, body=body) + reply(3)
+    parser = ResponseParser()
+    # the body is incomplete, so the response is not returned yet
+    assert parser.feed(data[:len(data) - len(reply(3)) - 5]) == []
+    responses = parser.feed(data[len(data) - len(reply(3)) - 5:])
+    assert [r.cseq for r in responses] == [2, 3]
+    assert responses[0].body == body
+    assert responses[1].body == b''
+
+def test_pipelined_out_of_order_responses():
+    parser = ResponseParser()
+    responses = parser.feed(reply(5) + reply(4) + reply(6)[:10])
+    assert [r.cseq for r in responses] == [5, 4]
+    assert [r.cseq for r in parser.feed(reply(6)[10:])] == [6]
+
+def test_error_response():
+    response, = ResponseParser().feed(b'RTSP/1.0 454 Session Not Found\r\nCSeq: 9\r\n\r\n')
+    assert response.response_code == 454
+    assert response.message == 'Session Not Found'
+    assert response.session_id is None
+
+@pytest.fixture
+def server():
+    listener = socket.create_server(('127.0.0.1', 0))
+    yield listener
+    listener.close()
+
+def connect(server):
+    connection = Connection(None, server.getsockname())
+    peer, _ = server.accept()
+    return connection, peer
+
+def test_responses_matched_by_cseq(server):
+    connection, peer = connect(server)
+    connection.outstanding = {1: ('SETUP', 0.), 2: ('PLAY', 0.)}
+    peer.sendall(b'RTSP/1.0 200 OK\nCSeq: 2\nSession: 42\n\n'
+                 b'RTSP/1.0 200 OK\nCSeq: 1\nSession: 42\n\n')
+    assert connection.get_response(1).cseq == 1
+    assert connection.get_response(2).cseq == 2
+    assert set(connection.latency.stats()) == {'SETUP', 'PLAY'}
+    peer.close()
+    connection.socket.close()
+
+def test_get_response_times_out(server, monkeypatch):
+    monkeypatch.setattr(Connection, 'CONTROL_TIMEOUT', 0.1)
+    connection, peer = connect(server)
+    with pytest.raises(socket.timeout):
+        connection.get_response(1)
+    peer.close()
+    connection.socket.close()
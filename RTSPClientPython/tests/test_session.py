@@ -0,0 +1,65 @@
+import asyncio
+
+from session import AsyncSession, SessionListener, VideoFrame
+
+class Image:
+    size = (4, 4)
+
+    def getbands(self):
+        return ('R', 'G', 'B')
+
+class ErrorListener(SessionListener):
+    def __init__(self):
+        self.errors = []
+
+    def exception_thrown(self, exception):
+        self.errors.append(exception)
+
+def cached_frame(timestamp):
+    frame = VideoFrame(26, 0, 1, timestamp, b'')
+    frame.image = Image()
+    return frame
+
+def test_async_open_clears_frame_cache():
+    session = AsyncSession(('127.0.0.1', 1))
+    listener = ErrorListener()
+    session.add_listener(listener)
+    cache = session.enable_frame_cache()
+    cache.put(cached_frame(40))
+    assert len(cache) == 1
+    # not connected, so SETUP fails after the video state is reset
+    asyncio.run(session.open('movie1.Mjpeg'))
+    assert listener.errors
+    assert session.video_name == 'movie1.Mjpeg'
+    assert len(cache) == 0
+
+def test_async_open_resets_concealment():
+    session = AsyncSession(('127.0.0.1', 1))
+    session.add_listener(ErrorListener())
+    session.concealment.accept(cached_frame(40))
+    session.concealment.reject(cached_frame(80), 'missing EOI')
+    asyncio.run(session.open('movie1.Mjpeg'))
+    assert session.concealment.last_good is None
+    assert session.concealment.concealing_since is None
+
+def test_decode_cached_keeps_the_image_of_copies():
+    session = AsyncSession(('127.0.0.1', 1))
+    session.enable_decode_cache()
+    session.enable_frame_cache()
+    held = cached_frame(40).copy(cached_frame(80))
+    assert held.payload is None
+    image = held.image
+    assert session.decode_cached(held) is image
+    assert session.decode_cache.stats()['misses'] == 0
+
+def test_image_to_show_conceals_decode_errors():
+    session = AsyncSession(('127.0.0.1', 1))
+    good = cached_frame(40)
+    session.concealment.accept(good)
+    bad = VideoFrame(26, 0, 2, 80, b'not a jpeg')
+    assert session.image_to_show(bad) is good.image
+    assert session.concealment.stats()['reasons'] == {'decode error': 1}
+
+def test_image_to_show_skips_undecodable_frames_without_a_held_one():
+    session = AsyncSession(('127.0.0.1', 1))
+    assert session.image_to_show(VideoFrame(26, 0, 2, 80, b'not a jpeg')) is None
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from stats import StreamStatistics
+
+FRAGMENTS = 7
+
+def fragmented(frames, first_seq=0):
+    '''(seq, timestamp) of frames split into FRAGMENTS packets each, 40 ms
+    apart.
+    '''
+    return [((first_seq + n) % StreamStatistics.SEQ_MOD, 40 * (n // FRAGMENTS))
+            for n in range(frames * FRAGMENTS)]
+
+def delay(packets, every, distance):
+    '''Moves every every-th packet distance places later.'''
+    packets = list(packets)
+    for index in range(len(packets) - distance - 1, 0, -every):
+        packets.insert(index + distance, packets.pop(index))
+    return packets
+
+def receive(statistics, packets):
+    for n, (seq, timestamp) in enumerate(packets):
+        statistics.packet_received(seq, timestamp, 1400, arrival=n / 1000.)
+
+def test_reorder_past_rfc_window_is_not_loss():
+    packets = delay(fragmented(300), 50, 147)
+    statistics = StreamStatistics()
+    receive(statistics, packets)
+    assert statistics.received == len(packets)
+    assert statistics.expected == len(packets)
+    assert statistics.lost == 0
+    assert statistics.reordered > 0
+    assert statistics.duplicates == 0
+
+def test_reorder_across_wraparound():
+    packets = delay(fragmented(300, first_seq=StreamStatistics.SEQ_MOD - 1000), 50, 147)
+    statistics = StreamStatistics()
+    receive(statistics, packets)
+    assert statistics.lost == 0
+    assert statistics.expected == len(packets)
+
+def test_rfc_window_counts_late_packets_as_lost():
+    packets = delay(fragmented(300), 50, 147)
+    statistics = StreamStatistics(max_misorder=100)
+    receive(statistics, packets)
+    assert statistics.reordered == 0
+    assert statistics.lost > 0
+
+def test_reordered_duplicates_are_detected():
+    packets = delay(fragmented(100), 50, 147)
+    statistics = StreamStatistics()
+    receive(statistics, packets + packets[-200:-190])
+    assert statistics.duplicates == 10
+    assert statistics.lost == 0
+
+def test_max_misorder_is_bounded_by_duplicate_window():
+    with pytest.raises(ValueError):
+        StreamStatistics(max_misorder=StreamStatistics.DUPLICATE_WINDOW)
+
+def test_rates_read_while_packets_arrive():
+    statistics = StreamStatistics()
+    stop = threading.Event()
+
+    def receive():
+        seq = 0
+        while not stop.is_set():
+            statistics.packet_received(seq % StreamStatistics.SEQ_MOD, 40 * seq, 1400)
+            statistics.frame_completed()
+            seq += 1
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            statistics.snapshot()
+    finally:
+        stop.set()
+        thread.join()